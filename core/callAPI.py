@@ -11,11 +11,13 @@ class VertexClient:
         )
         self.model = GenerativeModel(model)
 
-    def send_data_to_AI(self, prompt, file_path=None, temperature=0.5, top_p=0.8):
+    def send_data_to_AI(self, prompt, file_path=None, temperature=0.5, top_p=0.8, pdf_bytes=None):
+        """pdf_bytes: nội dung PDF đã có trong RAM (bỏ qua file_path, không đọc lại đĩa)"""
         parts = []
-        if file_path:
+        if pdf_bytes is None and file_path:
             with open(file_path, "rb") as f:
                 pdf_bytes = f.read()
+        if pdf_bytes is not None:
             parts.append(Part.from_data(data=pdf_bytes, mime_type="application/pdf"))
         parts.append(Part.from_text(prompt))
         generation_config = GenerationConfig(temperature=temperature, top_p=top_p)
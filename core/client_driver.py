@@ -1,12 +1,34 @@
 import os
+import json
 import pickle
 import re
 import io
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import httplib2
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
 
+# Cấu hình tải song song
+DEFAULT_DOWNLOAD_WORKERS = 6
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024  # 64MB / request -> ít round-trip với file sách lớn
+DOWNLOAD_NUM_RETRIES = 3
+
+# Cấu hình duyệt cây thư mục
+FOLDER_MIME = 'application/vnd.google-apps.folder'
+PDF_MIME = 'application/pdf'
+LIST_PAGE_SIZE = 1000
+PARENTS_PER_QUERY = 40  # Số folder cha gộp trong 1 query ('a' in parents or 'b' in parents ...)
+DEFAULT_LIST_WORKERS = 4
+LIST_FIELDS = "nextPageToken, files(id, name, mimeType, size, md5Checksum, modifiedTime, parents)"
+
+# Đồng bộ incremental
+MANIFEST_FILE_NAME = ".drive_manifest.json"
+CHANGES_FIELDS = "nextPageToken, newStartPageToken, changes(fileId, removed, file(id, mimeType, parents, trashed))"
+
 class GoogleDriveAPI:
     def __init__(self, client_secrets_file):
         """
@@ -21,6 +43,8 @@ class GoogleDriveAPI:
         # Xác thực và tạo service
         self.creds = self._authenticate()
         self.service = build('drive', 'v3', credentials=self.creds)
+        # httplib2 không thread-safe -> mỗi thread tải có Http + service riêng
+        self._thread_local = threading.local()
     
     def _authenticate(self):
         """Xác thực OAuth2"""
@@ -79,33 +103,80 @@ class GoogleDriveAPI:
             print(f"Lỗi khi lấy tên folder: {e}")
             return 'Unknown'
     
+    def _list_children(self, parent_ids, mime_types):
+        """
+        Liệt kê con trực tiếp của nhiều folder trong 1 query, đi hết mọi trang (nextPageToken)
+        """
+        parents_query = " or ".join(f"'{parent_id}' in parents" for parent_id in parent_ids)
+        mime_query = " or ".join(f"mimeType='{mime}'" for mime in mime_types)
+        query = f"({parents_query}) and ({mime_query}) and trashed=false"
+
+        service = self._get_thread_service()
+        items = []
+        page_token = None
+        while True:
+            results = service.files().list(
+                q=query,
+                fields=LIST_FIELDS,
+                pageSize=LIST_PAGE_SIZE,
+                pageToken=page_token,
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True
+            ).execute()
+            items.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return items
+
+    def walk_folder_tree(self, root_folder_id, max_workers=DEFAULT_LIST_WORKERS):
+        """
+        Duyệt cây thư mục theo chiều rộng (BFS): mỗi tầng gộp nhiều folder cha vào 1 query,
+        các query trong cùng tầng chạy song song. Lấy folder và PDF trong cùng 1 lượt.
+        Returns: (folders_map {folder_id: relative_path}, pdf_files [dict file + 'relative_path'])
+        """
+        folders_map = {root_folder_id: ""}
+        pdf_files = []
+        current_level = [root_folder_id]
+        depth = 0
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while current_level:
+                level_ids = set(current_level)
+                chunks = [current_level[i:i + PARENTS_PER_QUERY] for i in range(0, len(current_level), PARENTS_PER_QUERY)]
+                results = executor.map(lambda chunk: self._list_children(chunk, [FOLDER_MIME, PDF_MIME]), chunks)
+
+                next_level = []
+                for items in results:
+                    for item in items:
+                        parent_id = next((pid for pid in item.get('parents', []) if pid in level_ids), None)
+                        if parent_id is None:
+                            continue
+                        parent_path = folders_map[parent_id]
+                        if item['mimeType'] == FOLDER_MIME:
+                            if item['id'] in folders_map:
+                                continue  # Folder có nhiều cha -> chỉ lấy 1 lần
+                            folders_map[item['id']] = os.path.join(parent_path, item['name']) if parent_path else item['name']
+                            next_level.append(item['id'])
+                        else:
+                            pdf_files.append(dict(item, relative_path=parent_path))
+
+                depth += 1
+                print(f"  Tầng {depth}: {len(current_level)} folder -> {len(next_level)} folder con, tổng {len(pdf_files)} PDF")
+                current_level = next_level
+
+        return folders_map, pdf_files
+
     def list_all_folders(self, parent_folder_id, current_path=""):
         """
-        Liệt kê tất cả các folder con đệ quy
+        Liệt kê tất cả các folder con (BFS, có phân trang)
         Returns: dict {folder_id: relative_path}
         """
-        folders_map = {}
-        
         try:
-            # Lấy tất cả folder con
-            query = f"'{parent_folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
-            results = self.service.files().list(
-                q=query,
-                fields="files(id, name)",
-                pageSize=100
-            ).execute()
-            
-            folders = results.get('files', [])
-            
-            for folder in folders:
-                folder_path = os.path.join(current_path, folder['name']) if current_path else folder['name']
-                folders_map[folder['id']] = folder_path
-                print(f"Tìm thấy folder: {folder_path}")
-                
-                # Đệ quy vào folder con
-                sub_folders = self.list_all_folders(folder['id'], folder_path)
-                folders_map.update(sub_folders)
-            
+            folders_map, _ = self.walk_folder_tree(parent_folder_id)
+            folders_map.pop(parent_folder_id, None)
+            if current_path:
+                folders_map = {fid: os.path.join(current_path, path) for fid, path in folders_map.items()}
+            print(f"Tìm thấy {len(folders_map)} folder")
             return folders_map
             
         except Exception as e:
@@ -113,16 +184,9 @@ class GoogleDriveAPI:
             return {}
     
     def list_pdf_files_in_folder(self, folder_id):
-        """Liệt kê tất cả file PDF trong một folder cụ thể"""
+        """Liệt kê tất cả file PDF trong một folder cụ thể (đi hết mọi trang)"""
         try:
-            query = f"'{folder_id}' in parents and mimeType='application/pdf' and trashed=false"
-            results = self.service.files().list(
-                q=query,
-                fields="files(id, name, size)",
-                pageSize=100
-            ).execute()
-            
-            return results.get('files', [])
+            return self._list_children([folder_id], [PDF_MIME])
         except Exception as e:
             print(f"Lỗi khi liệt kê PDF trong folder {folder_id}: {e}")
             return []
@@ -150,10 +214,109 @@ class GoogleDriveAPI:
             print(f"  ✗ Lỗi khi tải file {file_name}: {e}")
             return None
     
-    def download_all_pdfs_with_structure(self, root_folder_id, base_download_path):
+    def _get_thread_service(self):
+        """Service Drive riêng cho thread hiện tại (mỗi thread 1 httplib2.Http)"""
+        service = getattr(self._thread_local, "service", None)
+        if service is None:
+            authed_http = AuthorizedHttp(self.creds, http=httplib2.Http(timeout=300))
+            service = build('drive', 'v3', http=authed_http, cache_discovery=False)
+            self._thread_local.service = service
+        return service
+
+    def _fetch_media(self, file_id, fh, chunk_size, on_bytes):
+        """Tải nội dung 1 file Drive vào file-object fh theo từng chunk"""
+        request = self._get_thread_service().files().get_media(fileId=file_id)
+        downloader = MediaIoBaseDownload(fh, request, chunksize=chunk_size)
+        last_bytes = 0
+        done = False
+        while not done:
+            status, done = downloader.next_chunk(num_retries=DOWNLOAD_NUM_RETRIES)
+            if status:
+                on_bytes(status.resumable_progress - last_bytes)
+                last_bytes = status.resumable_progress
+
+    def _download_one(self, spec, chunk_size, on_bytes):
+        """Tải 1 file vào spec['download_path'] qua file .part rồi đổi tên (không để lại file dở)"""
+        os.makedirs(spec['download_path'], exist_ok=True)
+        file_path = os.path.join(spec['download_path'], spec['name'])
+        part_path = file_path + ".part"
+
+        try:
+            with io.FileIO(part_path, 'wb') as fh:
+                self._fetch_media(spec['id'], fh, chunk_size, on_bytes)
+            os.replace(part_path, file_path)
+            return file_path
+        except Exception:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+
+    def _download_one_to_memory(self, spec, chunk_size, on_bytes):
+        """Tải 1 file thẳng vào RAM (không ghi đĩa), trả về bytes"""
+        buffer = io.BytesIO()
+        self._fetch_media(spec['id'], buffer, chunk_size, on_bytes)
+        return buffer.getvalue()
+
+    def download_files_concurrently(self, file_specs, max_workers=DEFAULT_DOWNLOAD_WORKERS,
+                                    chunk_size=DEFAULT_CHUNK_SIZE, progress_callback=None, on_file_done=None,
+                                    in_memory=False):
+        """
+        Tải nhiều file song song với pool giới hạn.
+        Args:
+            file_specs: list dict {id, name, size, download_path}
+            progress_callback(done_files, total_files, bytes_done, total_bytes): tiến độ tổng hợp
+            on_file_done(spec, result): gọi ngay khi 1 file tải xong (result=None nếu lỗi)
+            in_memory: True -> không ghi đĩa, result là bytes nội dung file (download_path không cần)
+        Returns: list đường dẫn file đã tải thành công (in_memory: list spec đã tải thành công,
+                 bytes chỉ được trao qua on_file_done để không giữ cả cây trong RAM)
+        """
+        total_files = len(file_specs)
+        total_bytes = sum(int(spec.get('size') or 0) for spec in file_specs)
+        state = {"files": 0, "bytes": 0}
+        lock = threading.Lock()
+        downloaded = []
+
+        def report(delta_bytes=0, file_done=False):
+            with lock:
+                state["bytes"] += delta_bytes
+                if file_done:
+                    state["files"] += 1
+                snapshot = (state["files"], total_files, state["bytes"], total_bytes)
+            if progress_callback:
+                progress_callback(*snapshot)
+
+        fetch = self._download_one_to_memory if in_memory else self._download_one
+
+        def worker(spec):
+            try:
+                result = fetch(spec, chunk_size, lambda delta: report(delta))
+            except Exception as e:
+                print(f"  ✗ Lỗi khi tải file {spec['name']}: {e}")
+                result = None
+            report(file_done=True)
+            if on_file_done:
+                on_file_done(spec, result)
+            if in_memory:
+                return spec if result is not None else None
+            return result
+
+        print(f"⬇️ Tải {total_files} file ({total_bytes / (1024 * 1024):.1f} MB) với {max_workers} luồng, chunk {chunk_size // (1024 * 1024)}MB")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(worker, spec) for spec in file_specs]
+            for future in as_completed(futures):
+                result = future.result()
+                if result:
+                    downloaded.append(result)
+
+        print(f"  ✓ Đã tải {len(downloaded)}/{total_files} file")
+        return downloaded
+
+    def download_all_pdfs_with_structure(self, root_folder_id, base_download_path, max_workers=DEFAULT_DOWNLOAD_WORKERS,
+                                         chunk_size=DEFAULT_CHUNK_SIZE, progress_callback=None, on_file_done=None):
         """
         Tải xuống tất cả PDF từ folder gốc và các folder con
-        với cấu trúc thư mục được giữ nguyên
+        với cấu trúc thư mục được giữ nguyên (tải song song).
+        Returns: list đường dẫn PDF đã tải
         """
         try:
             # Lấy tên folder gốc
@@ -163,47 +326,222 @@ class GoogleDriveAPI:
             # Tạo thư mục gốc
             root_download_path = os.path.join(base_download_path, root_folder_name)
             
-            # Lấy danh sách tất cả folders
+            # Quét cây thư mục 1 lượt: lấy luôn danh sách PDF
             print("\n=== Đang quét cấu trúc thư mục ===")
-            all_folders = self.list_all_folders(root_folder_id)
-            all_folders[root_folder_id] = ""  # Thêm folder gốc
-            
-            total_files = 0
-            downloaded_files = 0
+            all_folders, pdf_files = self.walk_folder_tree(root_folder_id)
+            print(f"Tìm thấy {len(all_folders) - 1} folder con, {len(pdf_files)} PDF")
             
             print(f"\n=== Bắt đầu tải PDF ===")
-            
-            # Duyệt qua từng folder
-            for folder_id, relative_path in all_folders.items():
+            file_specs = []
+            for pdf_file in pdf_files:
+                relative_path = pdf_file['relative_path']
                 folder_download_path = os.path.join(root_download_path, relative_path) if relative_path else root_download_path
-                
-                # Lấy danh sách PDF trong folder này
-                pdf_files = self.list_pdf_files_in_folder(folder_id)
-                
-                if pdf_files:
-                    folder_display_path = relative_path if relative_path else root_folder_name
-                    print(f"\nFolder: {folder_display_path} ({len(pdf_files)} PDFs)")
-                    
-                    total_files += len(pdf_files)
-                    
-                    # Tải từng file PDF
-                    for pdf_file in pdf_files:
-                        print(f"  Đang tải: {pdf_file['name']}")
-                        result = self.download_file(
-                            pdf_file['id'], 
-                            pdf_file['name'], 
-                            folder_download_path
-                        )
-                        if result:
-                            downloaded_files += 1
+                file_specs.append(dict(pdf_file, download_path=folder_download_path))
+            
+            downloaded_files = self.download_files_concurrently(
+                file_specs, max_workers=max_workers, chunk_size=chunk_size,
+                progress_callback=progress_callback, on_file_done=on_file_done
+            )
             
             print(f"\n=== Hoàn thành ===")
-            print(f"Tổng số file PDF: {total_files}")
-            print(f"Đã tải thành công: {downloaded_files}")
+            print(f"Tổng số file PDF: {len(file_specs)}")
+            print(f"Đã tải thành công: {len(downloaded_files)}")
             print(f"Thư mục lưu: {root_download_path}")
+            return downloaded_files
             
         except Exception as e:
             print(f"Lỗi trong quá trình tải: {e}")
+            return []
+
+    def stream_pdfs_with_structure(self, root_folder_id, max_workers=DEFAULT_DOWNLOAD_WORKERS,
+                                   chunk_size=DEFAULT_CHUNK_SIZE, progress_callback=None, on_file_done=None):
+        """
+        Tải tất cả PDF trong cây thư mục thẳng vào RAM, không ghi file nguồn xuống đĩa.
+        on_file_done(spec, data): spec có thêm 'relative_path' và 'root_folder_name', data là bytes
+        (None nếu lỗi). Hàm này được gọi từ luồng tải nên có thể chặn để giới hạn RAM.
+        Returns: list spec đã tải thành công
+        """
+        root_folder_name = self.get_folder_name(root_folder_id)
+        print(f"Bắt đầu tải (trong RAM) từ folder: {root_folder_name}")
+        all_folders, pdf_files = self.walk_folder_tree(root_folder_id)
+        print(f"Tìm thấy {len(all_folders) - 1} folder con, {len(pdf_files)} PDF")
+        file_specs = [dict(pdf_file, root_folder_name=root_folder_name) for pdf_file in pdf_files]
+        return self.download_files_concurrently(
+            file_specs, max_workers=max_workers, chunk_size=chunk_size,
+            progress_callback=progress_callback, on_file_done=on_file_done, in_memory=True
+        )
+
+    # ============================================================
+    # ĐỒNG BỘ INCREMENTAL (MANIFEST + CHANGES API)
+    # ============================================================
+    @staticmethod
+    def _load_manifest(manifest_path, root_folder_id):
+        empty = {"root_folder_id": root_folder_id, "page_token": None, "folders": {}, "files": {}}
+        if not os.path.exists(manifest_path):
+            return empty
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get("root_folder_id") != root_folder_id:
+                return empty
+            return manifest
+        except Exception as e:
+            print(f"⚠️ Manifest hỏng, quét lại toàn bộ: {e}")
+            return empty
+
+    @staticmethod
+    def _save_manifest(manifest_path, manifest):
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, manifest_path)
+
+    def get_start_page_token(self):
+        response = self.service.changes().getStartPageToken(supportsAllDrives=True).execute()
+        return response.get('startPageToken')
+
+    def list_changes(self, page_token):
+        """
+        Đọc toàn bộ thay đổi kể từ page_token.
+        Returns: (changes, new_start_page_token)
+        """
+        changes = []
+        while page_token:
+            response = self.service.changes().list(
+                pageToken=page_token,
+                fields=CHANGES_FIELDS,
+                pageSize=LIST_PAGE_SIZE,
+                includeItemsFromAllDrives=True,
+                supportsAllDrives=True
+            ).execute()
+            changes.extend(response.get('changes', []))
+            if 'newStartPageToken' in response:
+                return changes, response['newStartPageToken']
+            page_token = response.get('nextPageToken')
+        return changes, None
+
+    @staticmethod
+    def _changes_touch_tree(changes, manifest):
+        """Có thay đổi nào thuộc cây thư mục đang đồng bộ không"""
+        known_folders = set(manifest["folders"])
+        known_files = manifest["files"]
+        for change in changes:
+            file_id = change.get('fileId')
+            if file_id in known_files or file_id in known_folders:
+                return True
+            parents = (change.get('file') or {}).get('parents', [])
+            if any(parent_id in known_folders for parent_id in parents):
+                return True
+        return False
+
+    @staticmethod
+    def _is_unchanged(old_entry, pdf_file, local_path):
+        if not old_entry or old_entry.get('local_path') != local_path or not os.path.exists(local_path):
+            return False
+        if pdf_file.get('md5Checksum') and old_entry.get('md5Checksum'):
+            return pdf_file['md5Checksum'] == old_entry['md5Checksum']
+        return (pdf_file.get('modifiedTime') == old_entry.get('modifiedTime')
+                and str(pdf_file.get('size')) == str(old_entry.get('size')))
+
+    def sync_pdfs_with_structure(self, root_folder_id, base_download_path, manifest_path=None,
+                                 max_workers=DEFAULT_DOWNLOAD_WORKERS, chunk_size=DEFAULT_CHUNK_SIZE,
+                                 progress_callback=None, on_file_done=None):
+        """
+        Đồng bộ incremental: chỉ tải PDF mới / đã sửa so với manifest lần trước.
+        - Có page token: hỏi Changes API trước, không có thay đổi trong cây -> không cần quét lại.
+        - Ngược lại: quét cây 1 lượt và so md5Checksum (fallback modifiedTime + size).
+        Manifest chỉ cho biết bản local đã khớp Drive, KHÔNG có nghĩa sách đã xử lý xong:
+        file không đổi vẫn được đưa qua on_file_done (không tải lại) để bên xử lý tự quyết định
+        bỏ qua theo checkpoint của nó - sách xử lý lỗi lần trước sẽ được thử lại.
+        Returns: list đường dẫn PDF local đã đồng bộ (file không đổi + file vừa tải)
+        """
+        root_folder_name = self.get_folder_name(root_folder_id)
+        root_download_path = os.path.join(base_download_path, root_folder_name)
+        manifest_path = manifest_path or os.path.join(root_download_path, MANIFEST_FILE_NAME)
+        manifest = self._load_manifest(manifest_path, root_folder_id)
+
+        # 1. Đường nhanh: Changes API
+        if manifest.get("page_token"):
+            try:
+                changes, new_token = self.list_changes(manifest["page_token"])
+                local_ok = all(os.path.exists(entry['local_path']) for entry in manifest["files"].values())
+                if new_token and local_ok and not self._changes_touch_tree(changes, manifest):
+                    manifest["page_token"] = new_token
+                    self._save_manifest(manifest_path, manifest)
+                    print(f"✅ Drive không có thay đổi ({len(changes)} change ngoài phạm vi), bỏ qua quét lại.")
+                    return self._pass_through_unchanged(manifest["files"], on_file_done)
+                print(f"🔄 Phát hiện thay đổi ({len(changes)} change), quét lại cây thư mục...")
+            except Exception as e:
+                print(f"⚠️ Không đọc được Changes API, chuyển sang so md5: {e}")
+
+        # Lấy token TRƯỚC khi quét để không bỏ lỡ thay đổi xảy ra trong lúc quét
+        try:
+            start_token = self.get_start_page_token()
+        except Exception as e:
+            print(f"⚠️ Không lấy được start page token: {e}")
+            start_token = None
+
+        # 2. Quét cây + so md5
+        folders_map, pdf_files = self.walk_folder_tree(root_folder_id)
+        old_files = manifest["files"]
+        new_files = {}
+        file_specs = []
+        for pdf_file in pdf_files:
+            relative_path = pdf_file['relative_path']
+            folder_download_path = os.path.join(root_download_path, relative_path) if relative_path else root_download_path
+            local_path = os.path.join(folder_download_path, pdf_file['name'])
+            old_entry = old_files.get(pdf_file['id'])
+            if self._is_unchanged(old_entry, pdf_file, local_path):
+                new_files[pdf_file['id']] = old_entry
+            else:
+                file_specs.append(dict(pdf_file, download_path=folder_download_path))
+
+        removed = len(set(old_files) - {pdf_file['id'] for pdf_file in pdf_files})
+        print(f"📊 Sync: {len(pdf_files)} PDF trên Drive, {len(file_specs)} mới/thay đổi, {removed} đã xóa khỏi Drive")
+        unchanged = self._pass_through_unchanged(new_files, on_file_done)
+
+        manifest_lock = threading.Lock()
+        failed = []
+
+        def record_download(spec, local_path):
+            with manifest_lock:
+                if local_path:
+                    new_files[spec['id']] = {
+                        "name": spec['name'],
+                        "md5Checksum": spec.get('md5Checksum'),
+                        "modifiedTime": spec.get('modifiedTime'),
+                        "size": spec.get('size'),
+                        "local_path": local_path,
+                    }
+                else:
+                    failed.append(spec['id'])
+            if on_file_done:
+                on_file_done(spec, local_path)
+
+        downloaded = []
+        if file_specs:
+            downloaded = self.download_files_concurrently(
+                file_specs, max_workers=max_workers, chunk_size=chunk_size,
+                progress_callback=progress_callback, on_file_done=record_download
+            )
+
+        manifest["folders"] = folders_map
+        manifest["files"] = new_files
+        # Có file tải lỗi -> không lưu token để lần sau quét lại đầy đủ
+        manifest["page_token"] = start_token if not failed else None
+        self._save_manifest(manifest_path, manifest)
+        return unchanged + downloaded
+
+    @staticmethod
+    def _pass_through_unchanged(files, on_file_done):
+        """Đưa các file không đổi (đã có bản local) cho bên xử lý, không tải lại"""
+        local_paths = []
+        for file_id, entry in files.items():
+            local_paths.append(entry['local_path'])
+            if on_file_done:
+                on_file_done(dict(entry, id=file_id), entry['local_path'])
+        return local_paths
 
     # Giữ nguyên các method cũ cho compatibility
     def list_pdf_files(self, folder_input):
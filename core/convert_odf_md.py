@@ -1,139 +1,62 @@
-import requests 
 import base64 
 import os 
 import json 
 import time
 from config.credentials import Config
+from core.mathpix_client import MathpixClient
 # Load credentials từ environment
 
 
+_client = None
+
+
 def get_mathpix_credentials():
     return Config.MATHPIX_APP_KEY, Config.MATHPIX_APP_ID
 
-def send_pdf_to_mathpix(file_path):
-    """Gửi PDF đến Mathpix API để convert"""
-    try:
+def get_mathpix_client():
+    """MathpixClient dùng chung (1 session, giữ kết nối giữa các lần gọi)"""
+    global _client
+    if _client is None:
         app_key, app_id = get_mathpix_credentials()
-        
-        with open(file_path, "rb") as f:
-            print("📤 Đang gửi request đến Mathpix...")
+        _client = MathpixClient(app_key, app_id)
+    return _client
 
-            files = {
-                "file": (os.path.basename(file_path), f, "application/pdf")
-            }
-
-            response = requests.post(
-                "https://api.mathpix.com/v3/pdf",
-                headers={
-                    "app_id": app_id,
-                    "app_key": app_key
-                },
-                files=files,
-                # Specify conversion formats
-                data={
-                    "conversion_formats[md]": "true",  # Enable Markdown
-                }
-            )
-
-            if response.status_code == 200:
-                result = response.json()
-                print("✅ Gửi thành công!")
-                print(f"📋 PDF ID: {result.get('pdf_id', 'N/A')}")
-                return result
-            else:
-                print(f"❌ Lỗi API: {response.status_code} - {response.text}")
-                return None
-
-    except Exception as e:
-        print(f"❌ Lỗi: {e}")
+def send_pdf_to_mathpix(file_path):
+    """Gửi PDF đến Mathpix API để convert"""
+    print("📤 Đang gửi request đến Mathpix...")
+    pdf_id = get_mathpix_client().upload_pdf(file_path, formats=("md",))
+    if not pdf_id:
         return None
+    print("✅ Gửi thành công!")
+    print(f"📋 PDF ID: {pdf_id}")
+    return {"pdf_id": pdf_id}
 
 def check_conversion_status(pdf_id):
     """Kiểm tra trạng thái conversion"""
-    app_key, app_id = get_mathpix_credentials()
-    
-    headers = {
-        'app_key': app_key,
-        'app_id': app_id
-    }
-    
-    try:
-        url = f"https://api.mathpix.com/v3/pdf/{pdf_id}"
-        response = requests.get(url, headers=headers)
-        
-        if response.status_code == 200:
-            result = response.json()
-            status = result.get('status', 'unknown')
-            print(f"📋 Conversion status: {status}")
-            return result
-        else:
-            print(f"❌ Lỗi check status: {response.status_code}")
-            return None
-    except Exception as e:
-        print(f"❌ Lỗi check status: {e}")
-        return None
+    result = get_mathpix_client().get_status(pdf_id)
+    if result:
+        print(f"📋 Conversion status: {result.get('status', 'unknown')}")
+    return result
 
 def download_markdown(pdf_id, output_path):
     """Download file Markdown đã convert"""
-    app_key, app_id = get_mathpix_credentials()
-    
-    headers = {
-        'app_key': app_key, 
-        'app_id': app_id
-    }
-    
     print(f"📥 Đang download Markdown cho PDF ID: {pdf_id}")
-    
-    try:
-        # Mathpix API endpoint cho markdown
-        url = f"https://api.mathpix.com/v3/pdf/{pdf_id}.md"
-        response = requests.get(url, headers=headers, timeout=120)
-        
-        if response.status_code == 200:
-            # Tạo thư mục nếu chưa có
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-                
-            # Lưu content dạng text (UTF-8)
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(response.text)
-                print(f"✅ Downloaded Markdown: {output_path}")
-            return output_path
-        else:
-            print(f"❌ Lỗi download: {response.status_code} - {response.text}")
-            return None
-            
-    except Exception as e:
-        print(f"❌ Lỗi download: {str(e)}")
-        return None
+    downloaded = get_mathpix_client().download(pdf_id, "md", output_path)
+    if downloaded:
+        print(f"✅ Downloaded Markdown: {output_path}")
+    return downloaded
 
 def wait_for_conversion(pdf_id, max_wait_time=300):
     """Chờ conversion hoàn thành với timeout"""
     print(f"⏳ Chờ conversion hoàn thành (max {max_wait_time}s)...")
-    start_time = time.time()
-    
-    while time.time() - start_time < max_wait_time:
-        status_result = check_conversion_status(pdf_id)
-        
-        if not status_result:
-            print("❌ Không thể check status")
-            return False
-        
-        status = status_result.get('status', 'unknown')
-        
-        if status == 'completed':
-            print("✅ Conversion hoàn thành!")
-            return True
-        elif status == 'error':
-            error_msg = status_result.get('error', 'Unknown error')
-            print(f"❌ Conversion lỗi: {error_msg}")
-            return False
-        elif status == 'processing':
-            print("🔄 Đang xử lý...")
-        
-        # Đợi 10 giây trước khi check lại
-        time.sleep(10)
-    
-    print("⏰ Timeout! Conversion mất quá nhiều thời gian")
+
+    def on_status(status, elapsed):
+        if status == 'processing':
+            print(f"🔄 Đang xử lý... ({elapsed}s)")
+
+    if get_mathpix_client().wait_for_completion(pdf_id, max_wait_time, on_status=on_status):
+        print("✅ Conversion hoàn thành!")
+        return True
     return False
 
 def convert_pdf_to_markdown(pdf_path, output_path=None):
@@ -2,11 +2,24 @@ import pypdf
 from pypdf.generic import NullObject
 import subprocess
 import os
+import io
 from PyPDF2.generic import NullObject
 import re
+def open_pdf_reader(source):
+    """
+    Mở PdfReader từ đường dẫn, bytes (PDF đã nằm trong RAM) hoặc PdfReader có sẵn.
+    Dùng chung 1 reader cho nhiều lần cắt để không phải đọc/parse lại file nguồn.
+    """
+    if isinstance(source, pypdf.PdfReader):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return pypdf.PdfReader(io.BytesIO(source))
+    return pypdf.PdfReader(source)
+
 def cut_pdf_by_pages(input_path, output_path, start_page, end_page):
     """
     Cắt PDF với cơ chế xử lý lỗi Null Object và tương thích tiếng Trung.
+    input_path: đường dẫn PDF, bytes nội dung PDF hoặc PdfReader đã mở (xem open_pdf_reader).
     """
     # 1. Làm sạch tên file đầu ra
     directory = os.path.dirname(output_path)
@@ -16,43 +29,49 @@ def cut_pdf_by_pages(input_path, output_path, start_page, end_page):
     final_output_path = os.path.join(directory, safe_filename)
 
     try:
-        with open(input_path, 'rb') as input_file:
-            reader = pypdf.PdfReader(input_file)
-            writer = pypdf.PdfWriter()
-            
-            total_pages = len(reader.pages)
-            s_page = max(1, int(start_page))
-            e_page = min(total_pages, int(end_page))
-
-            for page_num in range(s_page - 1, e_page):
-                try:
-                    page = reader.pages[page_num]
-                    
-                    # Kiểm tra đối tượng trang
-                    if page is None or isinstance(page, NullObject):
-                        print(f"⚠️ Bỏ qua trang {page_num + 1}: Dữ liệu Null.")
-                        continue
-                    
-                    # Thêm trang vào writer
-                    writer.add_page(page)
-                    
-                except Exception as e:
-                    # Bắt lỗi "Null object" phát sinh bên trong add_page của pypdf
-                    print(f"⚠️ Lỗi tại trang {page_num + 1}: {e}. Đang bỏ qua...")
-                    continue
-
-            # 2. Ghi file nếu có trang hợp lệ
-            if len(writer.pages) > 0:
-                with open(final_output_path, 'wb') as output_file:
-                    writer.write(output_file)
-                return True
-            else:
-                print(f"❌ Không có trang nào hợp lệ cho file: {safe_filename}")
-                return False
+        if isinstance(input_path, (str, os.PathLike)):
+            with open(input_path, 'rb') as input_file:
+                reader = pypdf.PdfReader(input_file)
+                return _write_page_range(reader, final_output_path, safe_filename, start_page, end_page)
+        reader = open_pdf_reader(input_path)
+        return _write_page_range(reader, final_output_path, safe_filename, start_page, end_page)
 
     except Exception as e:
         print(f"❌ Lỗi nghiêm trọng khi đọc file PDF: {e}")
         return False
+
+def _write_page_range(reader, final_output_path, safe_filename, start_page, end_page):
+    writer = pypdf.PdfWriter()
+    
+    total_pages = len(reader.pages)
+    s_page = max(1, int(start_page))
+    e_page = min(total_pages, int(end_page))
+
+    for page_num in range(s_page - 1, e_page):
+        try:
+            page = reader.pages[page_num]
+            
+            # Kiểm tra đối tượng trang
+            if page is None or isinstance(page, NullObject):
+                print(f"⚠️ Bỏ qua trang {page_num + 1}: Dữ liệu Null.")
+                continue
+            
+            # Thêm trang vào writer
+            writer.add_page(page)
+            
+        except Exception as e:
+            # Bắt lỗi "Null object" phát sinh bên trong add_page của pypdf
+            print(f"⚠️ Lỗi tại trang {page_num + 1}: {e}. Đang bỏ qua...")
+            continue
+
+    # 2. Ghi file nếu có trang hợp lệ
+    if len(writer.pages) > 0:
+        with open(final_output_path, 'wb') as output_file:
+            writer.write(output_file)
+        return True
+    else:
+        print(f"❌ Không có trang nào hợp lệ cho file: {safe_filename}")
+        return False
 def compress_pdf_ghostscript(input_path, output_path, quality='ebook'):
     """
     Nén PDF bằng Ghostscript
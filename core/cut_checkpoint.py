@@ -0,0 +1,139 @@
+"""
+Checkpoint cho luồng cắt sách (LocalProcessor / AutoProcessor).
+Mỗi sách có file <book>.checkpoint.json cạnh <book>.json, lưu:
+- dấu vân tay PDF nguồn (size, mtime, sha256) và hash prompt
+- danh sách file bài đã cắt kèm size / mtime / sha256
+Lần chạy sau chỉ gửi AI + cắt lại những sách có PDF nguồn hoặc prompt thay đổi.
+"""
+import os
+import json
+import hashlib
+
+from core.hashing import file_sha256
+
+CHECKPOINT_VERSION = 1
+
+
+def _file_stat(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def fingerprint_file(path, previous=None):
+    """
+    Dấu vân tay của 1 file. Nếu size + mtime trùng bản ghi cũ thì dùng lại sha256 cũ
+    (không phải đọc lại file), ngược lại mới hash.
+    """
+    info = _file_stat(path)
+    if previous and previous.get("size") == info["size"] and previous.get("mtime_ns") == info["mtime_ns"] and previous.get("sha256"):
+        info["sha256"] = previous["sha256"]
+    else:
+        info["sha256"] = file_sha256(path)
+    return info
+
+
+def fingerprint_bytes(data):
+    """Dấu vân tay của PDF nằm trong RAM (không có mtime, so sánh bằng sha256)"""
+    return {"size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+
+
+def checkpoint_path(output_folder, book_name):
+    return os.path.join(output_folder, f"{book_name}.checkpoint.json")
+
+
+def load_checkpoint(output_folder, book_name):
+    path = checkpoint_path(output_folder, book_name)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != CHECKPOINT_VERSION:
+            return None
+        return data
+    except Exception as e:
+        print(f"⚠️ Checkpoint hỏng, bỏ qua: {path} ({e})")
+        return None
+
+
+def save_checkpoint(output_folder, book_name, source_fp, prompt_sha, json_data, generated_files, previous=None):
+    """Ghi checkpoint sau khi cắt xong (chỉ ghi nhận các file bài thực sự tồn tại)"""
+    previous_outputs = (previous or {}).get("outputs", {})
+    outputs = {}
+    for path in generated_files:
+        if not os.path.exists(path):
+            continue
+        file_name = os.path.basename(path)
+        outputs[file_name] = fingerprint_file(path, previous_outputs.get(file_name))
+
+    data = {
+        "version": CHECKPOINT_VERSION,
+        "source": source_fp,
+        "prompt_sha": prompt_sha,
+        "lesson_count": len(json_data),
+        "outputs": outputs,
+    }
+    path = checkpoint_path(output_folder, book_name)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    return data
+
+
+def verify_output(output_path, record):
+    """File bài còn nguyên: đúng size, và đúng sha256 nếu mtime đã đổi"""
+    if not record or not os.path.exists(output_path):
+        return False
+    info = _file_stat(output_path)
+    if info["size"] != record.get("size"):
+        return False
+    if info["mtime_ns"] == record.get("mtime_ns"):
+        return True
+    return file_sha256(output_path) == record.get("sha256")
+
+
+def plan_book(pdf_path, output_folder, book_name, prompt_sha, pdf_bytes=None):
+    """
+    Quyết định cách xử lý 1 sách ở chế độ incremental.
+    pdf_bytes: nội dung PDF trong RAM (khi không có file nguồn trên đĩa).
+    Trả về dict:
+      action: "full" (gửi AI + cắt lại), "recut" (dùng JSON cũ, cắt lại bài thiếu/hỏng), "skip"
+      source_fp, checkpoint, json_data, valid_files, outputs_record
+    """
+    checkpoint = load_checkpoint(output_folder, book_name)
+    if pdf_bytes is not None:
+        source_fp = fingerprint_bytes(pdf_bytes)
+    else:
+        source_fp = fingerprint_file(pdf_path, (checkpoint or {}).get("source"))
+    plan = {"action": "full", "source_fp": source_fp, "checkpoint": checkpoint,
+            "json_data": None, "valid_files": []}
+
+    json_path = os.path.join(output_folder, f"{book_name}.json")
+    if not checkpoint or not os.path.exists(json_path):
+        return plan
+    if checkpoint.get("source", {}).get("sha256") != source_fp["sha256"] or checkpoint.get("prompt_sha") != prompt_sha:
+        return plan
+
+    try:
+        with open(json_path, "r", encoding="utf-8") as f:
+            json_data = json.load(f)
+    except Exception:
+        return plan
+    if not isinstance(json_data, list) or len(json_data) != checkpoint.get("lesson_count"):
+        return plan
+
+    outputs = checkpoint.get("outputs", {})
+    valid_files = []
+    for file_name, record in outputs.items():
+        output_path = os.path.join(output_folder, file_name)
+        if verify_output(output_path, record):
+            valid_files.append(output_path)
+
+    plan["json_data"] = json_data
+    plan["valid_files"] = valid_files
+    # So với số bài trong JSON (không phải số file đã ghi nhận): bài cắt lỗi lần trước
+    # không có trong outputs nên vẫn phải được cắt lại
+    all_cut = outputs and len(valid_files) == len(outputs) and len(valid_files) >= len(json_data)
+    plan["action"] = "skip" if all_cut else "recut"
+    return plan
@@ -0,0 +1,17 @@
+"""
+Hàm hash dùng chung (checkpoint cắt sách, cache Mathpix, run journal GenQues)
+"""
+import hashlib
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Hash SHA-256 của file (đọc theo chunk để không tốn RAM)"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def text_sha256(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
@@ -0,0 +1,93 @@
+"""
+Cache kết quả Mathpix theo nội dung PDF.
+Index JSON: sha256 file PDF -> pdf_id đã upload, các format đã yêu cầu, file output đã tải.
+- Cùng PDF, cùng format, output còn nguyên -> bỏ qua hoàn toàn
+- Cùng PDF, format khác -> dùng lại pdf_id, không upload lại (không tốn phí Mathpix lần 2)
+"""
+import os
+import json
+import time
+import threading
+
+from core.hashing import file_sha256
+
+CACHE_FILE_NAME = "mathpix_cache.json"
+
+
+class MathpixCache:
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except Exception as e:
+            print(f"⚠️ Cache Mathpix hỏng, tạo mới: {e}")
+            return {}
+
+    def _save(self):
+        """Ghi index (gọi khi đang giữ lock)"""
+        os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def hash_file(path):
+        return file_sha256(path)
+
+    def lookup(self, file_hash):
+        with self._lock:
+            entry = self._entries.get(file_hash)
+            return dict(entry) if entry else None
+
+    def output_for(self, file_hash, fmt, expected_path=None):
+        """Đường dẫn output đã tải cho format nếu file còn nguyên (đúng size), ngược lại None"""
+        with self._lock:
+            record = (self._entries.get(file_hash) or {}).get("outputs", {}).get(fmt)
+        if not record:
+            return None
+        path = record.get("path")
+        if expected_path and os.path.normcase(os.path.abspath(path)) != os.path.normcase(os.path.abspath(expected_path)):
+            return None
+        if not path or not os.path.exists(path) or os.path.getsize(path) != record.get("size"):
+            return None
+        return path
+
+    def record_upload(self, file_hash, pdf_id, formats, source_name=None):
+        with self._lock:
+            entry = self._entries.setdefault(file_hash, {"outputs": {}})
+            entry["pdf_id"] = pdf_id
+            entry["formats"] = sorted(set(formats))
+            entry["source_name"] = source_name
+            entry["uploaded_ts"] = time.time()
+            # pdf_id mới -> output cũ không còn gắn với job này
+            entry["outputs"] = {}
+            self._save()
+
+    def record_output(self, file_hash, fmt, output_path):
+        with self._lock:
+            entry = self._entries.get(file_hash)
+            if not entry:
+                return
+            entry.setdefault("outputs", {})[fmt] = {
+                "path": output_path,
+                "size": os.path.getsize(output_path),
+                "ts": time.time(),
+            }
+            if fmt not in entry.get("formats", []):
+                entry["formats"] = sorted(set(entry.get("formats", [])) | {fmt})
+            self._save()
+
+    def forget(self, file_hash):
+        """Bỏ bản ghi (pdf_id hết hạn / bị xóa phía Mathpix)"""
+        with self._lock:
+            if self._entries.pop(file_hash, None) is not None:
+                self._save()
@@ -0,0 +1,96 @@
+"""
+Chia PDF lớn thành các đoạn trang để gửi Mathpix song song (mỗi đoạn xử lý nhanh, lỗi thì
+chỉ gửi lại đoạn đó), rồi ghép kết quả Markdown / DOCX / PDF theo đúng thứ tự trang.
+"""
+import os
+
+import pypdf
+
+from core.cutPDF import cut_pdf_by_pages, open_pdf_reader
+
+CHUNK_DIR_NAME = ".mathpix_chunks"
+
+
+def plan_page_ranges(total_pages, pages_per_chunk):
+    """[(1, 50), (51, 100), ...] - trang đánh số từ 1, có cả trang cuối"""
+    return [(start, min(start + pages_per_chunk - 1, total_pages))
+            for start in range(1, total_pages + 1, pages_per_chunk)]
+
+
+def split_pdf(pdf_path, work_dir, pages_per_chunk):
+    """
+    Cắt PDF thành các đoạn pages_per_chunk trang trong work_dir (đọc file nguồn 1 lần).
+    Đoạn đã cắt từ lần chạy trước được dùng lại.
+    Returns: list đường dẫn đoạn theo thứ tự, hoặc None nếu file không cần chia
+    """
+    reader = open_pdf_reader(pdf_path)
+    total_pages = len(reader.pages)
+    if pages_per_chunk <= 0 or total_pages <= pages_per_chunk:
+        return None
+
+    os.makedirs(work_dir, exist_ok=True)
+    base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    chunks = []
+    for start, end in plan_page_ranges(total_pages, pages_per_chunk):
+        chunk_path = os.path.join(work_dir, f"{base_name}_p{start:04d}-{end:04d}.pdf")
+        if not os.path.exists(chunk_path):
+            part_path = chunk_path + ".part"
+            if not cut_pdf_by_pages(reader, part_path, start, end):
+                raise ValueError(f"Không cắt được trang {start}-{end} của {os.path.basename(pdf_path)}")
+            os.replace(part_path, chunk_path)
+        chunks.append(chunk_path)
+    print(f"✂️ Chia {os.path.basename(pdf_path)} ({total_pages} trang) thành {len(chunks)} đoạn")
+    return chunks
+
+
+# ============================================================
+# GHÉP KẾT QUẢ
+# ============================================================
+def _stitch_markdown(parts, output_path):
+    with open(output_path, "w", encoding="utf-8") as out:
+        for idx, part in enumerate(parts):
+            with open(part, "r", encoding="utf-8") as f:
+                content = f.read().strip("\n")
+            if idx:
+                out.write("\n\n")
+            out.write(content)
+        out.write("\n")
+
+
+def _stitch_docx(parts, output_path):
+    from docx import Document
+    from docxcompose.composer import Composer
+
+    composer = Composer(Document(parts[0]))
+    for part in parts[1:]:
+        composer.append(Document(part))
+    composer.save(output_path)
+
+
+def _stitch_pdf(parts, output_path):
+    writer = pypdf.PdfWriter()
+    for part in parts:
+        writer.append(part)
+    with open(output_path, "wb") as f:
+        writer.write(f)
+
+
+STITCHERS = {
+    "md": _stitch_markdown,
+    "docx": _stitch_docx,
+    "pdf": _stitch_pdf,
+}
+
+
+def stitch_outputs(fmt, parts, output_path):
+    """Ghép kết quả các đoạn (đúng thứ tự) thành 1 file output, ghi qua file tạm"""
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    part_path = output_path + ".part"
+    try:
+        STITCHERS[fmt](parts, part_path)
+        os.replace(part_path, output_path)
+        return output_path
+    except Exception:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
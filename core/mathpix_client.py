@@ -0,0 +1,175 @@
+"""
+Client Mathpix PDF API dùng chung cho chạy headless (core/convert_odf_md.py)
+và GUI (ConversionThread trong ui/convert_pdf_widget.py).
+- 1 requests.Session với connection pool: poll status / tải file không phải bắt tay TLS lại
+- Tự retry (backoff) khi lỗi mạng hoặc 429 / 5xx
+- Tải kết quả dạng stream xuống file .part rồi đổi tên (không giữ cả file trong RAM)
+"""
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+MATHPIX_PDF_URL = "https://api.mathpix.com/v3/pdf"
+
+# Timeout (giây)
+UPLOAD_TIMEOUT = 120
+STATUS_TIMEOUT = 30
+DOWNLOAD_TIMEOUT = 120
+
+# Retry / pool
+DEFAULT_POOL_SIZE = 16
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 1.0
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Poll status
+POLL_INITIAL_INTERVAL = 2
+POLL_BACKOFF_FACTOR = 1.5
+POLL_MAX_INTERVAL = 30
+DEFAULT_MAX_WAIT_TIME = 300
+
+# Format luôn gửi cờ true/false rõ ràng khi upload (các format khác chỉ gửi khi được chọn)
+EXPLICIT_FORMATS = ("md", "docx")
+
+
+class MathpixClient:
+    def __init__(self, app_key, app_id, pool_size=DEFAULT_POOL_SIZE,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR):
+        self.session = requests.Session()
+        self.session.headers.update({"app_key": app_key, "app_id": app_id})
+        # POST upload không nằm trong allowed_methods: chỉ retry khi chưa kết nối được,
+        # tránh upload (và tính phí) 2 lần khi server đã nhận file
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset({"GET"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ============================================================
+    # UPLOAD / STATUS
+    # ============================================================
+    def upload_pdf(self, file_path, formats=("md",), options=None):
+        """
+        Upload PDF, bật conversion_formats cho các format cần lấy.
+        Returns: pdf_id hoặc None nếu lỗi
+        """
+        data = {}
+        for fmt in EXPLICIT_FORMATS:
+            data[f"conversion_formats[{fmt}]"] = "true" if fmt in formats else "false"
+        for fmt in formats:
+            if fmt not in EXPLICIT_FORMATS:
+                data[f"conversion_formats[{fmt}]"] = "true"
+        if options:
+            data.update(options)
+
+        try:
+            with open(file_path, "rb") as f:
+                files = {"file": (os.path.basename(file_path), f, "application/pdf")}
+                response = self.session.post(MATHPIX_PDF_URL, files=files, data=data, timeout=UPLOAD_TIMEOUT)
+            if response.status_code == 200:
+                return response.json().get("pdf_id")
+            print(f"❌ API Error: {response.status_code} - {response.text}")
+            return None
+        except Exception as e:
+            print(f"❌ Upload error: {e}")
+            return None
+
+    def get_status(self, pdf_id):
+        """Trạng thái job (dict từ Mathpix) hoặc None nếu không check được"""
+        try:
+            response = self.session.get(f"{MATHPIX_PDF_URL}/{pdf_id}", timeout=STATUS_TIMEOUT)
+            if response.status_code == 200:
+                return response.json()
+            print(f"❌ Status check error: {response.status_code}")
+            return None
+        except Exception as e:
+            print(f"❌ Status check error: {e}")
+            return None
+
+    def wait_for_completion(self, pdf_id, max_wait_time=DEFAULT_MAX_WAIT_TIME, should_stop=None, on_status=None):
+        """
+        Chờ job xong, check với khoảng giãn dần (2s, x1.5, tối đa 30s).
+        on_status(status, elapsed): gọi sau mỗi lần check. Returns: True nếu completed
+        """
+        start_time = time.time()
+        interval = POLL_INITIAL_INTERVAL
+        while time.time() - start_time < max_wait_time:
+            if should_stop and should_stop():
+                return False
+            status_result = self.get_status(pdf_id)
+            status = status_result.get("status", "unknown") if status_result else None
+            if on_status:
+                on_status(status, int(time.time() - start_time))
+            if status == "completed":
+                return True
+            if status == "error":
+                print(f"❌ Conversion lỗi: {status_result.get('error', 'Unknown error')}")
+                return False
+            time.sleep(interval)
+            interval = min(interval * POLL_BACKOFF_FACTOR, POLL_MAX_INTERVAL)
+        print("⏰ Timeout! Conversion mất quá nhiều thời gian")
+        return False
+
+    # ============================================================
+    # DOWNLOAD
+    # ============================================================
+    def download(self, pdf_id, fmt, output_path, on_bytes=None):
+        """
+        Tải kết quả 1 format (md / docx / pdf...) dạng stream xuống output_path.
+        Returns: output_path hoặc None nếu lỗi
+        """
+        part_path = output_path + ".part"
+        try:
+            with self.session.get(f"{MATHPIX_PDF_URL}/{pdf_id}.{fmt}", stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                if response.status_code != 200:
+                    print(f"❌ Download error: {response.status_code}")
+                    return None
+                os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+                with open(part_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        if chunk:
+                            f.write(chunk)
+                            if on_bytes:
+                                on_bytes(len(chunk))
+            os.replace(part_path, output_path)
+            return output_path
+        except Exception as e:
+            print(f"❌ Download error: {e}")
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return None
+
+    def convert(self, pdf_path, output_paths, max_wait_time=DEFAULT_MAX_WAIT_TIME):
+        """
+        Chạy trọn 1 file (headless): upload -> chờ -> tải mọi format.
+        output_paths: {format: đường dẫn output}. Returns: {format: đường dẫn đã tải}
+        """
+        pdf_id = self.upload_pdf(pdf_path, tuple(output_paths))
+        if not pdf_id:
+            return {}
+        print(f"📋 PDF ID: {pdf_id}")
+        if not self.wait_for_completion(pdf_id, max_wait_time):
+            return {}
+        results = {}
+        for fmt, output_path in output_paths.items():
+            downloaded = self.download(pdf_id, fmt, output_path)
+            if downloaded:
+                results[fmt] = downloaded
+        return results
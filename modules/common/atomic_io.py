@@ -0,0 +1,55 @@
+"""
+Ghi file kết quả an toàn khi nhiều luồng cùng lưu:
+- Khóa theo từng đường dẫn: 2 luồng chỉ chờ nhau khi ghi đúng cùng 1 file
+- Ghi ra file tạm cùng thư mục rồi os.replace: file đích không bao giờ bị ghi dở
+"""
+import os
+import time
+import tempfile
+import threading
+from contextlib import contextmanager
+
+_path_locks = {}
+_registry_lock = threading.Lock()
+
+
+def _lock_for(path):
+    key = os.path.normcase(os.path.abspath(path))
+    with _registry_lock:
+        lock = _path_locks.get(key)
+        if lock is None:
+            lock = _path_locks[key] = threading.RLock()
+        return lock
+
+
+@contextmanager
+def path_lock(path):
+    """Khóa riêng cho 1 đường dẫn (các file khác không bị chặn)"""
+    with _lock_for(path):
+        yield
+
+
+def atomic_write_bytes(path, data, max_retries=3, retry_delay=0.5):
+    """
+    Ghi data vào path: ghi file tạm (không cần khóa, tên tạm là duy nhất) rồi os.replace
+    trong khóa của path. Retry khi file đích đang bị chương trình khác giữ (Word trên Windows).
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        with path_lock(path):
+            for attempt in range(max_retries):
+                try:
+                    os.replace(tmp_path, path)
+                    return path
+                except PermissionError:
+                    if attempt == max_retries - 1:
+                        raise
+                    print(f"⚠️ File đang bị khóa, thử lại lần {attempt + 2}: {os.path.basename(path)}")
+                    time.sleep(retry_delay)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
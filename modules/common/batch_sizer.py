@@ -0,0 +1,141 @@
+"""
+Chia batch câu hỏi theo số token đầu ra thực đo (usage_metadata) thay vì cố định 10 câu / 1 request:
+- Học token/câu (trung bình trượt EMA) theo từng (loại đề, chế độ ngôn ngữ, model)
+- Mỗi batch lấy đủ số câu để tổng token dự kiến nằm dưới max_output_tokens * SAFETY_RATIO
+- Request bị cắt (finish_reason MAX_TOKENS) -> tăng ngay token/câu ước lượng để batch sau nhỏ hơn
+Số liệu lưu ở output/.batch_stats.json để lần chạy sau dùng luôn.
+"""
+import os
+import threading
+
+from modules.common import fast_json
+from modules.common.atomic_io import atomic_write_bytes
+
+OUTPUT_TOKEN_LIMIT = 65534
+SAFETY_RATIO = 0.6        # Chỉ dùng 60% giới hạn đầu ra (độ dài từng câu dao động, còn token "thinking")
+EMA_ALPHA = 0.3           # Trọng số của lần đo mới
+TRUNCATED_ALPHA = 0.6     # Bị cắt -> tin số đo mới nhiều hơn
+TRUNCATED_BACKOFF = 1.25  # Bị cắt -> token/câu tăng ít nhất 25% (batch sau chắc chắn nhỏ hơn)
+MIN_BATCH_SIZE = 3
+MAX_BATCH_SIZE = 40
+STATS_FILE_NAME = ".batch_stats.json"
+
+LANG_VI = "vi"
+LANG_BILINGUAL = "vi_en"
+
+# Ước lượng ban đầu (token/câu) khi chưa có số đo nào
+DEFAULT_TOKENS_PER_QUESTION = {
+    ("trac_nghiem_4_dap_an", LANG_VI): 700,
+    ("trac_nghiem_4_dap_an", LANG_BILINGUAL): 1400,
+    ("dung_sai", LANG_VI): 2200,
+    ("dung_sai", LANG_BILINGUAL): 4400,
+    ("tra_loi_ngan", LANG_VI): 600,
+    ("tra_loi_ngan", LANG_BILINGUAL): 1200,
+    ("tu_luan", LANG_VI): 1300,
+    ("tu_luan", LANG_BILINGUAL): 2600,
+}
+FALLBACK_TOKENS_PER_QUESTION = 1500
+
+# Dựa vào header của prompt, không dựa vào tên trường: prompt Tiếng Việt vẫn có mo_ta_en / noi_dung_en
+_VI_ONLY_MARKERS = ("CHỈ CÓ TIẾNG VIỆT", "TIẾNG VIỆT ONLY")
+_BILINGUAL_MARKER = "SONG NGỮ"
+
+
+def detect_language_mode(prompt):
+    """Prompt yêu cầu song ngữ (có bản Tiếng Anh) hay chỉ Tiếng Việt"""
+    prompt = prompt or ""
+    if any(marker in prompt for marker in _VI_ONLY_MARKERS):
+        return LANG_VI
+    return LANG_BILINGUAL if _BILINGUAL_MARKER in prompt else LANG_VI
+
+
+class BatchSizer:
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stats = None
+
+    def _load(self):
+        if self._stats is None:
+            self._stats = {}
+            if self.path and os.path.exists(self.path):
+                try:
+                    self._stats = fast_json.load_file(self.path)
+                except (OSError, ValueError):
+                    self._stats = {}  # File hỏng -> học lại từ đầu
+        return self._stats
+
+    def _save(self):
+        if self.path:
+            try:
+                atomic_write_bytes(self.path, fast_json.dumps_bytes(self._stats))
+            except OSError as e:
+                print(f"⚠️ Không lưu được thống kê batch: {e}")
+
+    @staticmethod
+    def _key(question_type, language_mode, model_name):
+        return f"{question_type}|{language_mode}|{model_name}"
+
+    def tokens_per_question(self, question_type, language_mode, model_name):
+        with self._lock:
+            entry = self._load().get(self._key(question_type, language_mode, model_name))
+        if entry:
+            return entry["tokens_per_question"]
+        return DEFAULT_TOKENS_PER_QUESTION.get((question_type, language_mode), FALLBACK_TOKENS_PER_QUESTION)
+
+    def batch_size(self, question_type, language_mode, model_name, max_output_tokens=OUTPUT_TOKEN_LIMIT):
+        per_question = self.tokens_per_question(question_type, language_mode, model_name)
+        size = int(max_output_tokens * SAFETY_RATIO // max(per_question, 1))
+        return max(MIN_BATCH_SIZE, min(MAX_BATCH_SIZE, size))
+
+    def plan_batches(self, total_questions, question_type, language_mode, model_name,
+                     max_output_tokens=OUTPUT_TOKEN_LIMIT):
+        """[(stt đầu, stt cuối)] phủ 1..total_questions, các batch dài gần bằng nhau"""
+        size = self.batch_size(question_type, language_mode, model_name, max_output_tokens)
+        batch_count = -(-total_questions // size)
+        base, extra = divmod(total_questions, batch_count) if batch_count else (0, 0)
+        ranges = []
+        start = 1
+        for idx in range(batch_count):
+            end = start + base + (1 if idx < extra else 0) - 1
+            ranges.append((start, end))
+            start = end + 1
+        return ranges
+
+    def record(self, question_type, language_mode, model_name, usage, question_count):
+        """
+        Ghi nhận 1 request: usage là dict từ send_data_to_AI(return_usage=True),
+        question_count là số câu hợp lệ nhận được.
+        """
+        output_tokens = (usage or {}).get("output_tokens")
+        if not output_tokens or question_count <= 0:
+            return
+        measured = output_tokens / question_count
+        truncated = usage.get("truncated")
+        alpha = TRUNCATED_ALPHA if truncated else EMA_ALPHA
+        key = self._key(question_type, language_mode, model_name)
+        with self._lock:
+            stats = self._load()
+            entry = stats.get(key)
+            previous = entry["tokens_per_question"] if entry else None
+            value = measured if previous is None else (1 - alpha) * previous + alpha * measured
+            if truncated:
+                value = max(value, (previous or measured) * TRUNCATED_BACKOFF)
+            if entry:
+                entry["tokens_per_question"] = round(value, 1)
+                entry["samples"] += 1
+            else:
+                stats[key] = {"tokens_per_question": round(value, 1), "samples": 1}
+            self._save()
+
+
+_sizers = {}
+_sizers_lock = threading.Lock()
+
+
+def get_batch_sizer(app_path):
+    path = os.path.join(app_path, "output", STATS_FILE_NAME)
+    with _sizers_lock:
+        if path not in _sizers:
+            _sizers[path] = BatchSizer(path)
+        return _sizers[path]
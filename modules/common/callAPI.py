@@ -1,9 +1,15 @@
 import os
 import sys
+import asyncio
+import threading
+import concurrent.futures
 from dotenv import load_dotenv
 from google.oauth2 import service_account
 from google import genai
 from google.genai import types
+
+from modules.common import pdf_text_layer
+from modules.common.concurrency import is_quota_error
 # --- LOGIC TÌM ENV ĐA NĂNG ---
 # 1. Xác định vị trí file này (modules/common)
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -57,81 +63,175 @@ def get_vertex_ai_credentials():
         return None
 
 # ============================================================
-# 3. CLASS VERTEX CLIENT (CHO TEXT GENERATION)
+# 3. HÀM DÙNG CHUNG: DỰNG NỘI DUNG & CẤU HÌNH REQUEST
+# ============================================================
+def _build_pdf_parts(file_path, text_layer_plans=None, use_text_layer=False):
+    """
+    Part cho 1 file PDF: nguyên file, hoặc (use_text_layer) text layer + PDF con các trang hình,
+    xem modules/common/pdf_text_layer.py
+    """
+    if use_text_layer:
+        plan = pdf_text_layer.analyze_pdf(file_path)
+        if text_layer_plans is not None:
+            text_layer_plans.append(plan)
+        if plan.use_text:
+            parts = [types.Part.from_text(
+                text=f"--- NỘI DUNG TÀI LIỆU (TEXT TỪ PDF {plan.file_name}): ---\n{plan.text}\n--- HẾT TÀI LIỆU ---")]
+            if plan.pdf_subset:
+                parts.append(types.Part.from_text(text=pdf_text_layer.describe_visual_pages(plan)))
+                parts.append(types.Part.from_bytes(data=plan.pdf_subset, mime_type="application/pdf"))
+            print(f"📑 Đã load text layer: {plan.file_name} "
+                  f"({plan.page_count - len(plan.visual_pages)}/{plan.page_count} trang dạng text)")
+            return parts
+
+    with open(file_path, "rb") as f:
+        pdf_bytes = f.read()
+    print(f"📄 Đã load PDF: {os.path.basename(file_path)}")
+    return [types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf")]
+
+
+def _record_text_layer_usage(response, text_layer_plans, report):
+    """
+    Ghi các PDF đã gửi + số prompt token thực tế vào báo cáo text layer của lần chạy
+    (chỉ request sinh nội dung có PDF; tài liệu đưa vào context cache không tính)
+    """
+    if not text_layer_plans or report is None:
+        return
+    for plan in text_layer_plans:
+        report.record_plan(plan)
+    usage = getattr(response, "usage_metadata", None)
+    report.record_usage(getattr(usage, "prompt_token_count", None) if usage else None)
+
+
+def _build_file_contents(file_paths, text_layer_plans=None, use_text_layer=False):
+    """
+    Đọc file (.md / .pdf) và dựng danh sách Content tài liệu (chưa có prompt).
+    text_layer_plans: list (tùy chọn) nhận các TextLayerPlan đã dùng để ghi báo cáo token.
+    use_text_layer: PDF có text layer tốt được gửi dạng text thay cho cả file.
+    """
+    contents = []
+
+    if file_paths:
+        if isinstance(file_paths, str):
+            file_paths = [file_paths]
+            
+        for file_path in file_paths:
+            try:
+                # --- PHẦN THÊM MỚI: Xử lý file Markdown ---
+                if file_path.lower().endswith('.md'):
+                    with open(file_path, "r", encoding="utf-8") as f:
+                        md_text = f.read()
+                    # Đưa nội dung Markdown vào như một phần của ngữ cảnh văn bản
+                    md_part = types.Part.from_text(text=f"--- NỘI DUNG TÀI LIỆU (.MD): ---\n{md_text}\n--- HẾT TÀI LIỆU ---")
+                    contents.append(types.Content(role="user", parts=[md_part]))
+                    print(f"📝 Đã load nội dung Markdown: {os.path.basename(file_path)}")
+                
+                # --- PHẦN CŨ: Xử lý file PDF ---
+                elif file_path.lower().endswith('.pdf'):
+                    pdf_parts = _build_pdf_parts(file_path, text_layer_plans, use_text_layer)
+                    contents.append(types.Content(role="user", parts=pdf_parts))
+            except Exception as e:
+                print(f"❌ Lỗi đọc file {file_path}: {e}")
+                raise e
+    return contents
+
+
+def _build_contents(prompt, file_paths=None, text_layer_plans=None, use_text_layer=False):
+    """Content gửi lên Gemini: tài liệu (nếu có) trước, prompt luôn ở cuối"""
+    contents = _build_file_contents(file_paths, text_layer_plans, use_text_layer)
+    text_part = types.Part.from_text(text=prompt)
+    contents.append(types.Content(role="user", parts=[text_part]))
+    return contents
+
+
+def _build_generate_config(temperature, top_p, response_schema, max_output_tokens, cached_content=None):
+    config_args = {
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_output_tokens": max_output_tokens
+    }
+
+    # Tài liệu đã nằm trong context cache -> request chỉ mang prompt
+    if cached_content:
+        config_args["cached_content"] = cached_content
+
+    # Nếu có schema, ép kiểu về JSON
+    if response_schema:
+        config_args["response_mime_type"] = "application/json"
+        config_args["response_schema"] = response_schema
+
+    return types.GenerateContentConfig(**config_args)
+
+
+def _extract_response_text(response):
+    if response.text:
+        return response.text
+    return "⚠️ API trả về rỗng (Có thể do Safety Filter chặn)."
+
+
+def _extract_usage(response):
+    """Số token thực đo của 1 response (token "thinking" cũng tính vào max_output_tokens)"""
+    usage = getattr(response, "usage_metadata", None)
+    output_tokens = None
+    if usage is not None and getattr(usage, "candidates_token_count", None) is not None:
+        output_tokens = usage.candidates_token_count + (getattr(usage, "thoughts_token_count", None) or 0)
+    candidates = getattr(response, "candidates", None) or []
+    finish_reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+    return {
+        "prompt_tokens": getattr(usage, "prompt_token_count", None) if usage is not None else None,
+        "output_tokens": output_tokens,
+        "truncated": "MAX_TOKENS" in str(finish_reason),
+    }
+
+
+def _create_genai_client(project_id, creds, region):
+    # Khởi tạo Client theo chuẩn mới
+    return genai.Client(
+        vertexai=True,
+        project=project_id,
+        location=region,
+        credentials=creds
+    )
+
+# ============================================================
+# 4. CLASS VERTEX CLIENT (CHO TEXT GENERATION)
 # ============================================================
 
 class VertexClient:
-    def __init__(self, project_id, creds, model_name, region="global"):
+    def __init__(self, project_id, creds, model_name, region="global", use_text_layer=False, quota_counter=None,
+                 text_layer_report=None):
         """
         Khởi tạo Client sử dụng google.genai SDK mới
+        use_text_layer: PDF có text layer tốt được gửi dạng text (+ PDF con chỉ gồm trang hình)
+        quota_counter: QuotaErrorCounter của lần chạy (mặc định: của thread tạo client, xem set_current_quota_counter)
+        text_layer_report: TextLayerReport của lần chạy (mặc định: của thread tạo client)
         """
         self.model_name = model_name
+        self.use_text_layer = use_text_layer
+        self.quota_counter = quota_counter if quota_counter is not None else get_current_quota_counter()
+        self.text_layer_report = text_layer_report if text_layer_report is not None else get_current_text_layer_report()
+        self.client = None
         if not creds:
             print("❌ Lỗi: Credentials bị None.")
             return
 
         try:
-            # Khởi tạo Client theo chuẩn mới
-            self.client = genai.Client(
-                vertexai=True,
-                project=project_id,
-                location=region,
-                credentials=creds
-            )
+            self.client = _create_genai_client(project_id, creds, region)
             print(f"✅ Init GenAI Client thành công với model: {self.model_name}")
         except Exception as e:
             print(f"Lỗi init GenAI Client: {e}")
             self.client = None
 
-    def send_data_to_AI(self, prompt, file_paths=None, temperature=0.2, top_p=0.8, response_schema=None, max_output_tokens=65535):
+    def send_data_to_AI(self, prompt, file_paths=None, temperature=0.2, top_p=0.8, response_schema=None, max_output_tokens=65535,
+                        return_usage=False):
+        """return_usage=True: trả về (text, usage) với usage từ _extract_usage"""
         if not self.client:
-            return "❌ Lỗi: Client chưa được khởi tạo."
-
-        contents = []
-
-        if file_paths:
-            if isinstance(file_paths, str):
-                file_paths = [file_paths]
-                
-            for file_path in file_paths:
-                try:
-                    # --- PHẦN THÊM MỚI: Xử lý file Markdown ---
-                    if file_path.lower().endswith('.md'):
-                        with open(file_path, "r", encoding="utf-8") as f:
-                            md_text = f.read()
-                        # Đưa nội dung Markdown vào như một phần của ngữ cảnh văn bản
-                        md_part = types.Part.from_text(text=f"--- NỘI DUNG TÀI LIỆU (.MD): ---\n{md_text}\n--- HẾT TÀI LIỆU ---")
-                        contents.append(types.Content(role="user", parts=[md_part]))
-                        print(f"📝 Đã load nội dung Markdown: {os.path.basename(file_path)}")
-                    
-                    # --- PHẦN CŨ: Xử lý file PDF ---
-                    elif file_path.lower().endswith('.pdf'):
-                        with open(file_path, "rb") as f:
-                            pdf_bytes = f.read()
-                        pdf_part = types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf")
-                        contents.append(types.Content(role="user", parts=[pdf_part]))
-                        print(f"📄 Đã load PDF: {os.path.basename(file_path)}")
-                except Exception as e:
-                    print(f"❌ Lỗi đọc file {file_path}: {e}")
-                    raise e
-
-        # Các phần còn lại giữ nguyên...
-        text_part = types.Part.from_text(text=prompt)
-        contents.append(types.Content(role="user", parts=[text_part]))
-
-        # 3. Cấu hình sinh nội dung
-        config_args = {
-            "temperature": temperature,
-            "top_p": top_p,
-            "max_output_tokens": max_output_tokens
-        }
-
-        # Nếu có schema, ép kiểu về JSON
-        if response_schema:
-            config_args["response_mime_type"] = "application/json"
-            config_args["response_schema"] = response_schema
+            message = "❌ Lỗi: Client chưa được khởi tạo."
+            return (message, {}) if return_usage else message
 
-        generate_config = types.GenerateContentConfig(**config_args)    
+        text_layer_plans = []
+        contents = _build_contents(prompt, file_paths, text_layer_plans, self.use_text_layer)
+        generate_config = _build_generate_config(temperature, top_p, response_schema, max_output_tokens)
 
         try:
             # Gọi API
@@ -140,13 +240,227 @@ class VertexClient:
                 contents=contents,
                 config=generate_config
             )
-            
-            # Trả về text
-            if response.text:
-                return response.text
-            else:
-                return "⚠️ API trả về rỗng (Có thể do Safety Filter chặn)."
+            _record_text_layer_usage(response, text_layer_plans, self.text_layer_report)
+            if return_usage:
+                return _extract_response_text(response), _extract_usage(response)
+            return _extract_response_text(response)
                 
         except Exception as e:
             print(f"❌ Lỗi khi gọi AI generate_content: {e}")
-            raise e
\ No newline at end of file
+            if self.quota_counter is not None and is_quota_error(e):
+                self.quota_counter.record()
+            raise e
+
+# ============================================================
+# 5. CLASS ASYNC VERTEX CLIENT + EVENT LOOP RUNNER
+# ============================================================
+# Mỗi request đang chờ chỉ tốn 1 coroutine thay vì 1 OS thread,
+# nên có thể giữ hàng trăm request song song (giới hạn bởi semaphore của runner).
+
+class AsyncVertexClient:
+    def __init__(self, project_id, creds, model_name, region="global", use_text_layer=False, quota_counter=None,
+                 text_layer_report=None):
+        """
+        Bản async của VertexClient, dùng client.aio.models.generate_content
+        """
+        self.model_name = model_name
+        self.use_text_layer = use_text_layer
+        self.quota_counter = quota_counter if quota_counter is not None else get_current_quota_counter()
+        self.text_layer_report = text_layer_report if text_layer_report is not None else get_current_text_layer_report()
+        self.client = None
+        if not creds:
+            print("❌ Lỗi: Credentials bị None.")
+            return
+
+        try:
+            self.client = _create_genai_client(project_id, creds, region)
+        except Exception as e:
+            print(f"Lỗi init GenAI Client (async): {e}")
+            self.client = None
+
+    async def send_data_to_AI(self, prompt, file_paths=None, temperature=0.2, top_p=0.8, response_schema=None, max_output_tokens=65535,
+                              cached_content=None, return_usage=False):
+        """
+        cached_content: tên context cache (create_context_cache) -> không gửi lại file_paths
+        return_usage=True: trả về (text, usage) với usage từ _extract_usage
+        """
+        if not self.client:
+            message = "❌ Lỗi: Client chưa được khởi tạo."
+            return (message, {}) if return_usage else message
+
+        # Đọc file trong thread phụ để không chặn event loop
+        text_layer_plans = []
+        if cached_content:
+            file_paths = None
+        contents = await asyncio.to_thread(_build_contents, prompt, file_paths, text_layer_plans, self.use_text_layer)
+        generate_config = _build_generate_config(temperature, top_p, response_schema, max_output_tokens, cached_content)
+
+        try:
+            response = await self.client.aio.models.generate_content(
+                model=self.model_name,
+                contents=contents,
+                config=generate_config
+            )
+            _record_text_layer_usage(response, text_layer_plans, self.text_layer_report)
+            if return_usage:
+                return _extract_response_text(response), _extract_usage(response)
+            return _extract_response_text(response)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Lỗi khi gọi AI generate_content (async): {e}")
+            if self.quota_counter is not None and is_quota_error(e):
+                self.quota_counter.record()
+            raise e
+
+    async def create_context_cache(self, file_paths, ttl_seconds=600):
+        """
+        Đưa tài liệu (PDF / MD) vào context cache để các request bổ sung nhỏ chỉ gửi prompt.
+        Returns: tên cache, hoặc None nếu không tạo được (tài liệu dưới ngưỡng token tối thiểu
+        của cache, model không hỗ trợ...) -> bên gọi gửi kèm tài liệu như bình thường.
+        """
+        if not self.client or not file_paths:
+            return None
+        try:
+            contents = await asyncio.to_thread(_build_file_contents, file_paths, None, self.use_text_layer)
+            cache = await self.client.aio.caches.create(
+                model=self.model_name,
+                config=types.CreateCachedContentConfig(contents=contents, ttl=f"{ttl_seconds}s")
+            )
+            print(f"🗄️ Đã tạo context cache: {cache.name}")
+            return cache.name
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Không tạo được context cache, gửi kèm tài liệu như thường: {e}")
+            return None
+
+    async def delete_context_cache(self, cache_name):
+        """Xóa cache ngay khi xong (không chờ hết TTL để khỏi tính phí lưu trữ)"""
+        if not self.client or not cache_name:
+            return
+        try:
+            await self.client.aio.caches.delete(name=cache_name)
+        except Exception as e:
+            print(f"⚠️ Lỗi xóa context cache {cache_name}: {e}")
+
+
+DEFAULT_MAX_IN_FLIGHT = 256
+
+
+class AsyncRunner:
+    """
+    Event loop chạy trên 1 thread nền. Code đồng bộ (QThread, worker) gửi coroutine vào
+    bằng submit()/run(); cancel_all() hủy toàn bộ request đang bay.
+    """
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = None
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._thread = threading.Thread(target=self._run_loop, name="AsyncVertexLoop", daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    async def _guarded(self, coro):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        async with self._semaphore:
+            return await coro
+
+    def submit(self, coro):
+        """Gửi coroutine vào loop, trả về concurrent.futures.Future"""
+        with self._lock:
+            if self._cancelled:
+                coro.close()
+                raise concurrent.futures.CancelledError("Runner đã bị hủy")
+            future = asyncio.run_coroutine_threadsafe(self._guarded(coro), self._loop)
+            self._futures.add(future)
+        future.add_done_callback(self._discard_future)
+        return future
+
+    def run(self, coro, timeout=None):
+        """Chạy coroutine và chờ kết quả (dùng từ code đồng bộ)"""
+        return self.submit(coro).result(timeout)
+
+    def _discard_future(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    @property
+    def in_flight(self):
+        with self._lock:
+            return len(self._futures)
+
+    def cancel_all(self):
+        """Hủy mọi request đang chờ/đang chạy và chặn request mới"""
+        with self._lock:
+            self._cancelled = True
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+        if futures:
+            print(f"🛑 [API] Đã hủy {len(futures)} request đang chạy.")
+
+    async def _drain(self):
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        """Dọn các task còn sót rồi dừng loop"""
+        if not self._loop.is_running():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._drain(), self._loop).result(timeout=5)
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+
+
+_runner_local = threading.local()
+_default_runner = None
+_default_runner_lock = threading.Lock()
+
+
+def set_current_quota_counter(counter):
+    """Gắn QuotaErrorCounter của lần chạy cho thread hiện tại (client tạo trong thread này ghi vào đó)"""
+    _runner_local.quota_counter = counter
+
+
+def get_current_quota_counter():
+    return getattr(_runner_local, "quota_counter", None)
+
+
+def set_current_text_layer_report(report):
+    """Gắn TextLayerReport của lần chạy cho thread hiện tại (client tạo trong thread này ghi vào đó)"""
+    _runner_local.text_layer_report = report
+
+
+def get_current_text_layer_report():
+    return getattr(_runner_local, "text_layer_report", None)
+
+
+def set_current_async_runner(runner):
+    """Gắn runner cho thread hiện tại (ProcessingThread gắn runner riêng cho từng worker)"""
+    _runner_local.runner = runner
+
+
+def get_async_runner():
+    """Runner của thread hiện tại, nếu chưa gắn thì dùng runner mặc định toàn cục"""
+    global _default_runner
+    runner = getattr(_runner_local, "runner", None)
+    if runner is not None:
+        return runner
+    with _default_runner_lock:
+        if _default_runner is None:
+            _default_runner = AsyncRunner()
+        return _default_runner
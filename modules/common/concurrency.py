@@ -0,0 +1,145 @@
+"""
+Điều phối số request Gemini chạy song song theo quota của từng model.
+- Chế độ cố định: dùng đúng số luồng user chọn (bị chặn bởi quota model).
+- Chế độ tự động: tăng dần số luồng khi request ổn định, giảm một nửa khi API báo hết quota
+  (429 / RESOURCE_EXHAUSTED) hoặc latency chậm hẳn nhiều lần liên tiếp (AIMD).
+  Latency so theo từng loại task (TN / DS...), lỗi parse / schema không làm giảm luồng.
+- Lỗi quota đếm riêng cho từng lần chạy (QuotaErrorCounter): tab khác gặp 429 không ảnh hưởng.
+"""
+import os
+import threading
+
+# ============================================================
+# GIỚI HẠN ĐỒNG THỜI THEO MODEL
+# ============================================================
+# Mức trần MẶC ĐỊNH cho từng model (ước lượng, không phải quota thật của project).
+# Ghi đè trong .env.gen: GENQUES_MODEL_CONCURRENCY=gemini-2.5-pro=12,gemini-2.5-flash=30
+# Chế độ tự động sẽ tự lùi khi chạm quota thật (429).
+MODEL_CONCURRENCY_ENV = "GENQUES_MODEL_CONCURRENCY"
+MODEL_CONCURRENCY_LIMITS = {
+    "gemini-2.5-pro": 8,
+    "gemini-2.5-flash": 16,
+    "gemini-2.5-flash-lite": 24,
+    "gemini-3-pro-preview": 6,
+}
+DEFAULT_CONCURRENCY_LIMIT = 4
+
+
+def _env_concurrency_limits():
+    """Đọc GENQUES_MODEL_CONCURRENCY dạng "model=số,model=số" (bỏ qua mục sai định dạng)"""
+    limits = {}
+    for item in os.getenv(MODEL_CONCURRENCY_ENV, "").split(","):
+        model, _, value = item.partition("=")
+        if model.strip() and value.strip().isdigit() and int(value) > 0:
+            limits[model.strip()] = int(value)
+    return limits
+
+
+def get_model_concurrency_limit(model_name):
+    """Lấy số request đồng thời tối đa cho model: cấu hình .env.gen > mặc định > mức chung"""
+    env_limits = _env_concurrency_limits()
+    if model_name in env_limits:
+        return env_limits[model_name]
+    return MODEL_CONCURRENCY_LIMITS.get(model_name, DEFAULT_CONCURRENCY_LIMIT)
+
+
+# ============================================================
+# NHẬN DIỆN LỖI QUOTA
+# ============================================================
+def is_quota_error(error):
+    """Lỗi do chạm quota / rate limit của API (429, RESOURCE_EXHAUSTED)"""
+    if getattr(error, "code", None) == 429 or getattr(error, "status_code", None) == 429:
+        return True
+    message = str(error)
+    return "429" in message or "RESOURCE_EXHAUSTED" in message or "Too Many Requests" in message
+
+
+class QuotaErrorCounter:
+    """
+    Số lỗi quota của 1 lần chạy. Client API ghi vào (request chạy trong worker, lỗi thường bị
+    nuốt ở tầng trên), vòng điều phối đọc để giảm luồng.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def record(self):
+        with self._lock:
+            self._count += 1
+
+    @property
+    def count(self):
+        with self._lock:
+            return self._count
+
+
+# ============================================================
+# BỘ ĐIỀU KHIỂN SỐ LUỒNG
+# ============================================================
+class AdaptiveConcurrency:
+    """
+    Giữ giới hạn số task được chạy cùng lúc.
+    - adaptive=False: giới hạn cố định.
+    - adaptive=True: bắt đầu thấp, cứ `success_window` lần thành công liên tiếp thì +1,
+      gặp lỗi quota hoặc `slow_window` lần liên tiếp latency > baseline * latency_factor thì chia đôi.
+    Baseline latency là trung bình trượt riêng cho từng loại task (key) và luôn cập nhật,
+    nên task dài hơn hẳn nhưng đều đặn (VD Đúng/Sai sau loạt TN ngắn) chỉ bị coi là chậm vài lần đầu.
+    """
+    def __init__(self, max_limit, initial=None, adaptive=False, min_limit=1,
+                 success_window=2, latency_factor=2.0, slow_window=3):
+        self.max_limit = max(min_limit, max_limit)
+        self.min_limit = min_limit
+        self.adaptive = adaptive
+        start = initial if initial is not None else self.max_limit
+        self.limit = max(min_limit, min(start, self.max_limit))
+        self.success_window = success_window
+        self.latency_factor = latency_factor
+        self.slow_window = slow_window
+        self._baseline_latency = {}
+        self._streak = 0
+        self._slow_streak = 0
+        self._lock = threading.Lock()
+
+    def record_success(self, latency, key=None):
+        """
+        Ghi nhận 1 task thành công (latency tính bằng giây, key = loại task). Trả về giới hạn mới.
+        """
+        with self._lock:
+            if not self.adaptive:
+                return self.limit
+
+            baseline = self._baseline_latency.get(key)
+            # Trung bình trượt luôn nhận mẫu mới để baseline bám theo độ dài thực tế của task
+            self._baseline_latency[key] = latency if baseline is None else 0.8 * baseline + 0.2 * latency
+            if baseline is not None and latency > baseline * self.latency_factor:
+                self._streak = 0
+                self._slow_streak += 1
+                if self._slow_streak >= self.slow_window:
+                    # Chậm hẳn nhiều lần liên tiếp -> API đang quá tải, lùi lại
+                    self._back_off()
+                return self.limit
+
+            self._slow_streak = 0
+            self._streak += 1
+            if self._streak >= self.success_window and self.limit < self.max_limit:
+                self.limit += 1
+                self._streak = 0
+            return self.limit
+
+    def record_failure(self, quota_error=False):
+        """
+        Ghi nhận 1 task lỗi. Chỉ lỗi quota (429 / RESOURCE_EXHAUSTED) mới chia đôi giới hạn;
+        lỗi khác (parse JSON, schema...) chỉ ngắt chuỗi thành công. Trả về giới hạn mới.
+        """
+        with self._lock:
+            if self.adaptive:
+                if quota_error:
+                    self._back_off()
+                else:
+                    self._streak = 0
+            return self.limit
+
+    def _back_off(self):
+        self.limit = max(self.min_limit, self.limit // 2)
+        self._streak = 0
+        self._slow_streak = 0
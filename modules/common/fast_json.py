@@ -0,0 +1,164 @@
+"""
+Lớp JSON dùng chung cho phản hồi AI và file kết quả:
+- Dùng orjson nếu đã cài (parse / dump nhanh hơn nhiều với JSON song ngữ cỡ MB)
+- Không có orjson hoặc orjson từ chối dữ liệu (NaN, ký tự điều khiển khi strict=False...)
+  -> rơi về thư viện json chuẩn
+- orjson đọc số nguyên ngoài 64 bit thành float mà không báo lỗi -> kết quả có float ngoài
+  khoảng int64 thì parse lại bằng json chuẩn để giữ nguyên giá trị
+Khác biệt còn lại so với json chuẩn: dumps ghi NaN / Infinity thành null (JSON hợp lệ,
+json chuẩn ghi NaN - không phải JSON chuẩn).
+Chạy trực tiếp file này để đo trên các JSON đã lưu:
+    python -m modules.common.fast_json [file.json | thư mục ...]
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Lỗi parse chung cho mọi backend (orjson.JSONDecodeError kế thừa json.JSONDecodeError)
+JSONDecodeError = json.JSONDecodeError
+
+_INT64_LIMIT = 2.0 ** 63
+
+
+def backend_name():
+    return "orjson" if orjson is not None else "json"
+
+
+def _has_huge_float(data):
+    """
+    Có float ngoài khoảng int64 không (dấu hiệu orjson đã đổi số nguyên lớn thành float).
+    Duyệt container bằng stack, chỉ so float: rẻ hơn nhiều so với quét regex cả văn bản.
+    """
+    if type(data) is not dict and type(data) is not list:
+        return type(data) is float and not -_INT64_LIMIT < data < _INT64_LIMIT
+    stack = [data]
+    while stack:
+        container = stack.pop()
+        for value in (container.values() if type(container) is dict else container):
+            value_type = type(value)
+            if value_type is dict or value_type is list:
+                stack.append(value)
+            elif value_type is float and not -_INT64_LIMIT < value < _INT64_LIMIT:
+                return True
+    return False
+
+
+def loads(text, strict=True):
+    """
+    Parse str / bytes thành object Python.
+    strict=False: cho phép ký tự điều khiển trong chuỗi như json.loads(strict=False).
+    """
+    if orjson is not None:
+        try:
+            data = orjson.loads(text)
+            if not _has_huge_float(data):
+                return data
+        except orjson.JSONDecodeError:
+            pass  # Để json chuẩn quyết định (và báo lỗi có vị trí như cũ)
+    if isinstance(text, (bytes, bytearray)):
+        text = text.decode("utf-8")
+    return json.loads(text, strict=strict)
+
+
+def dumps_bytes(data, indent=True):
+    """
+    Object -> JSON UTF-8 (không escape tiếng Việt), indent 2 như json.dump(..., indent=2).
+    Với orjson: NaN / Infinity được ghi thành null.
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(data, option=option)
+        except TypeError:
+            pass  # Kiểu orjson không hỗ trợ (int > 64 bit...) -> json chuẩn
+    return json.dumps(data, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
+
+def dumps(data, indent=True):
+    return dumps_bytes(data, indent).decode("utf-8")
+
+
+def load_file(path):
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+
+# ============================================================
+# BENCHMARK: python -m modules.common.fast_json [đường dẫn ...]
+# ============================================================
+if __name__ == "__main__":
+    import os
+    import sys
+    import time
+
+    def _collect(paths):
+        found = []
+        for path in paths:
+            if os.path.isdir(path):
+                for root, _, files in os.walk(path):
+                    found.extend(os.path.join(root, f) for f in files if f.endswith(".json"))
+            elif path.endswith(".json"):
+                found.append(path)
+        return found
+
+    def _synthetic_payload(n_questions=400):
+        """Phản hồi song ngữ giả lập khi chưa có JSON nào đã lưu"""
+        question = {
+            "stt": 0, "muc_do": "thong_hieu", "phan": ["Bài 1", "Mục I", "Dạng 1"],
+            "noi_dung": "Cho hàm số $y = \\frac{x^2 - 3x + 2}{x - 1}$. Tìm **giá trị nhỏ nhất** trên đoạn $[2; 5]$. " * 3,
+            "noi_dung_en": "Given $y = \\frac{x^2 - 3x + 2}{x - 1}$, find the minimum value on $[2; 5]$. " * 3,
+            "dap_an": [{"noi_dung": f"Phương án {c}: $x = {i}$", "dung": c == "A"} for i, c in enumerate("ABCD")],
+            "loi_giai": "Ta có $y' = \\frac{(2x - 3)(x - 1) - (x^2 - 3x + 2)}{(x - 1)^2}$ ... " * 5,
+        }
+        return {"cau_hoi": [dict(question, stt=i + 1) for i in range(n_questions)]}
+
+    def _synthetic_book_plan(n_lessons=300):
+        """Mảng cắt sách như LocalProcessor / AutoProcessor._parse_ai_response nhận (tên bài tiếng Trung)"""
+        return [{"name": f"第{i + 1}课 二次函数的图像与性质\t（练习）", "start_page": i * 4 + 1, "end_page": i * 4 + 4}
+                for i in range(n_lessons)]
+
+    files = _collect(sys.argv[1:] or ["output"])
+    payloads = []
+    for path in files:
+        with open(path, "rb") as f:
+            payloads.append(f.read())
+    if not payloads:
+        print("ℹ️ Không tìm thấy JSON đã lưu, dùng dữ liệu giả lập (400 câu song ngữ)")
+        payloads = [json.dumps(_synthetic_payload(), ensure_ascii=False, indent=2).encode("utf-8")]
+    total_mb = sum(len(p) for p in payloads) / 1024 / 1024
+    print(f"📦 {len(payloads)} file, {total_mb:.2f} MB, backend: {backend_name()}")
+
+    texts = [p.decode("utf-8") for p in payloads]
+    objects = [json.loads(t) for t in texts]
+    for obj, text in zip(objects, texts):
+        assert loads(text) == obj
+        assert json.loads(dumps_bytes(obj)) == obj
+
+    def _measure(label, func, items, repeat=5):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for item in items:
+                func(item)
+        elapsed = (time.perf_counter() - started) / repeat
+        print(f"⏱️ {label}: {elapsed * 1000:.1f} ms ({total_mb / elapsed:.0f} MB/s)")
+
+    _measure("json.loads", json.loads, texts)
+    _measure(f"fast_json.loads ({backend_name()})", loads, texts)
+    _measure("json.dumps(indent=2)", lambda o: json.dumps(o, ensure_ascii=False, indent=2).encode("utf-8"), objects)
+    _measure(f"fast_json.dumps_bytes ({backend_name()})", dumps_bytes, objects)
+
+    # Đường cắt sách: _parse_ai_response (strict=False) + lưu {tên sách}.json
+    plan = _synthetic_book_plan()
+    plan_text = json.dumps(plan, ensure_ascii=False)
+    assert loads(plan_text, strict=False) == plan
+    total_mb = len(plan_text.encode("utf-8")) / 1024 / 1024
+    print(f"📚 Mảng cắt sách: {len(plan)} bài, {total_mb:.3f} MB")
+    _measure("json.loads(strict=False)", lambda t: json.loads(t, strict=False), [plan_text], repeat=50)
+    _measure(f"fast_json.loads(strict=False) ({backend_name()})", lambda t: loads(t, strict=False), [plan_text], repeat=50)
+    _measure("json.dump(indent=2)", lambda o: json.dumps(o, ensure_ascii=False, indent=2).encode("utf-8"), [plan], repeat=50)
+    _measure(f"fast_json.dumps_bytes ({backend_name()})", dumps_bytes, [plan], repeat=50)
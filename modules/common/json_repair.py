@@ -0,0 +1,232 @@
+"""
+Sửa JSON lỗi cục bộ (không gọi AI) cho phản hồi của model, thử lần lượt từng tầng:
+1. Bỏ dấu phẩy thừa trước } / ]
+2. Escape dấu " lạc trong chuỗi (VD: Chọn "đúng" viết thiếu \\)
+3. JSON bị cắt ngang (hết max_output_tokens): bỏ câu hỏi cuối bị cắt dở, đóng JSON ngay sau
+   câu hoàn chỉnh cuối cùng
+4. Không có câu nào hoàn chỉnh: đóng chuỗi / mảng / object đang mở tại chỗ bị cắt
+Chỉ khi cả 4 tầng đều thất bại mới cần gọi AI sửa. Thống kê tầng nào cứu được
+tổng hợp theo từng lần chạy (reset_stats / format_stats).
+"""
+import re
+import threading
+
+from modules.common import fast_json
+
+TIER_TRAILING_COMMA = "trailing_comma"
+TIER_STRAY_QUOTE = "stray_quote"
+TIER_DROP_PARTIAL = "drop_partial"
+TIER_CLOSE_TRUNCATED = "close_truncated"
+TIER_AI = "ai"
+TIER_FAILED = "failed"
+
+LOCAL_TIERS = (TIER_TRAILING_COMMA, TIER_STRAY_QUOTE, TIER_DROP_PARTIAL, TIER_CLOSE_TRUNCATED)
+TIER_LABELS = {
+    TIER_TRAILING_COMMA: "bỏ phẩy thừa",
+    TIER_STRAY_QUOTE: "escape dấu \" lạc",
+    TIER_DROP_PARTIAL: "bỏ câu cuối dở",
+    TIER_CLOSE_TRUNCATED: "đóng JSON bị cắt",
+    TIER_AI: "AI sửa",
+    TIER_FAILED: "thất bại",
+}
+
+_TRAILING_COMMA_RE = re.compile(r'"(?:[^"\\]|\\.)*"|,(\s*[}\]])', re.DOTALL)
+_STRUCTURE_RE = re.compile(r'[\\"{}\[\]]')
+_CLOSERS = {"{": "}", "[": "]"}
+# Stack ngay sau khi đóng 1 câu hỏi: nằm trực tiếp trong mảng cấp cao nhất
+# ({"cau_hoi": [ {...} ]} hoặc [ {...} ]), không tính object lồng như đáp án / lựa chọn
+_QUESTION_LEVEL_STACKS = (["{", "["], ["["])
+
+
+# ============================================================
+# CÁC TẦNG SỬA
+# ============================================================
+def remove_trailing_commas(text):
+    """{"a": 1,} -> {"a": 1}; chuỗi JSON giữ nguyên"""
+    return _TRAILING_COMMA_RE.sub(lambda m: m.group(1) if m.group(1) is not None else m.group(0), text)
+
+
+def _next_significant(text, pos):
+    length = len(text)
+    while pos < length and text[pos] in " \t\r\n":
+        pos += 1
+    return text[pos] if pos < length else ""
+
+
+def escape_stray_quotes(text):
+    """
+    Dấu " trong chuỗi chỉ được coi là dấu đóng khi theo sau là , : } ] hoặc hết văn bản;
+    ngược lại là dấu " lạc của nội dung -> escape thành \\"
+    """
+    out = []
+    pos = 0
+    in_string = False
+    i = 0
+    length = len(text)
+    while i < length:
+        ch = text[i]
+        if in_string:
+            if ch == "\\":
+                i += 2
+                continue
+            if ch == '"':
+                if _next_significant(text, i + 1) in (",", ":", "}", "]", ""):
+                    in_string = False
+                else:
+                    out.append(text[pos:i])
+                    out.append('\\"')
+                    pos = i + 1
+        elif ch == '"':
+            in_string = True
+        i += 1
+    out.append(text[pos:])
+    return "".join(out)
+
+
+def _scan(text):
+    """
+    Duyệt cấu trúc 1 lượt.
+    Returns: (stack ngoặc đang mở, đang ở trong chuỗi?,
+              [vị trí ngay sau mỗi câu hỏi hoàn chỉnh trong mảng cấp cao nhất])
+    """
+    stack = []
+    in_string = False
+    skip_to = -1
+    complete_items = []
+    for match in _STRUCTURE_RE.finditer(text):
+        i = match.start()
+        if i < skip_to:
+            continue
+        ch = text[i]
+        if in_string:
+            if ch == "\\":
+                skip_to = i + 2
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append(ch)
+        elif stack:
+            opener = stack.pop()
+            if opener == "{" and len(stack) <= 2 and stack in _QUESTION_LEVEL_STACKS:
+                complete_items.append(i + 1)
+    return stack, in_string, complete_items
+
+
+def _close(text, stack):
+    text = text.rstrip()
+    if text.endswith(","):
+        text = text[:-1]
+    elif text.endswith(":"):
+        text += " null"
+    return text + "".join(_CLOSERS[opener] for opener in reversed(stack))
+
+
+def close_truncated(text):
+    """Đóng chuỗi đang mở (bỏ backslash lẻ ở cuối) rồi đóng các ngoặc còn thiếu"""
+    stack, in_string, _ = _scan(text)
+    if in_string:
+        if text.endswith("\\") and not text.endswith("\\\\"):
+            text = text[:-1]
+        text += '"'
+    return _close(text, stack)
+
+
+def drop_partial_item(text):
+    """
+    Cắt sau câu hỏi hoàn chỉnh cuối cùng của mảng cấp cao nhất rồi đóng ngoặc.
+    Object lồng (đáp án, lựa chọn) đóng xong không được tính: cắt ở đó sẽ giữ lại câu dở.
+    """
+    stack, _, complete_items = _scan(text)
+    if not stack or not complete_items:
+        return None  # Không bị cắt / không có câu nào hoàn chỉnh
+    text = text[:complete_items[-1]]
+    return _close(text, _scan(text)[0])
+
+
+# ============================================================
+# ĐIỀU PHỐI + THỐNG KÊ
+# ============================================================
+def repair_json(text, strict=False):
+    """
+    Thử lần lượt các tầng sửa cục bộ (mỗi tầng dựa trên kết quả tầng trước).
+    Returns: (data, tên tầng) nếu cứu được, (None, None) nếu không.
+    """
+    candidate = text
+    steps = (
+        (TIER_TRAILING_COMMA, remove_trailing_commas),
+        (TIER_STRAY_QUOTE, escape_stray_quotes),
+        (TIER_DROP_PARTIAL, drop_partial_item),
+        (TIER_CLOSE_TRUNCATED, lambda t: remove_trailing_commas(close_truncated(t))),
+    )
+    for tier, repair in steps:
+        try:
+            repaired = repair(candidate)
+        except Exception:
+            continue
+        if repaired is None:
+            continue
+        try:
+            data = fast_json.loads(repaired, strict=strict)
+        except ValueError:
+            # Tầng 3 / 4 chỉ là phép thử cuối, không làm đầu vào cho tầng sau
+            if tier in (TIER_TRAILING_COMMA, TIER_STRAY_QUOTE):
+                candidate = repaired
+            continue
+        record(tier)
+        return data, tier
+    return None, None
+
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def record(tier):
+    with _stats_lock:
+        _stats[tier] = _stats.get(tier, 0) + 1
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def format_stats():
+    stats = get_stats()
+    total = sum(stats.values())
+    if not total:
+        return "🩹 Sửa JSON: không có phản hồi lỗi nào."
+    local = sum(stats.get(tier, 0) for tier in LOCAL_TIERS)
+    parts = [f"{TIER_LABELS[tier]}: {stats[tier]}" for tier in TIER_LABELS if stats.get(tier)]
+    return (f"🩹 Sửa JSON: {total} phản hồi lỗi, {local} sửa cục bộ "
+            f"({local / total * 100:.0f}%, không tốn request AI) | " + ", ".join(parts))
+
+
+if __name__ == "__main__":
+    cases = {
+        "phẩy thừa": '{"cau_hoi": [{"stt": 1, "noi_dung": "A, }",},],}',
+        "dấu \" lạc": '{"cau_hoi": [{"stt": 1, "noi_dung": "Chọn "đúng" hoặc "sai"."}]}',
+        "cắt trong chuỗi": '{"cau_hoi": [{"stt": 1, "noi_dung": "Cho $\\\\frac{1}{2}',
+        "cắt sau key": '{"cau_hoi": [{"stt": 1, "dap_an": "A"}, {"stt": 2, "noi_dung":',
+        "cắt giữa key": '{"cau_hoi": [{"stt": 1, "dap_an": "A"}, {"stt": 2, "noi_d',
+        "cắt sau đáp án": '{"cau_hoi": [{"stt": 1, "dap_an": "A"}, {"stt": 2, "cac_lua_chon": [{"ky_hieu": "A"},',
+    }
+    for name, text in cases.items():
+        data, tier = repair_json(text)
+        print(f"{name:16} -> {tier}: {data}")
+    print(format_stats())
+
+    # Bị cắt ngay sau 1 lựa chọn lồng trong câu 2: phải bỏ cả câu 2, không giữ câu dở
+    data, tier = repair_json(cases["cắt sau đáp án"])
+    assert tier == TIER_DROP_PARTIAL and data == {"cau_hoi": [{"stt": 1, "dap_an": "A"}]}, (tier, data)
+    data, tier = repair_json('[{"stt": 1}, {"stt": 2, "dap_an": [{"noi_dung": "x"}')
+    assert tier == TIER_DROP_PARTIAL and data == [{"stt": 1}], (tier, data)
+    print("✅ drop_partial chỉ cắt sau câu hỏi cấp cao nhất")
@@ -0,0 +1,198 @@
+"""
+Tách text có LaTeX thành các đoạn (text / in đậm / công thức inline / công thức display)
+dùng chung cho renderer KHTN (response2docxTN) và KHXH (response2docxXH).
+- Mọi regex compile 1 lần ở cấp module
+- Tách đoạn bằng finditer trên text 1 lượt (không dựng list re.split lồng nhau)
+- Làm sạch công thức có cache: cùng 1 công thức lặp lại chỉ xử lý 1 lần
+Chạy trực tiếp file này để đo chi phí mỗi dòng so với cách tách cũ.
+"""
+import re
+from functools import lru_cache
+
+# Loại đoạn
+SEG_TEXT = "text"
+SEG_BOLD = "bold"
+SEG_MATH = "math"            # $...$
+SEG_DISPLAY_MATH = "display"  # \[...\]
+
+# Ký tự điều khiển không hợp lệ trong XML (ASCII 0-31, trừ 9, 10, 13)
+_XML_INVALID_RE = re.compile(r'[\x00-\x08\x0B-\x0C\x0E-\x1F]')
+
+# Thẻ HTML định dạng model hay chèn vào (bỏ đi, giữ nội dung)
+_HTML_TAG_RE = re.compile(r'</?(div|p|u|span|font|i|b)\b[^>]*>')
+
+_MATH_RE = re.compile(r'\$[^$]+\$|\\\[.*?\\\]')
+_BOLD_RE = re.compile(r'\*\*.*?\*\*')
+
+
+def sanitize_xml_string(text):
+    """
+    Loại bỏ các ký tự điều khiển không hợp lệ trong XML (ASCII 0-31, trừ 9, 10, 13).
+    """
+    if not text:
+        return ""
+    return _XML_INVALID_RE.sub('', str(text))
+
+
+def strip_html(text):
+    """<br> -> xuống dòng, bỏ thẻ định dạng và &nbsp; &lt; &gt;"""
+    text = text.replace("<br>", "\n").replace("<br/>", "\n") \
+               .replace("<Br>", "\n").replace("<Br/>", "\n")
+    text = _HTML_TAG_RE.sub('', text)
+    return text.replace("&nbsp;", "").replace("&lt;", "").replace("&gt;", "")
+
+
+def _text_segments(chunk, split_bold):
+    # Đoạn bắt đầu bằng $ hoặc \[ nhưng không khép -> vẫn thử render như công thức
+    if chunk[0] == "$":
+        yield SEG_MATH, chunk
+        return
+    if chunk.startswith("\\["):
+        yield SEG_DISPLAY_MATH, chunk
+        return
+    if not split_bold:
+        yield SEG_TEXT, chunk
+        return
+    pos = 0
+    for match in _BOLD_RE.finditer(chunk):
+        start, end = match.span()
+        if start > pos:
+            yield from _plain_or_bold(chunk[pos:start])
+        if end - start > 4:
+            yield SEG_BOLD, chunk[start + 2:end - 2]
+        pos = end
+    if pos < len(chunk):
+        yield from _plain_or_bold(chunk[pos:])
+
+
+def _plain_or_bold(piece):
+    # **...** xuống dòng (regex không bắt qua dòng) vẫn tính là in đậm
+    if piece.startswith("**") and piece.endswith("**"):
+        if len(piece) > 4:
+            yield SEG_BOLD, piece[2:-2]
+        return
+    yield SEG_TEXT, piece
+
+
+def iter_segments(text, split_bold=True):
+    """
+    Duyệt text, trả về từng (loại, nội dung) theo thứ tự:
+    - SEG_MATH / SEG_DISPLAY_MATH: nguyên công thức kèm dấu $ / \\[ \\]
+    - SEG_BOLD: nội dung giữa **...** (đã bỏ dấu **), chỉ khi split_bold
+    - SEG_TEXT: phần còn lại
+    """
+    pos = 0
+    for match in _MATH_RE.finditer(text):
+        start, end = match.span()
+        if start > pos:
+            yield from _text_segments(text[pos:start], split_bold)
+        token = match.group(0)
+        yield (SEG_MATH if token[0] == "$" else SEG_DISPLAY_MATH), token
+        pos = end
+    if pos < len(text):
+        yield from _text_segments(text[pos:], split_bold)
+
+
+# ============================================================
+# LÀM SẠCH CÔNG THỨC
+# ============================================================
+_LATEX_RULES = [
+    (re.compile(r'\\/'), ''),
+    (re.compile(r'\\operatorname\s*{\s*([^}]*)\s*}'), lambda m: m.group(1).replace(' ', '')),
+    (re.compile(r'\\root\s*(\d+)\s*{([^}]*)}'), r'\\sqrt[\1]{\2}'),
+    (re.compile(r'\\root\s*{(\d+)}\s*\\of\s*{([^}]*)}'), r'\\sqrt[\1]{\2}'),
+    (re.compile(r'\\root\s*(\d+)\s*\\sqrt\s*{([^}]*)}'), r'\\sqrt[\1]{\2}'),
+    (re.compile(r'([a-zA-Z])\s*\\frac\s*{([^}]+)}\s*{([^}]+)}'), r'\1^{\\frac{\2}{\3}}'),
+    (re.compile(r'\\sp\s*{([^}]*)}'), r'^{\1}'),
+    (re.compile(r'{\\bf\s*([^}]*)}'), r'\1'),
+    (re.compile(r'\\\s*log'), r'\\log'),
+    (re.compile(r'\\bigskip'), ''),
+    (re.compile(r'\\nonumber'), ''),
+    (r'\?', '?'),
+    (re.compile(r'\\cdot\s*(?=\w)'), r'\\cdot '),
+    (r'\dotstan', r'\cdot \tan'),
+    (re.compile(r'(?<!\\)(\bln\b|\blog\b|\bsin\b|\bcos\b|\btan\b|\blog_{?\d*}?)'), r'\\\1'),
+    (re.compile(r'(\\Leftrightarrow|\\Rightarrow|\\rightarrow)(?=\w)'), r'\1 '),
+    (r'\\n', r'\n'),
+]
+
+
+@lru_cache(maxsize=4096)
+def clean_latex_body(latex_raw):
+    """Chuẩn hóa lệnh LaTeX hay bị model viết sai, bọc lại trong $...$"""
+    for rule, replacement in _LATEX_RULES:
+        if isinstance(rule, str):
+            latex_raw = latex_raw.replace(rule, replacement)
+        else:
+            latex_raw = rule.sub(replacement, latex_raw)
+    latex_raw = latex_raw.strip()
+    if not (latex_raw.startswith('$') and latex_raw.endswith('$')):
+        latex_raw = f"${latex_raw}$"
+    return latex_raw
+
+
+# ============================================================
+# MICRO-BENCHMARK: python -m modules.common.latex_text
+# ============================================================
+if __name__ == "__main__":
+    import time
+
+    def _legacy_segments(text):
+        """Cách tách cũ của process_text_with_latex (KHTN), để so sánh kết quả và tốc độ"""
+        text = re.sub(r'[\x00-\x08\x0B-\x0C\x0E-\x1F]', '', text)
+        text = text.replace("<br>", "\n").replace("<br/>", "\n") \
+                   .replace("<Br>", "\n").replace("<Br/>", "\n")
+        text = re.sub(r'</?(div|p|u|span|font|i|b)\b[^>]*>', '', text)
+        text = text.replace("&nbsp;", "").replace("&lt;", "").replace("&gt;", "")
+        result = []
+        for part in re.split(r'(\$[^$]+\$|\\\[.*?\\\])', text):
+            if not part:
+                continue
+            if part.startswith('$'):
+                result.append((SEG_MATH, part))
+            elif part.startswith('\\['):
+                result.append((SEG_DISPLAY_MATH, part))
+            else:
+                for sp in re.split(r'(\*\*.*?\*\*)', part):
+                    if not re.sub(r'[\x00-\x08\x0B-\x0C\x0E-\x1F]', '', sp):
+                        continue
+                    if sp.startswith("**") and sp.endswith("**"):
+                        if len(sp) > 4:
+                            result.append((SEG_BOLD, sp[2:-2]))
+                    else:
+                        result.append((SEG_TEXT, sp))
+        return result
+
+    def _new_segments(text):
+        return list(iter_segments(strip_html(sanitize_xml_string(text))))
+
+    samples = [
+        "Cho hàm số $y = x^2 - 3x + 2$ có đồ thị $(C)$. Tìm **giá trị nhỏ nhất** của hàm số.",
+        "Tính tích phân \\[ I = \\int_0^1 x e^x dx \\]<br>Kết quả: $I = 1$",
+        "**Lời giải:** Ta có $\\sin^2 x + \\cos^2 x = 1$ nên &nbsp;<b>đáp án</b> là $A$.",
+        "Một vật dao động điều hòa với biên độ $A = 5\\,cm$ và chu kì $T = 2\\,s$.<br/>Chọn **B**.",
+        "Trong các chất sau, chất nào là **chất điện li mạnh**? <span>NaCl</span>, CH<sub>3</sub>COOH",
+        "Đoạn văn không có công thức nào, chỉ có chữ thường và vài dấu **in đậm** xen kẽ **ở đây**.",
+    ]
+    for sample in samples:
+        assert _new_segments(sample) == _legacy_segments(sample), sample
+
+    lines = samples * 2000
+    for name, func in (("cũ (re.split lồng nhau)", _legacy_segments), ("mới (iter_segments)", _new_segments)):
+        started = time.perf_counter()
+        for line in lines:
+            func(line)
+        elapsed = time.perf_counter() - started
+        print(f"⏱️ Tách {name}: {elapsed / len(lines) * 1e6:.2f} µs/dòng")
+
+    formulas = ["$x^2 - 3x + 2$", "$\\frac{1}{2} \\cdot x$", "$\\root 3 {x}$", "$\\sin x + \\cos x$"] * 2500
+    started = time.perf_counter()
+    for formula in formulas:
+        clean_latex_body.__wrapped__(formula)
+    elapsed = time.perf_counter() - started
+    print(f"⏱️ clean_latex_body (không cache): {elapsed / len(formulas) * 1e6:.2f} µs/công thức")
+    started = time.perf_counter()
+    for formula in formulas:
+        clean_latex_body(formula)
+    elapsed = time.perf_counter() - started
+    print(f"⏱️ clean_latex_body (có cache): {elapsed / len(formulas) * 1e6:.2f} µs/công thức")
@@ -0,0 +1,57 @@
+"""
+Gộp các dạng đề của 1 bài (TN + DS + TLN + TL) thành 1 file DOCX duy nhất
+từ các JSON phản hồi AI đã lưu: không gọi AI, render 1 lượt vào cùng 1 document.
+Công thức / hình lấy từ cache dùng chung (modules/common/render_cache.py) nên phần
+đã render ở các file lẻ không phải chuyển đổi Pandoc hay sinh ảnh lại.
+"""
+import os
+import time
+from contextlib import nullcontext
+
+from modules.common import fast_json
+from modules.common.ooxml_writer import create_document
+from modules.common.render_cache import cached_images_only
+
+TASK_SUFFIXES = {"TN": "_TN", "DS": "_DS", "TLN": "_TLN", "TL": "_TL"}
+LESSON_TASK_ORDER = ("TN", "DS", "TLN", "TL")
+LESSON_SUFFIX = "_TONG_HOP"
+
+
+def find_task_jsons(processor_module, output_name):
+    """[(loại đề, đường dẫn JSON)] theo thứ tự TN -> DS -> TLN -> TL, chỉ các JSON đã có"""
+    batch_folder = processor_module.ensure_output_folder_for_batch(output_name)
+    found = []
+    for task_type in LESSON_TASK_ORDER:
+        json_path = os.path.join(batch_folder, f"{output_name}{TASK_SUFFIXES[task_type]}.json")
+        if os.path.exists(json_path):
+            found.append((task_type, json_path))
+    return found
+
+
+def compose_lesson(processor_module, output_name, allow_image_generation=False, fast_docx=False):
+    """
+    Render mọi JSON đã lưu của 1 bài vào 1 file <output_name>_TONG_HOP.docx.
+    allow_image_generation=False: hình chưa có trong cache thành placeholder (không gọi API).
+    fast_docx: ghi bằng OoxmlDocument thay cho python-docx.
+    Returns: đường dẫn file gộp hoặc None
+    """
+    task_jsons = find_task_jsons(processor_module, output_name)
+    if not task_jsons:
+        print(f"⚠️ [{output_name}] Chưa có JSON nào để gộp")
+        return None
+
+    started = time.perf_counter()
+    doc = create_document(fast=fast_docx)
+    renderer = processor_module.DynamicDocxRenderer(doc)
+    with nullcontext() if allow_image_generation else cached_images_only():
+        for idx, (task_type, json_path) in enumerate(task_jsons):
+            data = fast_json.load_file(json_path)
+            if idx:
+                doc.add_page_break()
+            renderer.render_all(data)
+
+    output_path = processor_module.save_document_securely(doc, output_name, f"{output_name}{LESSON_SUFFIX}")
+    if output_path:
+        task_list = " + ".join(task_type for task_type, _ in task_jsons)
+        print(f"📚 [{output_name}] Gộp {task_list} trong {time.perf_counter() - started:.1f}s: {output_path}")
+    return output_path
@@ -0,0 +1,301 @@
+"""
+Ghi DOCX trực tiếp (WordprocessingML dạng chuỗi) thay cho object python-docx.
+Dùng cho đề lớn (200 câu song ngữ): mỗi dòng chỉ là vài object Python nhẹ,
+lúc save mới dựng word/document.xml và ghi stream thẳng vào file zip 1 lượt.
+- Style / theme / numbering lấy nguyên từ template mặc định của python-docx (giống Document())
+- Hỗ trợ đúng phần API mà DynamicDocxRenderer dùng: add_paragraph, add_heading, add_picture,
+  add_page_break, paragraph.add_run / alignment, run.bold / italic / font.color.rgb, chèn OMML (công thức)
+Chọn backend theo từng lần gọi: create_document(fast=True).
+"""
+import os
+import re
+import threading
+import zipfile
+from xml.sax.saxutils import escape, quoteattr
+
+import docx
+from docx import Document
+
+from modules.common.latex_text import sanitize_xml_string
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(docx.__file__), "templates", "default.docx")
+DOCUMENT_PART = "word/document.xml"
+RELS_PART = "word/_rels/document.xml.rels"
+CONTENT_TYPES_PART = "[Content_Types].xml"
+IMAGE_REL_TYPE = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/image"
+
+# Namespace cần cho ảnh / công thức (template mặc định thiếu a: và pic:)
+REQUIRED_NAMESPACES = {
+    "w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main",
+    "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+    "m": "http://schemas.openxmlformats.org/officeDocument/2006/math",
+    "wp": "http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing",
+    "a": "http://schemas.openxmlformats.org/drawingml/2006/main",
+    "pic": "http://schemas.openxmlformats.org/drawingml/2006/picture",
+}
+
+# WD_ALIGN_PARAGRAPH -> giá trị w:jc
+ALIGNMENT_VALUES = {0: "left", 1: "center", 2: "right", 3: "both"}
+
+_TEXT_BREAK_RE = re.compile(r'(\r\n|\n|\r|\t)')
+
+
+def create_document(fast=False):
+    """fast=True: OoxmlDocument (ghi XML trực tiếp), ngược lại Document python-docx"""
+    return OoxmlDocument() if fast else Document()
+
+
+# ============================================================
+# TEMPLATE (đọc 1 lần, dùng chung mọi document)
+# ============================================================
+_template = None
+_template_lock = threading.Lock()
+
+
+def _load_template():
+    global _template
+    with _template_lock:
+        if _template is None:
+            with zipfile.ZipFile(TEMPLATE_PATH) as z:
+                parts = {name: z.read(name) for name in z.namelist()}
+            document_xml = parts[DOCUMENT_PART].decode("utf-8")
+            root_tag = re.search(r'<w:document\b[^>]*>', document_xml).group(0)
+            for prefix, uri in REQUIRED_NAMESPACES.items():
+                if f"xmlns:{prefix}=" not in root_tag:
+                    root_tag = root_tag[:-1] + f' xmlns:{prefix}="{uri}">'
+            sect_match = re.search(r'<w:sectPr\b.*?</w:sectPr>', document_xml, re.DOTALL)
+            _template = {
+                "parts": parts,
+                "document_head": "<?xml version='1.0' encoding='UTF-8' standalone='yes'?>\n" + root_tag + "<w:body>",
+                "document_tail": (sect_match.group(0) if sect_match else "") + "</w:body></w:document>",
+            }
+        return _template
+
+
+# ============================================================
+# RUN / PARAGRAPH
+# ============================================================
+class _Color:
+    def __init__(self):
+        self.rgb = None
+
+
+class _Font:
+    def __init__(self):
+        self.color = _Color()
+
+
+class OoxmlRun:
+    def __init__(self, text=""):
+        self.text = text
+        self.bold = None
+        self.italic = None
+        self._font = None
+        self._omml = None
+
+    @property
+    def font(self):
+        if self._font is None:
+            self._font = _Font()
+        return self._font
+
+    def _xml(self):
+        props = []
+        if self.bold is not None:
+            props.append("<w:b/>" if self.bold else '<w:b w:val="0"/>')
+        if self.italic is not None:
+            props.append("<w:i/>" if self.italic else '<w:i w:val="0"/>')
+        if self._font is not None and self._font.color.rgb is not None:
+            props.append(f'<w:color w:val="{self._font.color.rgb}"/>')
+        rpr = f"<w:rPr>{''.join(props)}</w:rPr>" if props else ""
+
+        # Giống python-docx: \n -> w:br, \t -> w:tab
+        content = []
+        for piece in _TEXT_BREAK_RE.split(sanitize_xml_string(self.text)):
+            if not piece:
+                continue
+            if piece == "\t":
+                content.append("<w:tab/>")
+            elif piece in ("\n", "\r", "\r\n"):
+                content.append("<w:br/>")
+            else:
+                content.append(f'<w:t xml:space="preserve">{escape(piece)}</w:t>')
+        if self._omml:
+            content.append(self._omml)
+        return f"<w:r>{rpr}{''.join(content)}</w:r>"
+
+
+class OoxmlParagraph:
+    def __init__(self, style_id=None):
+        self.style_id = style_id
+        self.alignment = None
+        self.runs = []
+        self._raw_xml = None
+
+    def add_run(self, text=None):
+        run = OoxmlRun(text or "")
+        self.runs.append(run)
+        return run
+
+    def add_omml(self, omml_str):
+        """Chèn công thức OMML (chuỗi <m:oMath>...) vào 1 run mới"""
+        run = OoxmlRun()
+        run._omml = omml_str
+        self.runs.append(run)
+        return run
+
+    def _xml(self):
+        props = []
+        if self.style_id:
+            props.append(f'<w:pStyle w:val="{self.style_id}"/>')
+        if self.alignment is not None:
+            props.append(f'<w:jc w:val="{ALIGNMENT_VALUES.get(int(self.alignment), "left")}"/>')
+        ppr = f"<w:pPr>{''.join(props)}</w:pPr>" if props else ""
+        body = "".join(run._xml() for run in self.runs)
+        if self._raw_xml:
+            body += self._raw_xml
+        return f"<w:p>{ppr}{body}</w:p>"
+
+
+# ============================================================
+# DOCUMENT
+# ============================================================
+class OoxmlDocument:
+    def __init__(self):
+        self.paragraphs = []
+        self._images = []  # (tên file trong word/media, bytes, rel_id)
+
+    def add_paragraph(self, text="", style=None):
+        paragraph = OoxmlParagraph(style.replace(" ", "") if style else None)
+        if text:
+            paragraph.add_run(text)
+        self.paragraphs.append(paragraph)
+        return paragraph
+
+    def add_heading(self, text="", level=1):
+        return self.add_paragraph(text, "Title" if level == 0 else f"Heading {level}")
+
+    def add_page_break(self):
+        paragraph = self.add_paragraph()
+        paragraph._raw_xml = '<w:r><w:br w:type="page"/></w:r>'
+        return paragraph
+
+    def add_picture(self, image_stream, width=None, height=None):
+        """Chèn ảnh inline thành 1 paragraph riêng (kích thước tính như python-docx)"""
+        from docx.image.image import Image
+
+        blob = image_stream.read() if hasattr(image_stream, "read") else image_stream
+        image = Image.from_blob(blob)
+        cx, cy = image.width, image.height
+        if width and height:
+            cx, cy = int(width), int(height)
+        elif width:
+            cx, cy = int(width), int(image.height * int(width) / image.width)
+        elif height:
+            cx, cy = int(image.width * int(height) / image.height), int(height)
+
+        index = len(self._images) + 1
+        rel_id = f"rIdImg{index}"
+        file_name = f"image{index}.{image.ext}"
+        self._images.append((file_name, blob, rel_id))
+
+        paragraph = self.add_paragraph()
+        paragraph._raw_xml = (
+            '<w:r><w:drawing><wp:inline distT="0" distB="0" distL="0" distR="0">'
+            f'<wp:extent cx="{cx}" cy="{cy}"/><wp:docPr id="{index}" name="Picture {index}"/>'
+            '<wp:cNvGraphicFramePr><a:graphicFrameLocks noChangeAspect="1"/></wp:cNvGraphicFramePr>'
+            '<a:graphic><a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+            f'<pic:pic><pic:nvPicPr><pic:cNvPr id="0" name="{file_name}"/><pic:cNvPicPr/></pic:nvPicPr>'
+            f'<pic:blipFill><a:blip r:embed="{rel_id}"/><a:stretch><a:fillRect/></a:stretch></pic:blipFill>'
+            f'<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="{cx}" cy="{cy}"/></a:xfrm>'
+            '<a:prstGeom prst="rect"><a:avLst/></a:prstGeom></pic:spPr></pic:pic>'
+            '</a:graphicData></a:graphic></wp:inline></w:drawing></w:r>'
+        )
+        return paragraph
+
+    # --- Ghi file ---
+    def _relationships_xml(self, template_rels):
+        if not self._images:
+            return template_rels
+        extra = "".join(
+            f'<Relationship Id="{rel_id}" Type="{IMAGE_REL_TYPE}" Target={quoteattr("media/" + file_name)}/>'
+            for file_name, _, rel_id in self._images
+        )
+        text = template_rels.decode("utf-8")
+        return text.replace("</Relationships>", extra + "</Relationships>").encode("utf-8")
+
+    def _content_types_xml(self, template_types):
+        text = template_types.decode("utf-8")
+        for ext in sorted({file_name.rsplit(".", 1)[1] for file_name, _, _ in self._images}):
+            if f'Extension="{ext}"' not in text:
+                content_type = "image/jpeg" if ext in ("jpg", "jpeg") else f"image/{ext}"
+                text = text.replace("</Types>", f'<Default Extension="{ext}" ContentType="{content_type}"/></Types>')
+        return text.encode("utf-8")
+
+    def save(self, path_or_stream):
+        """Ghi cả file zip 1 lượt; document.xml được ghi stream từng paragraph"""
+        template = _load_template()
+        parts = template["parts"]
+        with zipfile.ZipFile(path_or_stream, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr(CONTENT_TYPES_PART, self._content_types_xml(parts[CONTENT_TYPES_PART]))
+            for name, data in parts.items():
+                if name == CONTENT_TYPES_PART or name == DOCUMENT_PART:
+                    continue
+                if name == RELS_PART:
+                    data = self._relationships_xml(data)
+                z.writestr(name, data)
+            with z.open(DOCUMENT_PART, "w") as f:
+                f.write(template["document_head"].encode("utf-8"))
+                for paragraph in self.paragraphs:
+                    f.write(paragraph._xml().encode("utf-8"))
+                f.write(template["document_tail"].encode("utf-8"))
+            for file_name, blob, _ in self._images:
+                z.writestr(f"word/media/{file_name}", blob)
+
+
+# ============================================================
+# BENCHMARK: python -m modules.common.ooxml_writer [số câu]
+# ============================================================
+if __name__ == "__main__":
+    import sys
+    import time
+    import tempfile
+
+    from modules.khtn.response2docxTN import DynamicDocxRenderer
+
+    question_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    # Không có công thức $...$ để đo riêng chi phí ghi DOCX (không gọi Pandoc)
+    data = {
+        "loai_de": "trac_nghiem",
+        "ma_bai": "BENCH",
+        "cau_hoi": [
+            {
+                "stt": i + 1,
+                "muc_do": ["Nhận biết", "Thông hiểu", "Vận dụng", "Vận dụng cao"][i % 4],
+                "phan": [f"Phần {i // 50 + 1}"],
+                "noi_dung": f"Câu hỏi số {i + 1} về **chuyển động thẳng đều** của một vật trên mặt phẳng ngang.",
+                "noi_dung_en": f"Question {i + 1} about **uniform linear motion** of an object on a horizontal plane.",
+                "cac_lua_chon": [{"ky_hieu": k, "noi_dung": f"Phương án {k} của câu {i + 1}",
+                                  "noi_dung_en": f"Option {k} of question {i + 1}"} for k in "ABCD"],
+                "dap_an_dung": "A",
+                "giai_thich": "\n".join(f"Bước {s}: lập luận chi tiết cho câu {i + 1}." for s in range(1, 6))
+                              + "\nVậy đáp án đúng là A.",
+                "giai_thich_en": "\n".join(f"Step {s}: detailed reasoning for question {i + 1}." for s in range(1, 6))
+                                 + "\nTherefore the answer is A.",
+            }
+            for i in range(question_count)
+        ],
+    }
+
+    out_dir = tempfile.mkdtemp()
+    for name, factory in (("python-docx", Document), ("ooxml_writer", OoxmlDocument)):
+        started = time.perf_counter()
+        doc = factory()
+        DynamicDocxRenderer(doc).render_all(data)
+        rendered = time.perf_counter()
+        out_path = os.path.join(out_dir, f"{name}.docx")
+        doc.save(out_path)
+        saved = time.perf_counter()
+        print(f"⏱️ {name}: render {rendered - started:.2f}s + save {saved - rendered:.2f}s, "
+              f"{len(doc.paragraphs)} paragraph, file {os.path.getsize(out_path) / 1024:.0f} KB "
+              f"({question_count} câu)")
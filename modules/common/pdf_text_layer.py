@@ -0,0 +1,208 @@
+"""
+Tiền xử lý PDF trước khi gửi Gemini: dùng text layer có sẵn thay cho cả file PDF.
+- Trích text từng trang bằng pypdf, chấm điểm chất lượng (đủ chữ, ít ký tự lỗi / font riêng)
+- Trang text tốt -> gửi dạng text; trang nhiều hình hoặc text hỏng -> gom thành 1 PDF con
+- File có quá ít trang text tốt (PDF scan) -> gửi nguyên PDF như cũ
+Báo cáo token tiết kiệm được tổng hợp theo từng lần chạy (TextLayerReport, mỗi lần chạy 1 đối tượng).
+"""
+import io
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import pypdf
+
+# Ước tính token: mỗi trang PDF tính như 1 ảnh 258 token + text layer (~4 ký tự / token)
+PDF_TOKENS_PER_PAGE = 258
+CHARS_PER_TOKEN = 4
+
+# Ngưỡng chấm điểm trang
+MIN_PAGE_CHARS = 200          # Ít chữ hơn -> coi là trang hình / trang scan
+MAX_BAD_CHAR_RATIO = 0.02     # Tỉ lệ ký tự lỗi (U+FFFD, vùng Private Use của font công thức, ký tự điều khiển)
+LARGE_IMAGE_PIXELS = 150_000  # Ảnh nhúng từ ~390x390 trở lên là hình nội dung, không phải logo / icon
+MIN_TEXT_PAGE_RATIO = 0.5     # Dưới tỉ lệ trang text tốt này thì gửi nguyên PDF
+PLAN_CACHE_SIZE = 16          # Số PDF giữ kế hoạch trong RAM (mỗi kế hoạch giữ cả text + PDF con)
+
+_BAD_CHARS_RE = re.compile(r"[\ufffd\ue000-\uf8ff\x00-\x08\x0b\x0c\x0e-\x1f]")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
+# ============================================================
+# CHẤM ĐIỂM TỪNG TRANG
+# ============================================================
+def _large_image_count(page):
+    """Số ảnh nhúng kích thước lớn trên trang (đọc /Width /Height trong XObject, không giải mã ảnh)"""
+    try:
+        resources = page.get("/Resources")
+        xobjects = resources.get_object().get("/XObject") if resources else None
+        if not xobjects:
+            return 0
+        count = 0
+        for xobject in xobjects.get_object().values():
+            xobject = xobject.get_object()
+            if xobject.get("/Subtype") != "/Image":
+                continue
+            if int(xobject.get("/Width", 0)) * int(xobject.get("/Height", 0)) >= LARGE_IMAGE_PIXELS:
+                count += 1
+        return count
+    except Exception:
+        return 0
+
+
+def score_page(page):
+    """Trích text 1 trang và quyết định gửi dạng text hay giữ dạng PDF"""
+    try:
+        text = page.extract_text() or ""
+    except Exception:
+        text = ""
+    text = _BLANK_LINES_RE.sub("\n\n", text).strip()
+    chars = len(text)
+    bad_ratio = len(_BAD_CHARS_RE.findall(text)) / chars if chars else 1.0
+    large_images = _large_image_count(page)
+    use_text = chars >= MIN_PAGE_CHARS and bad_ratio <= MAX_BAD_CHAR_RATIO and large_images == 0
+    return {"text": text, "chars": chars, "bad_ratio": bad_ratio,
+            "large_images": large_images, "use_text": use_text}
+
+
+# ============================================================
+# KẾ HOẠCH GỬI 1 FILE PDF
+# ============================================================
+class TextLayerPlan:
+    def __init__(self, file_name, page_count, use_text, text, visual_pages, pdf_subset,
+                 estimated_pdf_tokens, estimated_tokens):
+        self.file_name = file_name
+        self.page_count = page_count
+        self.use_text = use_text            # False -> gửi nguyên PDF
+        self.text = text                    # Text layer có đánh dấu trang
+        self.visual_pages = visual_pages    # Trang (đánh số từ 1) gửi kèm dạng PDF con
+        self.pdf_subset = pdf_subset        # bytes PDF con hoặc None
+        self.estimated_pdf_tokens = estimated_pdf_tokens
+        self.estimated_tokens = estimated_tokens
+
+
+def _build_subset(reader, page_numbers):
+    writer = pypdf.PdfWriter()
+    for page_number in page_numbers:
+        writer.add_page(reader.pages[page_number - 1])
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def _build_plan(pdf_path):
+    reader = pypdf.PdfReader(pdf_path)
+    file_name = os.path.basename(pdf_path)
+    scores = [score_page(page) for page in reader.pages]
+    page_count = len(scores)
+    total_chars = sum(score["chars"] for score in scores)
+    estimated_pdf_tokens = page_count * PDF_TOKENS_PER_PAGE + total_chars // CHARS_PER_TOKEN
+
+    text_pages = sum(1 for score in scores if score["use_text"])
+    if not page_count or text_pages / page_count < MIN_TEXT_PAGE_RATIO:
+        return TextLayerPlan(file_name, page_count, False, None, [], None,
+                             estimated_pdf_tokens, estimated_pdf_tokens)
+
+    visual_pages = [idx + 1 for idx, score in enumerate(scores) if not score["use_text"]]
+    blocks = []
+    for idx, score in enumerate(scores):
+        if score["use_text"]:
+            blocks.append(f"[Trang {idx + 1}]\n{score['text']}")
+        else:
+            blocks.append(f"[Trang {idx + 1}: xem PDF đính kèm]")
+    text = "\n\n".join(blocks)
+    pdf_subset = _build_subset(reader, visual_pages) if visual_pages else None
+
+    text_chars = sum(score["chars"] for score in scores if score["use_text"])
+    visual_chars = total_chars - text_chars
+    estimated_tokens = (len(text) // CHARS_PER_TOKEN
+                        + len(visual_pages) * PDF_TOKENS_PER_PAGE + visual_chars // CHARS_PER_TOKEN)
+    return TextLayerPlan(file_name, page_count, True, text, visual_pages, pdf_subset,
+                         estimated_pdf_tokens, estimated_tokens)
+
+
+_plan_cache = OrderedDict()
+_plan_lock = threading.Lock()
+
+
+def analyze_pdf(pdf_path):
+    """
+    Phân tích 1 PDF (có cache LRU theo đường dẫn + size + mtime: các task TN/DS/TLN/TL
+    cùng 1 bài chỉ trích text 1 lần, RAM không tăng theo số bài của lần chạy).
+    """
+    stat = os.stat(pdf_path)
+    key = (os.path.abspath(pdf_path), stat.st_size, stat.st_mtime_ns)
+    with _plan_lock:
+        plan = _plan_cache.get(key)
+        if plan is not None:
+            _plan_cache.move_to_end(key)
+    if plan is None:
+        plan = _build_plan(pdf_path)
+        with _plan_lock:
+            _plan_cache[key] = plan
+            while len(_plan_cache) > PLAN_CACHE_SIZE:
+                _plan_cache.popitem(last=False)
+    return plan
+
+
+def clear_cache():
+    with _plan_lock:
+        _plan_cache.clear()
+
+
+def describe_visual_pages(plan):
+    """Câu dẫn cho model biết PDF đính kèm chứa những trang nào"""
+    pages = ", ".join(str(page) for page in plan.visual_pages)
+    return (f"Các trang có hình vẽ / bảng biểu / công thức không trích được text của tài liệu "
+            f"{plan.file_name} được đính kèm dạng PDF (theo thứ tự): trang {pages}.")
+
+
+# ============================================================
+# BÁO CÁO TOKEN THEO LẦN CHẠY
+# ============================================================
+class TextLayerReport:
+    """Báo cáo token của 1 lần chạy; client API ghi vào sau mỗi request có gửi PDF"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._report = dict(requests=0, text_files=0, pdf_files=0, pages=0, visual_pages=0,
+                            estimated_pdf_tokens=0, estimated_tokens=0,
+                            measured_requests=0, measured_prompt_tokens=0)
+
+    def record_plan(self, plan):
+        """Ghi nhận 1 file PDF trong 1 request"""
+        with self._lock:
+            if plan.use_text:
+                self._report["text_files"] += 1
+            else:
+                self._report["pdf_files"] += 1
+            self._report["pages"] += plan.page_count
+            self._report["visual_pages"] += len(plan.visual_pages) if plan.use_text else plan.page_count
+            self._report["estimated_pdf_tokens"] += plan.estimated_pdf_tokens
+            self._report["estimated_tokens"] += plan.estimated_tokens
+
+    def record_usage(self, prompt_tokens):
+        """Ghi nhận số prompt token thực tế (usage_metadata) của 1 request có dùng text layer"""
+        with self._lock:
+            self._report["requests"] += 1
+            if prompt_tokens:
+                self._report["measured_requests"] += 1
+                self._report["measured_prompt_tokens"] += prompt_tokens
+
+    def get(self):
+        with self._lock:
+            return dict(self._report)
+
+    def format(self):
+        report = self.get()
+        if not (report["text_files"] or report["pdf_files"]):
+            return "📑 Text layer: không có file PDF nào được xử lý."
+        before = report["estimated_pdf_tokens"]
+        after = report["estimated_tokens"]
+        saved_pct = (before - after) / before * 100 if before else 0
+        message = (f"📑 Text layer: {report['text_files']} lượt gửi text, {report['pdf_files']} lượt gửi nguyên PDF; "
+                   f"{report['visual_pages']}/{report['pages']} trang vẫn gửi dạng PDF. "
+                   f"Token đầu vào ước tính: {before:,} → {after:,} (tiết kiệm {saved_pct:.0f}%)")
+        if report["measured_requests"]:
+            message += (f" | Thực đo: {report['measured_prompt_tokens']:,} prompt token "
+                        f"/ {report['measured_requests']} request")
+        return message
@@ -0,0 +1,131 @@
+"""
+Cache dùng chung khi render DOCX (KHTN / KHXH, file lẻ và file gộp theo bài):
+- Công thức: LaTeX -> OMML (mỗi công thức chỉ gọi Pandoc 1 lần, lưu JSONL để lần sau dùng lại)
+- Hình: mô tả -> ảnh PNG đã sinh (render lại từ JSON / gộp file không gọi API sinh ảnh lần 2)
+Đặt trong output/.render_cache của từng module xử lý.
+"""
+import os
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+
+CACHE_DIR_NAME = ".render_cache"
+EQUATION_FILE_NAME = "equations.jsonl"
+IMAGE_DIR_NAME = "images"
+
+
+class EquationCache:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = None
+        self._failed = set()  # Lỗi Pandoc chỉ nhớ trong phiên (lần sau có thể đã cài Pandoc)
+
+    def _load(self):
+        entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        entries[record["latex"]] = record["omml"]
+                    except (ValueError, KeyError):
+                        continue  # Dòng ghi dở khi bị tắt ngang
+        return entries
+
+    def get_or_convert(self, latex, convert):
+        """OMML của công thức, gọi convert(latex) nếu chưa có trong cache"""
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            if latex in self._entries:
+                return self._entries[latex]
+            if latex in self._failed:
+                return None
+
+        omml = convert(latex)
+
+        with self._lock:
+            if not omml:
+                self._failed.add(latex)
+                return None
+            if latex not in self._entries:
+                self._entries[latex] = omml
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"latex": latex, "omml": omml}, ensure_ascii=False) + "\n")
+        return omml
+
+
+class ImageCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+
+    def _path(self, description, lang):
+        key = hashlib.sha256(f"{lang}\n{description}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def get(self, description, lang="vi"):
+        path = self._path(description, lang)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def put(self, description, image_bytes, lang="vi"):
+        path = self._path(description, lang)
+        with self._lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(image_bytes)
+            os.replace(tmp_path, path)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _cache_root(app_path):
+    return os.path.join(app_path, "output", CACHE_DIR_NAME)
+
+
+def get_equation_cache(app_path):
+    root = _cache_root(app_path)
+    with _caches_lock:
+        key = ("equation", root)
+        if key not in _caches:
+            _caches[key] = EquationCache(os.path.join(root, EQUATION_FILE_NAME))
+        return _caches[key]
+
+
+def get_image_cache(app_path):
+    root = _cache_root(app_path)
+    with _caches_lock:
+        key = ("image", root)
+        if key not in _caches:
+            _caches[key] = ImageCache(os.path.join(root, IMAGE_DIR_NAME))
+        return _caches[key]
+
+
+# ============================================================
+# CHẾ ĐỘ KHÔNG SINH ẢNH (theo từng thread)
+# ============================================================
+_thread_state = threading.local()
+
+
+def image_generation_allowed():
+    return getattr(_thread_state, "allow_image_generation", True)
+
+
+@contextmanager
+def cached_images_only():
+    """Trong khối này, hình chưa có trong cache sẽ thành placeholder thay vì gọi API sinh ảnh"""
+    previous = image_generation_allowed()
+    _thread_state.allow_image_generation = False
+    try:
+        yield
+    finally:
+        _thread_state.allow_image_generation = previous
@@ -0,0 +1,102 @@
+"""
+Nhật ký chạy (run journal) cho GenQues - file JSONL append-only trong thư mục output/.
+Mỗi dòng ghi trạng thái 1 task (output_name, task_type): started / done / failed,
+kèm hash file DOCX và đường dẫn JSON phản hồi AI để lần chạy sau có thể resume.
+"""
+import os
+import json
+import time
+import threading
+
+from core.hashing import file_sha256
+
+JOURNAL_FILE_NAME = "run_journal.jsonl"
+
+
+class RunJournal:
+    def __init__(self, output_base):
+        os.makedirs(output_base, exist_ok=True)
+        self.path = os.path.join(output_base, JOURNAL_FILE_NAME)
+        self._lock = threading.Lock()
+        self._states = {}  # task_key -> bản ghi mới nhất
+        self._needs_newline = False
+        self._load()
+
+    @staticmethod
+    def task_key(output_name, task_type):
+        return f"{output_name}::{task_type}"
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                # Dòng cuối không có "\n" (ghi dở) -> lần ghi sau phải xuống dòng trước
+                self._needs_newline = not line.endswith("\n")
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Dòng cuối bị cắt ngang do app tắt đột ngột -> bỏ qua
+                    continue
+                key = self.task_key(entry.get("output_name"), entry.get("task_type"))
+                self._states[key] = entry
+        print(f"📒 [Journal] Đã nạp {len(self._states)} task từ {self.path}")
+
+    def record(self, output_name, task_type, state, **fields):
+        """Ghi 1 dòng trạng thái (flush + fsync để không mất khi crash)"""
+        entry = {
+            "ts": time.time(),
+            "output_name": output_name,
+            "task_type": task_type,
+            "state": state,
+        }
+        entry.update(fields)
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                if self._needs_newline:
+                    f.write("\n")
+                    self._needs_newline = False
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._states[self.task_key(output_name, task_type)] = entry
+        return entry
+
+    def get(self, output_name, task_type):
+        with self._lock:
+            return self._states.get(self.task_key(output_name, task_type))
+
+    def completed_output(self, output_name, task_type, input_sha):
+        """
+        Trả về đường dẫn DOCX nếu task đã xong với cùng prompt và file vẫn còn nguyên (đúng hash).
+        """
+        entry = self.get(output_name, task_type)
+        if not entry or entry.get("state") != "done" or entry.get("input_sha") != input_sha:
+            return None
+        output_path = entry.get("output_path")
+        if not output_path or not os.path.exists(output_path):
+            return None
+        try:
+            if file_sha256(output_path) != entry.get("output_sha256"):
+                return None
+        except OSError:
+            return None
+        return output_path
+
+    def cached_response(self, output_name, task_type, input_sha, response_path):
+        """
+        Trả về đường dẫn JSON phản hồi AI còn dùng được (task dở dang hoặc DOCX bị xóa/sửa):
+        file phải được ghi sau lần 'started' gần nhất với cùng đầu vào.
+        """
+        entry = self.get(output_name, task_type)
+        if not entry or entry.get("input_sha") != input_sha:
+            return None
+        if not response_path or not os.path.exists(response_path):
+            return None
+        if os.path.getmtime(response_path) < entry.get("started_ts", entry.get("ts", 0)):
+            return None
+        return response_path
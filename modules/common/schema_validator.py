@@ -0,0 +1,143 @@
+"""
+Kiểm tra phản hồi AI theo chính các schema gửi cho Gemini (modules/common/schema.py):
+- Schema được "compile" 1 lần thành cây hàm kiểm tra (không duyệt lại dict schema mỗi câu)
+- Kiểm tra TỪNG câu trong cau_hoi độc lập: câu lỗi bị đánh dấu, câu đúng vẫn dùng được
+- stt_ranges gom các stt lỗi thành khoảng liên tục để chỉ yêu cầu AI sinh lại đúng các câu đó
+Chỉ bắt lỗi thiếu trường bắt buộc (null / vắng) và sai kiểu: schema không có minLength, và
+prompt có trường cố ý để rỗng (VD "ma_dang": "" - code tự đánh mã sau).
+"""
+import threading
+
+_PRIMITIVE_CHECKS = {
+    "STRING": lambda v: isinstance(v, str),
+    "INTEGER": lambda v: (isinstance(v, int) and not isinstance(v, bool)) or (isinstance(v, float) and v.is_integer()),
+    "NUMBER": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "BOOLEAN": lambda v: isinstance(v, bool),
+    "OBJECT": lambda v: isinstance(v, dict),
+    "ARRAY": lambda v: isinstance(v, list),
+}
+_TYPE_NAMES = {"STRING": "chuỗi", "INTEGER": "số nguyên", "NUMBER": "số", "BOOLEAN": "true/false",
+               "OBJECT": "object", "ARRAY": "mảng"}
+
+# ma_dang: prompt yêu cầu để rỗng, Đúng/Sai được code đánh lại (renumber_ma_dang_global) -> không tính lỗi
+DEFAULT_IGNORE_FIELDS = ("ma_dang",)
+
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+
+def _compile(schema):
+    """Trả về hàm check(value, path, errors) cho 1 node schema"""
+    schema_type = schema.get("type", "").upper()
+    type_check = _PRIMITIVE_CHECKS.get(schema_type)
+    enum = frozenset(schema["enum"]) if "enum" in schema else None
+    properties = {key: _compile(sub) for key, sub in schema.get("properties", {}).items()}
+    required = tuple(schema.get("required", ()))
+    item_check = _compile(schema["items"]) if "items" in schema else None
+    type_name = _TYPE_NAMES.get(schema_type, schema_type)
+
+    def check(value, path, errors):
+        if type_check is not None and not type_check(value):
+            errors.append(f"{path}: cần {type_name}")
+            return
+        if enum is not None and value not in enum:
+            errors.append(f"{path}: giá trị '{value}' ngoài {sorted(enum)}")
+            return
+        if properties or required:
+            for key in required:
+                if value.get(key) is None:
+                    errors.append(f"{path}.{key}: thiếu")
+            for key, sub_check in properties.items():
+                field = value.get(key)
+                if field is not None:  # Trường không bắt buộc được phép null / vắng
+                    sub_check(field, f"{path}.{key}", errors)
+        elif item_check is not None:
+            for idx, item in enumerate(value):
+                item_check(item, f"{path}[{idx}]", errors)
+
+    return check
+
+
+def _get_check(schema):
+    # Giữ tham chiếu schema trong cache để id() không bị tái sử dụng
+    key = id(schema)
+    with _compiled_lock:
+        entry = _compiled.get(key)
+        if entry is None or entry[0] is not schema:
+            entry = _compiled[key] = (schema, _compile(schema))
+        return entry[1]
+
+
+def validate(value, schema, path="$"):
+    """Danh sách lỗi (rỗng = hợp lệ)"""
+    errors = []
+    _get_check(schema)(value, path, errors)
+    return errors
+
+
+def question_schema(schema):
+    """Schema của 1 phần tử trong cau_hoi"""
+    return schema["properties"]["cau_hoi"]["items"]
+
+
+def split_questions(questions, schema, ignore_fields=()):
+    """
+    Kiểm tra từng câu độc lập.
+    ignore_fields: trường sẽ bị code ghi đè sau đó (VD muc_do ở Đúng/Sai) nên không tính lỗi,
+    cộng thêm DEFAULT_IGNORE_FIELDS.
+    Returns: (câu hợp lệ, [(câu lỗi, danh sách lỗi)])
+    """
+    ignore_fields = DEFAULT_IGNORE_FIELDS + tuple(ignore_fields)
+    item_schema = question_schema(schema)
+    check = _get_check(item_schema)
+    valid, invalid = [], []
+    for idx, question in enumerate(questions):
+        stt = question.get("stt") if isinstance(question, dict) else None
+        errors = []
+        check(question, f"câu {stt if stt is not None else f'#{idx + 1}'}", errors)
+        if errors:
+            errors = [e for e in errors if not any(f".{field}" in e for field in ignore_fields)]
+        if errors:
+            invalid.append((question, errors))
+        else:
+            valid.append(question)
+    return valid, invalid
+
+
+def stt_ranges(numbers):
+    """[3, 4, 5, 9, 11, 12] -> [(3, 5), (9, 9), (11, 12)]"""
+    ranges = []
+    for number in sorted(set(numbers)):
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], number)
+        else:
+            ranges.append((number, number))
+    return ranges
+
+
+def format_ranges(ranges):
+    return ", ".join(f"{start}" if start == end else f"{start}-{end}" for start, end in ranges)
+
+
+if __name__ == "__main__":
+    import time
+    from modules.common.schema import schema_trac_nghiem
+
+    good = {
+        "stt": 1, "muc_do": "nhan_biet", "ma_dang": "X_1", "phan": ["Bài 1", "Mục I", "Dạng 1"],
+        "noi_dung": "Câu hỏi", "cac_lua_chon": [{"ky_hieu": k, "noi_dung": k} for k in "ABCD"],
+        "dap_an_dung": 1, "giai_thich": "Vì...",
+    }
+    bad = dict(good, stt=2, cac_lua_chon=[{"ky_hieu": "A"}], dap_an_dung="A", giai_thich=None)
+    questions = [dict(good, stt=i) for i in range(1, 40)] + [bad]
+    valid, invalid = split_questions(questions, schema_trac_nghiem)
+    print(f"✅ {len(valid)} hợp lệ, ❌ {len(invalid)} lỗi: {invalid[0][1]}")
+    # Chuỗi rỗng (VD ma_dang theo mẫu prompt) không phải lỗi
+    assert not split_questions([dict(good, ma_dang="", giai_thich="")], schema_trac_nghiem)[1]
+    print(f"🔁 Khoảng cần sinh lại: {format_ranges(stt_ranges([2, 3, 4, 9, 11, 12]))}")
+
+    started = time.perf_counter()
+    for _ in range(250):
+        split_questions(questions, schema_trac_nghiem)
+    elapsed = time.perf_counter() - started
+    print(f"⏱️ {elapsed / (250 * len(questions)) * 1e6:.1f} µs/câu")
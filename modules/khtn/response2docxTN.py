@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 import sys
@@ -20,23 +21,26 @@ from modules.common.schema import (
     schema_tra_loi_ngan, 
     schema_tu_luan
 )
+from modules.common.latex_text import (
+    SEG_MATH, SEG_DISPLAY_MATH, SEG_BOLD,
+    sanitize_xml_string, strip_html, iter_segments, clean_latex_body
+)
+from modules.common.ooxml_writer import OoxmlParagraph, create_document
+from modules.common.render_cache import get_equation_cache, get_image_cache, image_generation_allowed
+from modules.common.atomic_io import atomic_write_bytes
+from modules.common import fast_json, json_repair, schema_validator
+from modules.common.batch_sizer import get_batch_sizer, detect_language_mode
 
-_FILE_LOCK = threading.RLock()
 _OUTPUT_DIR_LOCK = threading.RLock()
+_UNESCAPED_PERCENT_RE = re.compile(r'(?<!\\)%')
+_SALVAGE_START_RE = re.compile(r'\{\s*[\'"]stt[\'"]\s*:', re.IGNORECASE)
+_TOTAL_QUESTIONS_RE = re.compile(r'["\']?tong_so_cau["\']?\s*[:=]\s*(\d+)')
 
 def get_app_path():
     """Lấy đường dẫn chứa file .exe hoặc script"""
     if getattr(sys, 'frozen', False):
         return os.path.dirname(sys.executable)
     return os.path.dirname(os.path.abspath(__file__))
-def sanitize_xml_string(text):
-    """
-    Loại bỏ các ký tự điều khiển không hợp lệ trong XML (ASCII 0-31, trừ 9, 10, 13).
-    """
-    if not text:
-        return ""
-    # Regex loại bỏ các ký tự từ \x00-\x08, \x0B-\x0C, \x0E-\x1F
-    return re.sub(r'[\x00-\x08\x0B-\x0C\x0E-\x1F]', '', str(text))
 def find_pandoc_executable():
     """
     Tìm pandoc.exe theo thứ tự ưu tiên:
@@ -140,6 +144,7 @@ def process_text_with_latex(text, paragraph, bold=False):
     """
     Xử lý text có công thức LaTeX
     VERSION ỔN ĐỊNH - Copy từ test_res.py (KHÔNG có repair_broken_latex)
+    Tách đoạn bằng tokenizer dùng chung (modules/common/latex_text.py)
     """
     if not text:
         return
@@ -149,21 +154,11 @@ def process_text_with_latex(text, paragraph, bold=False):
         is_entirely_bold = True
         text = text[2:-2]
     # Làm sạch HTML tags
-    text = text.replace("<br>", "\n").replace("<br/>", "\n") \
-               .replace("<Br>", "\n").replace("<Br/>", "\n")
-    text = re.sub(r'</?(div|p|u|span|font|i|b)\b[^>]*>', '', text)
-    text = text.replace("&nbsp;", "").replace("&lt;", "").replace("&gt;", "")
-    
-    # Tách text và LaTeX
-    pattern = r'(\$[^$]+\$|\\\[.*?\\\])'
-    parts = re.split(pattern, text)
-    
-    for part in parts:
-        if not part:
-            continue
-        
+    text = strip_html(text)
+
+    for kind, part in iter_segments(text):
         # Phần LaTeX
-        if part.startswith('$') or part.startswith('\\['):
+        if kind == SEG_MATH or kind == SEG_DISPLAY_MATH:
             try:
                 latex_expr = clean_latex_math(part)
                 insert_equation_into_paragraph(latex_expr, paragraph)
@@ -171,28 +166,19 @@ def process_text_with_latex(text, paragraph, bold=False):
                 # Fallback: thêm text thuần
                 run = paragraph.add_run(part)
                 run.bold = is_entirely_bold
+        # Phần **in đậm**
+        elif kind == SEG_BOLD:
+            run = paragraph.add_run(part)
+            run.bold = True
         # Phần text thường
         else:
-            # cleaned_part = re.sub(r'^\s*/', '', part)
-            # run = paragraph.add_run(cleaned_part)
-            # if bold:
-            #     run.bold = True
-            sub_parts = re.split(r'(\*\*.*?\*\*)', part)
-            for sp in sub_parts:
-                sp_clean = sanitize_xml_string(sp)
-                if not sp_clean: 
-                    continue
-                if sp.startswith("**") and sp.endswith("**"):
-                    run = paragraph.add_run(sp[2:-2])
-                    run.bold = True
-                else:
-                    run = paragraph.add_run(sp)
-                    run.bold = is_entirely_bold
+            run = paragraph.add_run(part)
+            run.bold = is_entirely_bold
 
 
 def insert_equation_into_paragraph(latex_math_dollar, paragraph):
     """Chèn công thức toán học vào paragraph"""
-    omml_str = latex_to_omml_via_pandoc(latex_math_dollar)
+    omml_str = get_equation_cache(get_app_path()).get_or_convert(latex_math_dollar, latex_to_omml_via_pandoc)
     
     if not omml_str:
         # Fallback: Thêm text thuần nếu không convert được
@@ -208,6 +194,11 @@ def insert_equation_into_paragraph(latex_math_dollar, paragraph):
             count=1
         )
     
+    # Backend ghi XML trực tiếp: chèn nguyên chuỗi OMML
+    if isinstance(paragraph, OoxmlParagraph):
+        paragraph.add_omml(omml_str)
+        return
+
     try:
         omml_element = parse_xml(omml_str)
         run = paragraph.add_run()
@@ -220,36 +211,8 @@ def insert_equation_into_paragraph(latex_math_dollar, paragraph):
 def clean_latex_math(latex_raw):
     latex_raw = latex_raw.lstrip('$').rstrip('$')
     latex_raw = latex_raw.strip()
-    latex_raw = re.sub(r'(?<!\\)%', r'\%', latex_raw)
-    latex_raw = re.sub(r'\\/', '', latex_raw)
-    latex_raw = re.sub(r'\\operatorname\s*{\s*([^}]*)\s*}',
-                       lambda m: m.group(1).replace(' ', ''), latex_raw)
-    latex_raw = re.sub(r'\\root\s*(\d+)\s*{([^}]*)}', r'\\sqrt[\1]{\2}', latex_raw)
-    latex_raw = re.sub(r'\\root\s*{(\d+)}\s*\\of\s*{([^}]*)}', r'\\sqrt[\1]{\2}', latex_raw)
-    latex_raw = re.sub(r'\\root\s*(\d+)\s*\\sqrt\s*{([^}]*)}', r'\\sqrt[\1]{\2}', latex_raw)
-    latex_raw = re.sub(r'([a-zA-Z])\s*\\frac\s*{([^}]+)}\s*{([^}]+)}',
-                       r'\1^{\\frac{\2}{\3}}', latex_raw)
-    latex_raw = re.sub(r'\\sp\s*{([^}]*)}', r'^{\1}', latex_raw)
-    latex_raw = re.sub(r'{\\bf\s*([^}]*)}', r'\1', latex_raw)
-    latex_raw = re.sub(r'\\\s*log', r'\\log', latex_raw)
-    latex_raw = re.sub(r'\\bigskip', '', latex_raw)
-    latex_raw = re.sub(r'\\nonumber', '', latex_raw)
-    latex_raw = latex_raw.replace(r'\?', '?')
-    latex_raw = re.sub(r'\\cdot\s*(?=\w)', r'\\cdot ', latex_raw)
-    latex_raw = latex_raw.replace(r'\dotstan', r'\cdot \tan')
-    latex_raw = re.sub(r'(?<!\\)(\bln\b|\blog\b|\bsin\b|\bcos\b|\btan\b|\blog_{?\d*}?)',
-                       r'\\\1', latex_raw)
-    latex_raw = re.sub(r'(\\Leftrightarrow|\\Rightarrow|\\rightarrow)(?=\w)', r'\1 ', latex_raw)
-    latex_raw = latex_raw.replace(r'\\n', r'\n')
-    
-    latex_raw = latex_raw.strip()
-    # ✅ KHÁC BIỆT: Version cũ KHÔNG replace \n và \r
-    # latex_raw = latex_raw.replace('\n', ' ').replace('\r', '')  # ← XÓA DÒNG NÀY
-    
-    if not (latex_raw.startswith('$') and latex_raw.endswith('$')):
-        latex_raw = f"${latex_raw}$"
-    
-    return latex_raw
+    latex_raw = _UNESCAPED_PERCENT_RE.sub(r'\%', latex_raw)
+    return clean_latex_body(latex_raw)
 
 def ensure_output_folder_for_batch(batch_name):
     """Tạo folder riêng cho batch"""
@@ -264,44 +227,45 @@ def ensure_output_folder_for_batch(batch_name):
     return batch_folder
 
 def save_document_securely(doc, batch_name, file_name):
-    """Lưu file DOCX với thread-safety"""
+    """Lưu file DOCX: serialize ra bộ nhớ ngoài mọi khóa, chỉ khóa đúng file đích khi ghi"""
     batch_folder = ensure_output_folder_for_batch(batch_name)
     if not batch_folder:
         return None
 
     output_path = os.path.join(batch_folder, f"{file_name}.docx")
-    
-    with _FILE_LOCK:
-        max_retries = 3
-        for retry_count in range(max_retries):
-            try:
-                doc.save(output_path)
-                if os.path.exists(output_path):
-                    file_size = os.path.getsize(output_path)
-                    print(f"✅ Đã lưu file: {output_path}")
-                    return output_path
-            except Exception as e:
-                print(f"⚠️ Lỗi lưu file lần {retry_count + 1}: {e}")
-                if retry_count < max_retries - 1:
-                    time.sleep(1)
-        
-        print(f"❌ Không thể lưu file sau {max_retries} lần thử")
+
+    try:
+        buffer = BytesIO()
+        doc.save(buffer)
+        docx_bytes = buffer.getvalue()
+    except Exception as e:
+        print(f"❌ Lỗi tạo nội dung DOCX: {e}")
         return None
+
+    max_retries = 3
+    try:
+        atomic_write_bytes(output_path, docx_bytes, max_retries=max_retries, retry_delay=1)
+    except Exception as e:
+        print(f"❌ Không thể lưu file sau {max_retries} lần thử: {e}")
+        return None
+    print(f"✅ Đã lưu file: {output_path}")
+    return output_path
+
 def save_json_securely(data, batch_name, file_name):
-    """Lưu file JSON với thread-safety"""
+    """Lưu file JSON: dump ngoài khóa, ghi nguyên tử theo khóa của riêng file này"""
     batch_folder = ensure_output_folder_for_batch(batch_name)
     if not batch_folder: return None
 
     output_path = os.path.join(batch_folder, f"{file_name}.json")
-    with _FILE_LOCK:
-        try:
-            with open(output_path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            print(f"✅ Đã lưu file JSON: {output_path}")
-            return output_path
-        except Exception as e:
-            print(f"❌ Lỗi lưu file JSON: {e}")
-            return None
+    try:
+        json_bytes = fast_json.dumps_bytes(data)
+        atomic_write_bytes(output_path, json_bytes)
+        print(f"✅ Đã lưu file JSON: {output_path}")
+        return output_path
+    except Exception as e:
+        print(f"❌ Lỗi lưu file JSON: {e}")
+        return None
+
 def generate_or_get_image(hinh_anh_data: Dict, target_key: str = "mo_ta") -> tuple:
     """
     Sinh ảnh từ data (STRICT MODE). 
@@ -320,8 +284,14 @@ def generate_or_get_image(hinh_anh_data: Dict, target_key: str = "mo_ta") -> tup
     # 3. Xác định ngôn ngữ
     lang_code = "en" if target_key == "mo_ta_en" else "vi"
 
-    # 4. Gọi API sinh ảnh
+    # 4. Gọi API sinh ảnh (ảnh đã sinh trước đó lấy lại từ cache)
     if loai == "tu_mo_ta" and mo_ta:
+        image_cache = get_image_cache(get_app_path())
+        cached_bytes = image_cache.get(mo_ta, lang_code)
+        if cached_bytes:
+            return cached_bytes, None
+        if not image_generation_allowed():
+            return None, f"🖼️ [{lang_code.upper()}: Chưa có ảnh đã sinh: {mo_ta}]"
         try:
             from modules.common.text2Image import generate_image_from_text
             
@@ -329,6 +299,7 @@ def generate_or_get_image(hinh_anh_data: Dict, target_key: str = "mo_ta") -> tup
             image_bytes = generate_image_from_text(mo_ta, lang=lang_code)
             
             if image_bytes:
+                image_cache.put(mo_ta, image_bytes, lang_code)
                 time.sleep(5)
                 return image_bytes, None
             else:
@@ -879,11 +850,13 @@ class DynamicDocxRenderer:
                 else:
                     self.render_question_trac_nghiem(cau)
 
+_CODE_FENCE_RE = re.compile(r'```json|```')
+
 def clean_json_response(text):
     """Làm sạch chuỗi trả về từ AI, loại bỏ markdown và ký tự thừa"""
     try:
         # Loại bỏ các tag ```json hoặc ``` nếu có
-        clean_text = re.sub(r'```json|```', '', text).strip()
+        clean_text = _CODE_FENCE_RE.sub('', text).strip()
         return clean_text
     except Exception:
         return text
@@ -904,9 +877,10 @@ def roman_to_int(s):
     if s in fast_map: return fast_map[s]
     return None
 
-def renumber_ma_dang_global(all_questions, reference_ma_bai):
+def renumber_ma_dang_global(all_questions, reference_ma_bai, keep_stt=False):
     """
     [SPECIALIZED FUNCTION FOR DUNG_SAI ONLY]
+    (Các dạng khác chỉ dùng với keep_stt=True để nối mã dạng giữa các batch, xem normalize_batched_ma_dang)
     Logic: 
     1. Bỏ qua ID Mục/Phần.
     2. Chỉ đếm ID Dạng tăng dần (Global Counter).
@@ -927,7 +901,8 @@ def renumber_ma_dang_global(all_questions, reference_ma_bai):
 
     for index, q in enumerate(all_questions):
         # 1. Cập nhật STT chuẩn (cho chắc chắn)
-        q['stt'] = index + 1
+        if not keep_stt:
+            q['stt'] = index + 1
         
         # 2. Lấy dữ liệu phân cấp
         raw_phan = q.get("phan", [])
@@ -962,67 +937,204 @@ def renumber_ma_dang_global(all_questions, reference_ma_bai):
     print(f"   ✅ [DungSai] Đã map {global_dang_counter} dạng bài duy nhất.")
     return final_questions
 
-def process_dung_sai_smart_batch(file_path, base_prompt, file_name, project_id, creds, model_name, batch_name):
-    from modules.common.callAPI import VertexClient
-    import re
-    import time
-    
-    client = VertexClient(project_id, creds, model_name)
+def salvage_questions_from_broken_json(broken_text):
+    """Cứu các object câu hỏi còn nguyên ({"stt": ...}) trong JSON bị lỗi (Smart Stream Scanner)"""
+    questions = []
+    try:
+        text = clean_json_response(broken_text)
+        # Regex tìm vị trí bắt đầu các object câu hỏi ({"stt": ...)
+        for match in _SALVAGE_START_RE.finditer(text):
+            start_idx = match.start()
+            # Thuật toán cân bằng ngoặc để tìm điểm kết thúc
+            balance = 0
+            end_idx = -1
+            in_string = False
+            escape = False
+
+            for i in range(start_idx, len(text)):
+                char = text[i]
+                if in_string:
+                    if char == '\\' and not escape: escape = True
+                    elif char == '"' and not escape: in_string = False; escape = False
+                    else: escape = False
+                else:
+                    if char == '"': in_string = True
+                    elif char == '{': balance += 1
+                    elif char == '}':
+                        balance -= 1
+                        if balance == 0:
+                            end_idx = i + 1
+                            break
+
+            if end_idx != -1:
+                try:
+                    q_obj = fast_json.loads(text[start_idx:end_idx])
+                    if "stt" in q_obj: questions.append(q_obj)
+                except: pass
+    except: pass
+    return questions
+
+def _parse_total_questions(prompt, default=40):
+    """Đọc tong_so_cau (tổng số câu yêu cầu) trong prompt người dùng"""
+    match_total = _TOTAL_QUESTIONS_RE.search(prompt or "")
+    return int(match_total.group(1)) if match_total else default
+
+def parse_ai_json(raw_text):
+    """Parse phản hồi AI; lỗi cú pháp thì thử sửa cục bộ (json_repair), cuối cùng cứu từng câu. Returns: dict hoặc None"""
+    if not raw_text:
+        return None
+    clean_text = clean_json_response(raw_text)
+    try:
+        return fast_json.loads(clean_text)
+    except json.JSONDecodeError:
+        data, _ = json_repair.repair_json(clean_text)
+        if data is not None:
+            return data
+        questions = salvage_questions_from_broken_json(raw_text)
+        return {"cau_hoi": questions} if questions else None
+
+async def regenerate_invalid_questions(client, file_path, prompt, schema, questions, label, ignore_fields=()):
+    """
+    Kiểm tra từng câu theo schema; chỉ yêu cầu AI sinh lại các khoảng STT bị lỗi (1 lượt, song song).
+    Câu sinh lại không được / vẫn lỗi thì giữ bản gốc (ghi rõ trong log): không bao giờ trả về
+    ít câu hơn số câu parse được.
+    """
+    valid, invalid = schema_validator.split_questions(questions, schema, ignore_fields)
+    if not invalid:
+        return questions
 
-    # ==============================================================================
-    # 0. HÀM PHỤ: CỨU DỮ LIỆU JSON (Smart Stream Scanner)
-    # ==============================================================================
-    def salvage_questions_from_broken_json(broken_text):
-        questions = []
+    for _, errors in invalid:
+        print(f"      ⚠️ [{label}] {'; '.join(errors[:3])}")
+    bad_stts = [q["stt"] for q, _ in invalid if isinstance(q, dict) and isinstance(q.get("stt"), int)]
+    ranges = schema_validator.stt_ranges(bad_stts)
+    if not ranges:
+        print(f"      ⚠️ [{label}] Giữ nguyên {len(invalid)} câu lỗi không có STT")
+        return questions
+    print(f"      🔁 [{label}] Sinh lại {len(bad_stts)} câu lỗi (STT {schema_validator.format_ranges(ranges)})...")
+
+    async def regenerate(start, end):
+        instruction = f"""
+{prompt}
+--------------------------------------------------------------------------------
+LỆNH SINH LẠI: CHỈ sinh các câu có STT từ {start} đến {end} (giữ đúng các STT này).
+Các câu khác đã có, KHÔNG sinh lại. Điền ĐẦY ĐỦ mọi trường bắt buộc.
+--------------------------------------------------------------------------------
+"""
         try:
-            text = clean_json_response(broken_text)
-            # Regex tìm vị trí bắt đầu các object câu hỏi ({"stt": ...)
-            start_pattern = re.compile(r'\{\s*[\'"]stt[\'"]\s*:', re.IGNORECASE)
-            
-            for match in start_pattern.finditer(text):
-                start_idx = match.start()
-                # Thuật toán cân bằng ngoặc để tìm điểm kết thúc
-                balance = 0
-                end_idx = -1
-                in_string = False
-                escape = False
-                
-                for i in range(start_idx, len(text)):
-                    char = text[i]
-                    if in_string:
-                        if char == '\\' and not escape: escape = True
-                        elif char == '"' and not escape: in_string = False; escape = False
-                        else: escape = False
-                    else:
-                        if char == '"': in_string = True
-                        elif char == '{': balance += 1
-                        elif char == '}':
-                            balance -= 1
-                            if balance == 0:
-                                end_idx = i + 1
-                                break
-                
-                if end_idx != -1:
-                    try:
-                        q_obj = json.loads(text[start_idx:end_idx])
-                        if "stt" in q_obj: questions.append(q_obj)
-                    except: pass
-        except: pass
+            raw_text = await client.send_data_to_AI(instruction, file_path, response_schema=schema, max_output_tokens=65534)
+        except Exception as e:
+            print(f"      ❌ [{label}] Lỗi sinh lại STT {start}-{end}: {e}")
+            return []
+        data = parse_ai_json(raw_text)
+        items = data.get("cau_hoi", []) if isinstance(data, dict) else []
+        return [q for q in items if isinstance(q, dict) and isinstance(q.get("stt"), int) and start <= q["stt"] <= end]
+
+    results = await asyncio.gather(*(regenerate(start, end) for start, end in ranges))
+    fixed, _ = schema_validator.split_questions([q for batch in results for q in batch], schema, ignore_fields)
+
+    known_stts = {q["stt"] for q in valid}
+    replacements = {}
+    for q in fixed:
+        if q["stt"] not in known_stts:
+            replacements.setdefault(q["stt"], q)
+    missing = sorted(set(bad_stts) - set(replacements))
+    print(f"      ✅ [{label}] Đã thay {len(replacements)}/{len(bad_stts)} câu lỗi")
+    if missing:
+        print(f"      ⚠️ [{label}] Giữ bản gốc {len(missing)} câu chưa sinh lại được: "
+              f"STT {schema_validator.format_ranges(schema_validator.stt_ranges(missing))}")
+    # Thay tại chỗ: câu lỗi có bản thay thì dùng bản mới, còn lại giữ nguyên thứ tự và số câu gốc
+    return [replacements.pop(q["stt"]) if isinstance(q, dict) and isinstance(q.get("stt"), int)
+            and q["stt"] in replacements else q
+            for q in questions]
+
+GAP_FILL_BATCH_SIZE = 5       # Mỗi request bổ sung tối đa 5 câu (phản hồi ngắn, ít bị cắt)
+GAP_FILL_ROUNDS = 2           # Số lượt bù (lượt 2 chỉ cho các câu lượt 1 vẫn thiếu)
+GAP_FILL_CACHE_MIN_REQUESTS = 2  # Từ 2 request bổ sung trở lên mới đáng tạo context cache
+
+async def fill_missing_questions(client, file_path, prompt, schema, questions, total_questions, label,
+                                 ignore_fields=()):
+    """
+    So STT đã có với tong_so_cau, chỉ yêu cầu AI sinh các STT còn thiếu (mỗi request <= 5 câu, song song).
+    Tài liệu được đưa vào context cache 1 lần để các request bổ sung chỉ gửi prompt ngắn
+    (không tạo được cache thì gửi kèm tài liệu như thường).
+    Returns: danh sách câu đã bù, sắp theo STT
+    """
+    by_stt = {}
+    extras = []
+    for q in questions:
+        stt = q.get("stt") if isinstance(q, dict) else None
+        if isinstance(stt, int) and 1 <= stt <= total_questions and stt not in by_stt:
+            by_stt[stt] = q
+        else:
+            extras.append(q)
+    missing = [stt for stt in range(1, total_questions + 1) if stt not in by_stt]
+    if not missing:
         return questions
 
-    # ==============================================================================
-    # 1. PARSER CẤU HÌNH (Level Parser V3.1)
-    # ==============================================================================
-    total_questions = 40
-    match_total = re.search(r'["\']?tong_so_cau["\']?\s*[:=]\s*(\d+)', base_prompt)
-    if match_total: total_questions = int(match_total.group(1))
-    
-    config_levels = {"nhan_biet": 0, "thong_hieu": 0, "van_dung": 0, "van_dung_cao": 0}
+    cache_name = None
+    try:
+        for round_idx in range(GAP_FILL_ROUNDS):
+            if not missing:
+                break
+            chunks = [missing[i:i + GAP_FILL_BATCH_SIZE] for i in range(0, len(missing), GAP_FILL_BATCH_SIZE)]
+            print(f"      🧩 [{label}] Thiếu {len(missing)}/{total_questions} câu "
+                  f"(STT {schema_validator.format_ranges(schema_validator.stt_ranges(missing))}), "
+                  f"bù lượt {round_idx + 1}: {len(chunks)} request")
+            if cache_name is None and len(chunks) >= GAP_FILL_CACHE_MIN_REQUESTS:
+                cache_name = await client.create_context_cache(file_path) or ""
+
+            async def request_chunk(stts):
+                instruction = f"""
+{prompt}
+--------------------------------------------------------------------------------
+LỆNH BỔ SUNG: CHỈ sinh đúng {len(stts)} câu có STT: {", ".join(map(str, stts))} (giữ đúng các STT này).
+Các câu khác đã có, KHÔNG sinh lại. Điền ĐẦY ĐỦ mọi trường bắt buộc.
+--------------------------------------------------------------------------------
+"""
+                try:
+                    if cache_name:
+                        raw_text = await client.send_data_to_AI(instruction, response_schema=schema,
+                                                                max_output_tokens=65534, cached_content=cache_name)
+                    else:
+                        raw_text = await client.send_data_to_AI(instruction, file_path, response_schema=schema,
+                                                                max_output_tokens=65534)
+                except Exception as e:
+                    print(f"      ❌ [{label}] Lỗi bù STT {stts[0]}-{stts[-1]}: {e}")
+                    return []
+                data = parse_ai_json(raw_text)
+                items = data.get("cau_hoi", []) if isinstance(data, dict) else []
+                wanted = set(stts)
+                return [q for q in items if isinstance(q, dict) and q.get("stt") in wanted]
+
+            results = await asyncio.gather(*(request_chunk(chunk) for chunk in chunks))
+            valid, _ = schema_validator.split_questions([q for batch in results for q in batch], schema, ignore_fields)
+            for q in valid:
+                by_stt.setdefault(q["stt"], q)
+            missing = [stt for stt in missing if stt not in by_stt]
+    finally:
+        if cache_name:
+            await client.delete_context_cache(cache_name)
+
+    if missing:
+        print(f"      ❌ [{label}] Vẫn thiếu {len(missing)} câu: STT {schema_validator.format_ranges(schema_validator.stt_ranges(missing))}")
+    else:
+        print(f"      ✅ [{label}] Đã bù đủ {total_questions} câu")
+    return [by_stt[stt] for stt in sorted(by_stt)] + extras
+
+LEVEL_KEYS = ("nhan_biet", "thong_hieu", "van_dung", "van_dung_cao")
+LEVEL_LABELS = {"nhan_biet": "NHẬN BIẾT", "thong_hieu": "THÔNG HIỂU", "van_dung": "VẬN DỤNG", "van_dung_cao": "VẬN DỤNG CAO"}
+
+def parse_level_config(prompt):
+    """
+    Level Parser V3.1: số câu mỗi mức độ khai báo trong prompt.
+    Returns: {"nhan_biet": n, ...} hoặc None nếu prompt không khai báo
+    """
+    config_levels = dict.fromkeys(LEVEL_KEYS, 0)
     found_config = False
-    
+
     # Priority 1: Key-Value
     for key in config_levels:
-        match = re.search(f"(?:sl_|so_cau_){key}\\s*[:=]\\s*(\\d+)", base_prompt, re.IGNORECASE)
+        match = re.search(f"(?:sl_|so_cau_){key}\\s*[:=]\\s*(\\d+)", prompt, re.IGNORECASE)
         if match:
             config_levels[key] = int(match.group(1))
             found_config = True
@@ -1037,7 +1149,7 @@ def process_dung_sai_smart_batch(file_path, base_prompt, file_name, project_id,
             ("nhan_biet",    ["NHẬN BIẾT", "MỨC 1"])
         ]
         range_pattern = r"(?:từ câu|câu)\s*(\d+)\s*(?:đến câu|-|đến)\s*(\d+)"
-        lines = base_prompt.split('\n')
+        lines = prompt.split('\n')
         for line in lines:
             line_upper = line.upper()
             matched_key = None
@@ -1055,8 +1167,129 @@ def process_dung_sai_smart_batch(file_path, base_prompt, file_name, project_id,
                         config_levels[matched_key] += count
                         found_config = True
 
+    return config_levels if found_config else None
+
+def describe_levels_for_range(config_levels, start, end):
+    """Mức độ của các STT start..end theo cấu hình toàn đề, VD: "NHẬN BIẾT (câu 31-40), THÔNG HIỂU (câu 41-45)" """
+    parts = []
+    level_start = 1
+    for key in LEVEL_KEYS:
+        level_end = level_start + config_levels.get(key, 0) - 1
+        lo, hi = max(start, level_start), min(end, level_end)
+        if lo <= hi:
+            parts.append(f"{LEVEL_LABELS[key]} (câu {lo}-{hi}, \"muc_do\": \"{key}\")")
+        level_start = level_end + 1
+    return ", ".join(parts)
+
+def normalize_batched_ma_dang(questions):
+    """
+    Mỗi batch tự đếm ID dạng từ 1 -> sau khi gộp, đánh lại ma_dang / phan toàn cục theo tên dạng (phan[2]).
+    Prompt để trống ma_dang (chỉ Tiếng Việt) -> giữ nguyên, không tự đặt mã.
+    """
+    reference_ma_bai = None
+    for q in questions:
+        parts = str(q.get("ma_dang") or "").split("_")
+        if len(parts) > 2:
+            reference_ma_bai = "_".join(parts[:-1])
+            break
+    if not reference_ma_bai:
+        return questions
+    return renumber_ma_dang_global(questions, reference_ma_bai, keep_stt=True)
+
+async def request_question_batches(client, file_path, prompt, schema, ranges, question_type, language_mode, model_name, sizer,
+                                   level_config=None):
+    """
+    Gửi song song các batch STT (ranges từ BatchSizer.plan_batches; [None] = 1 request cho cả đề),
+    ghi token/câu thực đo vào BatchSizer. Returns: dict JSON đã gộp hoặc None
+    level_config: số câu mỗi mức độ của cả đề (parse_level_config) -> mỗi batch được báo mức độ của riêng nó
+    """
+    total = ranges[-1][1] if ranges[-1] else None
+
+    async def request_one(idx, stt_range):
+        instruction = prompt
+        if stt_range:
+            start, end = stt_range
+            print(f"   ► [{question_type}] Batch {idx+1}/{len(ranges)}: Câu {start}-{end}")
+            level_line = ""
+            if level_config:
+                level_line = f"\n2. MỨC ĐỘ CỦA BATCH NÀY: {describe_levels_for_range(level_config, start, end)}."
+            instruction = f"""
+{prompt}
+--------------------------------------------------------------------------------
+LỆNH THỰC THI BATCH {idx+1}/{len(ranges)} (đề đầy đủ {total} câu được chia nhiều lần gửi):
+1. PHẠM VI STT: {start}-{end} (CHỈ sinh các câu này, giữ đúng STT; số câu / mức độ của cả đề ở trên chỉ để tham chiếu).{level_line}
+--------------------------------------------------------------------------------
+"""
+        try:
+            raw_text, usage = await client.send_data_to_AI(
+                instruction, file_path, response_schema=schema, max_output_tokens=65534, return_usage=True
+            )
+        except Exception as e:
+            print(f"      ❌ [{question_type}] Lỗi batch {idx+1}: {e}")
+            return None
+        data = parse_ai_json(raw_text)
+        if isinstance(data, dict) and isinstance(data.get("cau_hoi"), list):
+            sizer.record(question_type, language_mode, model_name, usage, len(data["cau_hoi"]))
+            if usage.get("truncated"):
+                print(f"      ✂️ [{question_type}] Batch {idx+1} bị cắt (MAX_TOKENS), lần sau sẽ chia batch nhỏ hơn")
+            return data
+        return None
+
+    results = await asyncio.gather(*(request_one(idx, stt_range) for idx, stt_range in enumerate(ranges)))
+
+    merged = None
+    questions = []
+    for data in results:
+        if not data:
+            continue
+        if merged is None:
+            merged = {key: value for key, value in data.items() if key != "cau_hoi"}
+        questions.extend(q for q in data["cau_hoi"] if isinstance(q, dict))
+    if merged is None:
+        return None
+    if len(ranges) > 1:
+        questions.sort(key=lambda q: q["stt"] if isinstance(q.get("stt"), int) else float("inf"))
+        merged["tong_so_cau"] = ranges[-1][1]
+    merged["cau_hoi"] = questions
+    return merged
+
+_DUNG_SAI_PHAN_NOISE = ["nhận biết", "thong_hieu", "vận dụng", "mức độ", "level", "nhan_biet", "thong_hieu", "van_dung", "slot"]
+
+def _postprocess_dung_sai_questions(questions, t_nb, t_th, t_vd):
+    """Bỏ tên mức độ khỏi "phan" và ép muc_do theo STT (ngưỡng tích lũy NB / TH / VD)"""
+    for q in questions:
+        # Clean Phan
+        raw_phan = q.get("phan", [])
+        if isinstance(raw_phan, list):
+            clean_phan = [str(p) for p in raw_phan if not any(kw in str(p).lower() for kw in _DUNG_SAI_PHAN_NOISE)]
+            if len(clean_phan) >= 3: q['phan'] = clean_phan
+
+        # Force Level
+        stt = q.get("stt", 0)
+        if stt <= t_nb: q['muc_do'] = "nhan_biet"
+        elif stt <= t_th: q['muc_do'] = "thong_hieu"
+        elif stt <= t_vd: q['muc_do'] = "van_dung"
+        else: q['muc_do'] = "van_dung_cao"
+
+def process_dung_sai_smart_batch(file_path, base_prompt, file_name, project_id, creds, model_name, batch_name, use_text_layer=False):
+    from modules.common.callAPI import AsyncVertexClient, get_async_runner
+    import re
+    import time
+    
+    client = AsyncVertexClient(project_id, creds, model_name, use_text_layer=use_text_layer)
+    runner = get_async_runner()
+
+    # ==============================================================================
+    # 1. PARSER CẤU HÌNH (Level Parser V3.1)
+    # ==============================================================================
+    total_questions = _parse_total_questions(base_prompt)
+    
+    config_levels = parse_level_config(base_prompt)
+    found_config = config_levels is not None
+
     # Fallback mặc định
     if not found_config:
+        config_levels = {"nhan_biet": 0, "thong_hieu": 0, "van_dung": 0, "van_dung_cao": 0}
         config_levels["nhan_biet"] = int(total_questions * 0.4) 
         config_levels["thong_hieu"] = int(total_questions * 0.3)
         config_levels["van_dung"] = int(total_questions * 0.3)
@@ -1071,13 +1304,12 @@ def process_dung_sai_smart_batch(file_path, base_prompt, file_name, project_id,
     print(f"\n[DungSai V3.5 Stable] Tổng: {total_questions} câu. (NB:{config_levels['nhan_biet']}, TH:{config_levels['thong_hieu']}, VD:{config_levels['van_dung']}, VDC:{config_levels['van_dung_cao']})")
     
     # ==============================================================================
-    # 2. CHIA BATCH (BATCH_SIZE = 10)
+    # 2. CHIA BATCH (số câu/batch theo token/câu thực đo của các lần chạy trước)
     # ==============================================================================
-    BATCH_SIZE = 10  # <--- CHÌA KHÓA AN TOÀN CỦA BẠN LÀ Ở ĐÂY
+    sizer = get_batch_sizer(get_app_path())
+    language_mode = detect_language_mode(base_prompt)
     batches = []
-    current_start = 1
-    while current_start <= total_questions:
-        current_end = min(current_start + BATCH_SIZE - 1, total_questions)
+    for current_start, current_end in sizer.plan_batches(total_questions, "dung_sai", language_mode, model_name):
         mid_point = (current_start + current_end) / 2
         
         if mid_point <= t_nb: mode_desc = "NHẬN BIẾT"
@@ -1086,15 +1318,14 @@ def process_dung_sai_smart_batch(file_path, base_prompt, file_name, project_id,
         else: mode_desc = "VẬN DỤNG CAO"
             
         batches.append({"range": f"{current_start}-{current_end}", "desc": mode_desc})
-        current_start += BATCH_SIZE
 
     # ==============================================================================
-    # 3. THỰC THI (CÓ SALVAGE)
+    # 3. THỰC THI (CÓ SALVAGE) - Gửi tất cả batch song song qua event loop
     # ==============================================================================
     all_raw_questions = []
     reference_ma_bai = "SN_UNK" 
 
-    for idx, batch in enumerate(batches):
+    async def request_batch(idx, batch):
         print(f"   ► Batch {idx+1}/{len(batches)}: Câu {batch['range']} [{batch['desc']}]")
         
         batch_instruction = f"""
@@ -1108,20 +1339,20 @@ LỆNH THỰC THI BATCH {idx+1}/{len(batches)}:
 """
         max_retries = 2
         retry_count = 0
-        success = False
         
-        while retry_count < max_retries and not success:
+        while retry_count < max_retries:
             try:
-                raw_text = client.send_data_to_AI(batch_instruction, file_path, response_schema=schema_dung_sai, max_output_tokens=65534)
+                raw_text, usage = await client.send_data_to_AI(
+                    batch_instruction, file_path, response_schema=schema_dung_sai, max_output_tokens=65534, return_usage=True
+                )
                 if not raw_text: 
                     print(f"      ⚠️ AI trả về rỗng. Thử lại...")
                     retry_count += 1
                     continue
 
-                batch_questions = []
                 try:
                     clean_text = clean_json_response(raw_text)
-                    data = json.loads(clean_text)
+                    data = fast_json.loads(clean_text)
                     batch_questions = data.get("cau_hoi", [])
                     print(f"      ✅ Batch {idx+1} OK: {len(batch_questions)} câu.")
                 except json.JSONDecodeError:
@@ -1131,36 +1362,38 @@ LỆNH THỰC THI BATCH {idx+1}/{len(batches)}:
                         print(f"      🚑 ĐÃ CỨU: {len(batch_questions)} câu.")
                     else:
                         raise Exception("Không cứu được câu nào.")
-
-                # POST-PROCESSING
-                keywords_to_remove = ["nhận biết", "thong_hieu", "vận dụng", "mức độ", "level", "nhan_biet", "thong_hieu", "van_dung", "slot"]
-                for q in batch_questions:
-                    # Clean Phan
-                    raw_phan = q.get("phan", [])
-                    if isinstance(raw_phan, list):
-                        clean_phan = [str(p) for p in raw_phan if not any(kw in str(p).lower() for kw in keywords_to_remove)]
-                        if len(clean_phan) >= 3: q['phan'] = clean_phan
-                    
-                    # Force Level
-                    stt = q.get("stt", 0)
-                    if stt <= t_nb: q['muc_do'] = "nhan_biet"
-                    elif stt <= t_th: q['muc_do'] = "thong_hieu"
-                    elif stt <= t_vd: q['muc_do'] = "van_dung"
-                    else: q['muc_do'] = "van_dung_cao"
-
-                if reference_ma_bai == "SN_UNK" and len(batch_questions) > 0:
-                    q0 = batch_questions[0]
-                    raw_ma_dang = q0.get("ma_dang", "")
-                    if raw_ma_dang:
-                        parts = raw_ma_dang.split("_")
-                        if len(parts) > 2: reference_ma_bai = "_".join(parts[:-1])
-
-                all_raw_questions.extend(batch_questions)
-                success = True 
+                sizer.record("dung_sai", language_mode, model_name, usage, len(batch_questions))
+                # muc_do được ép lại theo STT ở bước post-processing nên không tính lỗi
+                return await regenerate_invalid_questions(
+                    client, file_path, batch_instruction, schema_dung_sai, batch_questions,
+                    f"Batch {idx+1}", ignore_fields=("muc_do",)
+                )
 
             except Exception as e:
                 retry_count += 1
                 print(f"      ❌ Lỗi Batch {idx+1} (Lần {retry_count}): {e}")
+        return []
+
+    # Các batch chạy đồng thời, kết quả vẫn gom theo đúng thứ tự batch
+    batch_futures = [runner.submit(request_batch(idx, batch)) for idx, batch in enumerate(batches)]
+
+    for future in batch_futures:
+        all_raw_questions.extend(future.result())
+
+    # Bù các STT còn thiếu (batch hỏng hẳn / salvage chỉ cứu được 1 phần)
+    all_raw_questions = runner.run(fill_missing_questions(
+        client, file_path, base_prompt, schema_dung_sai, all_raw_questions, total_questions,
+        "DungSai", ignore_fields=("muc_do",)
+    ))
+
+    # POST-PROCESSING
+    _postprocess_dung_sai_questions(all_raw_questions, t_nb, t_th, t_vd)
+    for q in all_raw_questions:
+        raw_ma_dang = q.get("ma_dang", "")
+        if raw_ma_dang:
+            parts = raw_ma_dang.split("_")
+            if len(parts) > 2: reference_ma_bai = "_".join(parts[:-1])
+            break
 
     if not all_raw_questions: return None
     
@@ -1174,7 +1407,8 @@ LỆNH THỰC THI BATCH {idx+1}/{len(batches)}:
         "cau_hoi": final_questions
     }
 
-def response2docx_flexible(file_path, prompt, file_name, project_id, creds, model_name, question_type="trac_nghiem_4_dap_an", batch_name=None):
+def response2docx_flexible(file_path, prompt, file_name, project_id, creds, model_name, question_type="trac_nghiem_4_dap_an", batch_name=None,
+                           use_text_layer=False, fast_docx=False):
     if not batch_name:
         batch_name = file_name.replace("_TN", "").replace("_DS", "").replace("_TLN", "")
         
@@ -1184,25 +1418,46 @@ def response2docx_flexible(file_path, prompt, file_name, project_id, creds, mode
         # 1. LOGIC RIÊNG CHO ĐÚNG/SAI (Có can thiệp code renumber)
         if question_type == "dung_sai":
             final_json_data = process_dung_sai_smart_batch(
-                file_path, prompt, file_name, project_id, creds, model_name, batch_name
+                file_path, prompt, file_name, project_id, creds, model_name, batch_name,
+                use_text_layer=use_text_layer
             )
 
         # 2. LOGIC CHO CÁC DẠNG KHÁC (Tuyệt đối tin tưởng Prompt AI, không renumber)
         else:
-            from modules.common.callAPI import VertexClient
-            client = VertexClient(project_id, creds, model_name)
+            from modules.common.callAPI import AsyncVertexClient, get_async_runner
+            client = AsyncVertexClient(project_id, creds, model_name, use_text_layer=use_text_layer)
             target_schema = get_schema_by_type(question_type)
             final_prompt = PromptBuilder.wrap_user_prompt(prompt)
             
-            print(f"📤 [{question_type}] Đang gửi request (1-shot)...")
-            ai_response_text = client.send_data_to_AI(
-                final_prompt, file_path, response_schema=target_schema, max_output_tokens=65534
-            )
-            
-            if ai_response_text:
-                final_json_data = json.loads(clean_json_response(ai_response_text))
+            # Biết tổng số câu -> chia batch theo token/câu thực đo; không biết -> 1 request như cũ
+            sizer = get_batch_sizer(get_app_path())
+            language_mode = detect_language_mode(prompt)
+            total_questions = _parse_total_questions(prompt, default=None)
+            ranges = [None]
+            if total_questions:
+                ranges = sizer.plan_batches(total_questions, question_type, language_mode, model_name)
+            print(f"📤 [{question_type}] Đang gửi {len(ranges)} request...")
+            final_json_data = get_async_runner().run(request_question_batches(
+                client, file_path, final_prompt, target_schema, ranges, question_type, language_mode, model_name, sizer,
+                level_config=parse_level_config(prompt) if len(ranges) > 1 else None
+            ))
+
+            # Kiểm tra từng câu theo schema, chỉ sinh lại các STT lỗi; sau đó bù các STT còn thiếu
+            if final_json_data and isinstance(final_json_data.get("cau_hoi"), list):
+                final_json_data["cau_hoi"] = get_async_runner().run(regenerate_invalid_questions(
+                    client, file_path, final_prompt, target_schema, final_json_data["cau_hoi"], question_type
+                ))
+                total_questions = _parse_total_questions(prompt, default=final_json_data.get("tong_so_cau"))
+                if isinstance(total_questions, int) and total_questions > 0:
+                    final_json_data["cau_hoi"] = get_async_runner().run(fill_missing_questions(
+                        client, file_path, final_prompt, target_schema, final_json_data["cau_hoi"],
+                        total_questions, question_type
+                    ))
+                # Chia nhiều batch -> mã dạng mỗi batch đếm lại từ 1, phải nối lại toàn cục
+                if len(ranges) > 1:
+                    final_json_data["cau_hoi"] = normalize_batched_ma_dang(final_json_data["cau_hoi"])
             
-            # KHÔNG GỌI renumber_ma_dang_global ở đây.
+            # 1 request: KHÔNG GỌI renumber_ma_dang_global ở đây.
             # Dữ liệu AI trả về sao thì dùng vậy.
 
         # --- PHẦN CHUNG: LƯU FILE ---
@@ -1213,20 +1468,24 @@ def response2docx_flexible(file_path, prompt, file_name, project_id, creds, mode
         print(f"💾 [{batch_name}] Lưu JSON...")
         save_json_securely(final_json_data, batch_name, file_name)
         
-        print(f"📝 [{batch_name}] Render DOCX...")
-        doc = Document()
-        renderer = DynamicDocxRenderer(doc)
-        renderer.render_all(final_json_data)
-        
-        output_path = save_document_securely(doc, batch_name, file_name)
-        if output_path: print(f"✅ HOÀN THÀNH: {output_path}")
-        return output_path
+        return render_docx_from_json(final_json_data, batch_name, file_name, fast_docx=fast_docx)
 
     except Exception as e:
         print(f"❌ Lỗi hệ thống: {e}")
         traceback.print_exc()
         return None
 
+def render_docx_from_json(json_data, batch_name, file_name, fast_docx=False):
+    """Render DOCX từ dữ liệu JSON đã có (dùng chung cho luồng AI và khi resume từ JSON đã lưu)"""
+    print(f"📝 [{batch_name}] Render DOCX...")
+    doc = create_document(fast=fast_docx)
+    renderer = DynamicDocxRenderer(doc)
+    renderer.render_all(json_data)
+    
+    output_path = save_document_securely(doc, batch_name, file_name)
+    if output_path: print(f"✅ HOÀN THÀNH: {output_path}")
+    return output_path
+
 # def response2docx_flexible(
 #     file_path: str,
 #     prompt: str,
@@ -1313,34 +1572,42 @@ def response2docx_flexible(file_path, prompt, file_name, project_id, creds, mode
 #         except Exception as e_final:
 #             return None
 
-def response2docx_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None):
+def response2docx_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None, use_text_layer=False, fast_docx=False):
     """Wrapper cho trắc nghiệm 4 đáp án (legacy)"""
     return response2docx_flexible(
         file_path, prompt, file_name, project_id, creds, model_name,
         question_type="trac_nghiem_4_dap_an",
-        batch_name=batch_name
+        batch_name=batch_name,
+        use_text_layer=use_text_layer,
+        fast_docx=fast_docx
     )
 
-def response2docx_dung_sai_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None):
+def response2docx_dung_sai_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None, use_text_layer=False, fast_docx=False):
     """Wrapper cho đúng/sai (legacy)"""
     return response2docx_flexible(
         file_path, prompt, file_name, project_id, creds, model_name,
         question_type="dung_sai",
-        batch_name=batch_name
+        batch_name=batch_name,
+        use_text_layer=use_text_layer,
+        fast_docx=fast_docx
     )
     
-def response2docx_tra_loi_ngan_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None):
+def response2docx_tra_loi_ngan_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None, use_text_layer=False, fast_docx=False):
     """Wrapper cho trả lời ngắn (legacy compatibility)"""
     return response2docx_flexible(
         file_path, prompt, file_name, project_id, creds, model_name,
         question_type="tra_loi_ngan",
-        batch_name=batch_name
+        batch_name=batch_name,
+        use_text_layer=use_text_layer,
+        fast_docx=fast_docx
     )
 
-def response2docx_tu_luan_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None):
+def response2docx_tu_luan_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None, use_text_layer=False, fast_docx=False):
     """Wrapper cho tự luận học liệu"""
     return response2docx_flexible(
         file_path, prompt, file_name, project_id, creds, model_name,
         question_type="tu_luan", # Key này sẽ kích hoạt logic trong PromptBuilder và Renderer
-        batch_name=batch_name
+        batch_name=batch_name,
+        use_text_layer=use_text_layer,
+        fast_docx=fast_docx
     )
\ No newline at end of file
@@ -3,7 +3,6 @@ import json
 import os
 import sys
 import threading
-import time
 from docx import Document
 from docx.shared import Inches, Pt, RGBColor
 from docx.enum.text import WD_ALIGN_PARAGRAPH
@@ -15,9 +14,14 @@ import re
 from tempfile import NamedTemporaryFile
 from docx.oxml import parse_xml
 import traceback
+from modules.common.latex_text import SEG_MATH, SEG_DISPLAY_MATH, strip_html, iter_segments, clean_latex_body
+from modules.common.ooxml_writer import OoxmlParagraph, create_document
+from modules.common.render_cache import get_equation_cache, get_image_cache, image_generation_allowed
+from modules.common.atomic_io import atomic_write_bytes
+from modules.common import fast_json, json_repair
 
-_FILE_LOCK = threading.RLock()
 _OUTPUT_DIR_LOCK = threading.RLock()
+_LEADING_SLASH_RE = re.compile(r'^\s*/')
 
 def get_app_path():
     """Lấy đường dẫn chứa file .exe hoặc script"""
@@ -127,26 +131,17 @@ def process_text_with_latex(text, paragraph, bold=False):
     """
     Xử lý text có công thức LaTeX
     VERSION ỔN ĐỊNH - Copy từ test_res.py (KHÔNG có repair_broken_latex)
+    Tách đoạn bằng tokenizer dùng chung (modules/common/latex_text.py), không tách **in đậm**
     """
     if not text:
         return
     
     # Làm sạch HTML tags
-    text = text.replace("<br>", "\n").replace("<br/>", "\n") \
-               .replace("<Br>", "\n").replace("<Br/>", "\n")
-    text = re.sub(r'</?(div|p|u|span|font|i|b)\b[^>]*>', '', text)
-    text = text.replace("&nbsp;", "").replace("&lt;", "").replace("&gt;", "")
-    
-    # Tách text và LaTeX
-    pattern = r'(\$[^$]+\$|\\\[.*?\\\])'
-    parts = re.split(pattern, text)
-    
-    for part in parts:
-        if not part:
-            continue
-        
+    text = strip_html(text)
+
+    for kind, part in iter_segments(text, split_bold=False):
         # Phần LaTeX
-        if part.startswith('$') or part.startswith('\\['):
+        if kind == SEG_MATH or kind == SEG_DISPLAY_MATH:
             try:
                 latex_expr = clean_latex_math(part)
                 insert_equation_into_paragraph(latex_expr, paragraph)
@@ -157,7 +152,7 @@ def process_text_with_latex(text, paragraph, bold=False):
                     run.bold = True
         # Phần text thường
         else:
-            cleaned_part = re.sub(r'^\s*/', '', part)
+            cleaned_part = _LEADING_SLASH_RE.sub('', part)
             run = paragraph.add_run(cleaned_part)
             if bold:
                 run.bold = True
@@ -165,7 +160,7 @@ def process_text_with_latex(text, paragraph, bold=False):
 
 def insert_equation_into_paragraph(latex_math_dollar, paragraph):
     """Chèn công thức toán học vào paragraph"""
-    omml_str = latex_to_omml_via_pandoc(latex_math_dollar)
+    omml_str = get_equation_cache(get_app_path()).get_or_convert(latex_math_dollar, latex_to_omml_via_pandoc)
     
     if not omml_str:
         # Fallback: Thêm text thuần nếu không convert được
@@ -181,6 +176,11 @@ def insert_equation_into_paragraph(latex_math_dollar, paragraph):
             count=1
         )
     
+    # Backend ghi XML trực tiếp: chèn nguyên chuỗi OMML
+    if isinstance(paragraph, OoxmlParagraph):
+        paragraph.add_omml(omml_str)
+        return
+
     try:
         omml_element = parse_xml(omml_str)
         run = paragraph.add_run()
@@ -191,35 +191,7 @@ def insert_equation_into_paragraph(latex_math_dollar, paragraph):
 
 
 def clean_latex_math(latex_raw):
-    latex_raw = re.sub(r'\\/', '', latex_raw)
-    latex_raw = re.sub(r'\\operatorname\s*{\s*([^}]*)\s*}',
-                       lambda m: m.group(1).replace(' ', ''), latex_raw)
-    latex_raw = re.sub(r'\\root\s*(\d+)\s*{([^}]*)}', r'\\sqrt[\1]{\2}', latex_raw)
-    latex_raw = re.sub(r'\\root\s*{(\d+)}\s*\\of\s*{([^}]*)}', r'\\sqrt[\1]{\2}', latex_raw)
-    latex_raw = re.sub(r'\\root\s*(\d+)\s*\\sqrt\s*{([^}]*)}', r'\\sqrt[\1]{\2}', latex_raw)
-    latex_raw = re.sub(r'([a-zA-Z])\s*\\frac\s*{([^}]+)}\s*{([^}]+)}',
-                       r'\1^{\\frac{\2}{\3}}', latex_raw)
-    latex_raw = re.sub(r'\\sp\s*{([^}]*)}', r'^{\1}', latex_raw)
-    latex_raw = re.sub(r'{\\bf\s*([^}]*)}', r'\1', latex_raw)
-    latex_raw = re.sub(r'\\\s*log', r'\\log', latex_raw)
-    latex_raw = re.sub(r'\\bigskip', '', latex_raw)
-    latex_raw = re.sub(r'\\nonumber', '', latex_raw)
-    latex_raw = latex_raw.replace(r'\?', '?')
-    latex_raw = re.sub(r'\\cdot\s*(?=\w)', r'\\cdot ', latex_raw)
-    latex_raw = latex_raw.replace(r'\dotstan', r'\cdot \tan')
-    latex_raw = re.sub(r'(?<!\\)(\bln\b|\blog\b|\bsin\b|\bcos\b|\btan\b|\blog_{?\d*}?)',
-                       r'\\\1', latex_raw)
-    latex_raw = re.sub(r'(\\Leftrightarrow|\\Rightarrow|\\rightarrow)(?=\w)', r'\1 ', latex_raw)
-    latex_raw = latex_raw.replace(r'\\n', r'\n')
-    
-    latex_raw = latex_raw.strip()
-    # ✅ KHÁC BIỆT: Version cũ KHÔNG replace \n và \r
-    # latex_raw = latex_raw.replace('\n', ' ').replace('\r', '')  # ← XÓA DÒNG NÀY
-    
-    if not (latex_raw.startswith('$') and latex_raw.endswith('$')):
-        latex_raw = f"${latex_raw}$"
-    
-    return latex_raw
+    return clean_latex_body(latex_raw)
 
 def ensure_output_folder_for_batch(batch_name):
     """Tạo folder riêng cho batch"""
@@ -234,30 +206,47 @@ def ensure_output_folder_for_batch(batch_name):
     return batch_folder
 
 def save_document_securely(doc, batch_name, file_name):
-    """Lưu file DOCX với thread-safety"""
+    """Lưu file DOCX: serialize ra bộ nhớ ngoài mọi khóa, chỉ khóa đúng file đích khi ghi"""
     batch_folder = ensure_output_folder_for_batch(batch_name)
     if not batch_folder:
         return None
 
     output_path = os.path.join(batch_folder, f"{file_name}.docx")
-    
-    with _FILE_LOCK:
-        max_retries = 3
-        for retry_count in range(max_retries):
-            try:
-                doc.save(output_path)
-                if os.path.exists(output_path):
-                    file_size = os.path.getsize(output_path)
-                    print(f"✅ Đã lưu file: {output_path} ({file_size} bytes)")
-                    return output_path
-            except Exception as e:
-                print(f"⚠️ Lỗi lưu file lần {retry_count + 1}: {e}")
-                if retry_count < max_retries - 1:
-                    time.sleep(0.5)
-        
-        print(f"❌ Không thể lưu file sau {max_retries} lần thử")
+
+    try:
+        buffer = BytesIO()
+        doc.save(buffer)
+        docx_bytes = buffer.getvalue()
+    except Exception as e:
+        print(f"❌ Lỗi tạo nội dung DOCX: {e}")
+        return None
+
+    max_retries = 3
+    try:
+        atomic_write_bytes(output_path, docx_bytes, max_retries=max_retries, retry_delay=0.5)
+    except Exception as e:
+        print(f"❌ Không thể lưu file sau {max_retries} lần thử: {e}")
+        return None
+    print(f"✅ Đã lưu file: {output_path} ({len(docx_bytes)} bytes)")
+    return output_path
+
+def save_json_securely(data, batch_name, file_name):
+    """Lưu file JSON: dump ngoài khóa, ghi nguyên tử theo khóa của riêng file này"""
+    batch_folder = ensure_output_folder_for_batch(batch_name)
+    if not batch_folder: return None
+
+    output_path = os.path.join(batch_folder, f"{file_name}.json")
+    try:
+        json_bytes = fast_json.dumps_bytes(data)
+        atomic_write_bytes(output_path, json_bytes)
+        print(f"✅ Đã lưu file JSON: {output_path}")
+        return output_path
+    except Exception as e:
+        print(f"❌ Lỗi lưu file JSON: {e}")
         return None
 
+_JSON_FENCE_RE = re.compile(r"```(?:json)?(.*?)```", re.DOTALL | re.IGNORECASE)
+
 def clean_json_string(text: str) -> str:
     if not text:
         return ""
@@ -267,8 +256,7 @@ def clean_json_string(text: str) -> str:
     # BƯỚC 1: Dùng Regex để bắt nội dung trong ```json ... ``` (nếu có)
     # re.DOTALL giúp dấu chấm (.) khớp với cả dòng mới (\n)
     # re.IGNORECASE để bắt cả ```JSON và ```json
-    pattern = r"```(?:json)?(.*?)```"
-    match = re.search(pattern, text, re.DOTALL | re.IGNORECASE)
+    match = _JSON_FENCE_RE.search(text)
     
     if match:
         # Nếu tìm thấy markdown, lấy nội dung bên trong
@@ -300,84 +288,78 @@ NHIỆM VỤ:
 3. KHÔNG thay đổi công thức LaTeX (giữ nguyên \\frac, \\sqrt...)
 4. CHỈ TRẢ VỀ JSON ĐÃ SỬA (không markdown, không giải thích)
     """
-    repaired_text = client.send_data_to_check(prompt_fix)
-    return clean_json_string(repaired_text)
+    repaired_text = client.send_data_to_AI(prompt_fix)
+    return clean_json_string(repaired_text or "")
+
+_JSON_STRING_STOP_RE = re.compile(r'["\\]')
+_VALID_ESCAPE_CHARS = frozenset('\\"/bfnrt')
+_HEX_CHARS = frozenset('0123456789ABCDEFabcdef')
+
 def sanitize_latex_json(text: str) -> str:
     """
-    Sanitize JSON chứa LaTeX một cách AN TOÀN
-    
+    Sanitize JSON chứa LaTeX một cách AN TOÀN (1 lượt duyệt, tuyến tính theo độ dài)
+
     Chiến lược:
     1. Chỉ xử lý BÊN TRONG chuỗi JSON (giữa dấu ngoặc kép)
     2. Giữ nguyên phần cấu trúc JSON (keys, colons, brackets)
-    3. Escape backslash KHÔNG phải JSON escape hợp lệ
+    3. Escape backslash KHÔNG phải JSON escape hợp lệ (\\frac -> \\\\frac)
+
+    Máy trạng thái: ngoài chuỗi thì nhảy thẳng tới dấu " kế tiếp, trong chuỗi thì nhảy
+    tới dấu " hoặc \\ kế tiếp; chỉ cắt lát (slice) nối vào 1 buffer, không duyệt từng ký tự.
+    Kết quả giống hệt bản regex cũ (so sánh trong scripts/bench_sanitize_latex_json.py), kể cả
+    chuỗi không đóng hoặc có backslash ngay trước xuống dòng (giữ nguyên như cũ).
     """
-    
-    # Danh sách escape sequences hợp lệ trong JSON spec
-    VALID_JSON_ESCAPES = {
-        '\\\\', '\\"', '\\/', '\\b', '\\f', '\\n', '\\r', '\\t'
-    }
-    
-    def fix_string_content(match):
-        """
-        Xử lý nội dung BÊN TRONG chuỗi JSON (giữa dấu ngoặc kép)
-        match.group(0) = toàn bộ "..." (có dấu ")
-        match.group(1) = nội dung giữa dấu " (không có dấu ")
-        """
-        full_match = match.group(0)
-        content = match.group(1)
-        
-        # Nếu chuỗi rỗng, giữ nguyên
-        if not content:
-            return full_match
-        
-        result = []
-        i = 0
-        
-        while i < len(content):
-            char = content[i]
-            
-            if char == '\\':
-                # Kiểm tra có phải escape hợp lệ không
-                if i + 1 < len(content):
-                    next_char = content[i + 1]
-                    two_chars = char + next_char
-                    
-                    # Trường hợp 1: JSON escape hợp lệ (\\, \", \n, \t...)
-                    if two_chars in VALID_JSON_ESCAPES:
-                        result.append(two_chars)
-                        i += 2
-                        continue
-                    
-                    # Trường hợp 2: Unicode escape (\uXXXX)
-                    if next_char == 'u' and i + 5 < len(content):
-                        hex_part = content[i+2:i+6]
-                        if len(hex_part) == 4 and all(c in '0123456789ABCDEFabcdef' for c in hex_part):
-                            result.append(content[i:i+6])  # \uXXXX
-                            i += 6
-                            continue
-                    
-                    # Trường hợp 3: LaTeX command (VD: \frac, \sqrt, \sin)
-                    # → Escape thành \\
-                    result.append('\\\\')
-                    i += 1
-                else:
-                    # Backslash ở cuối chuỗi → Escape
-                    result.append('\\\\')
-                    i += 1
-            else:
-                result.append(char)
-                i += 1
-        
-        # Trả về chuỗi đã fix (VẪN CÓ dấu ngoặc kép)
-        return '"' + ''.join(result) + '"'
-    
-    # Regex tìm tất cả chuỗi JSON: "..."
-    # (?:[^"\\]|\\.)* nghĩa là: (không phải " hoặc \) HOẶC (\ theo sau bất kỳ ký tự nào)
-    string_pattern = r'"((?:[^"\\]|\\.)*)"'
-    
-    sanitized = re.sub(string_pattern, fix_string_content, text)
-    
-    return sanitized
+    out = []
+    append = out.append
+    find_quote = text.find
+    find_stop = _JSON_STRING_STOP_RE.search
+    pos = 0
+
+    while True:
+        # NGOÀI CHUỖI: chép nguyên tới dấu mở "
+        quote = find_quote('"', pos)
+        if quote == -1:
+            append(text[pos:])
+            break
+        append(text[pos:quote + 1])
+
+        # TRONG CHUỖI
+        mark = len(out)
+        seg_start = i = quote + 1
+        while True:
+            match = find_stop(text, i)
+            if match is None:
+                # Không có dấu " đóng: mọi dấu " phía sau đều đã bị escape -> giữ nguyên phần còn lại
+                del out[mark:]
+                append(text[quote + 1:])
+                return ''.join(out)
+            j = match.start()
+            if text[j] == '"':
+                append(text[seg_start:j + 1])
+                pos = j + 1
+                break
+
+            next_char = text[j + 1:j + 2]
+            if not next_char or next_char == '\n':
+                # Backslash cuối văn bản / trước xuống dòng: chuỗi không hợp lệ -> giữ nguyên tới đây
+                del out[mark:]
+                append(text[quote + 1:j + 1])
+                pos = j + 1
+                break
+            if next_char in _VALID_ESCAPE_CHARS:
+                i = j + 2
+                continue
+            if next_char == 'u':
+                hex_part = text[j + 2:j + 6]
+                if len(hex_part) == 4 and _HEX_CHARS.issuperset(hex_part):
+                    i = j + 6
+                    continue
+            # LaTeX command (VD: \\frac, \\sqrt, \\sin) -> escape thành \\\\
+            append(text[seg_start:j])
+            append('\\\\')
+            seg_start = i = j + 1
+
+    return ''.join(out)
 
 def parse_json_safely(json_str: str, client) -> Optional[Dict]:
     """Parse JSON an toàn với Sanitization và Retry AI"""
@@ -389,7 +371,7 @@ def parse_json_safely(json_str: str, client) -> Optional[Dict]:
     
     # Thử parse lần 1 (với chuỗi đã sanitize)
     try:
-        return json.loads(sanitized_str, strict=False)
+        return fast_json.loads(sanitized_str, strict=False)
     except json.JSONDecodeError as e:
         print(f"❌ Lỗi JSON lần 1 (Logic): {e}")
         # Debug: In ra đoạn lỗi để kiểm tra nếu cần
@@ -397,6 +379,12 @@ def parse_json_safely(json_str: str, client) -> Optional[Dict]:
         end = min(len(sanitized_str), e.pos + 20)
         print(f"Context: ...{sanitized_str[start:end]}...")
     
+    # Sửa cục bộ (phẩy thừa, dấu " lạc, JSON bị cắt) - không tốn request AI
+    data, tier = json_repair.repair_json(sanitized_str, strict=False)
+    if data is not None:
+        print(f"🩹 Đã sửa JSON cục bộ ({json_repair.TIER_LABELS[tier]})")
+        return data
+
     # Thử sửa bằng AI (Fallback cuối cùng)
     try:
         # Lưu ý: Gửi chuỗi gốc (cleaned_str) hoặc chuỗi đã sanitize tùy chiến lược. 
@@ -406,9 +394,12 @@ def parse_json_safely(json_str: str, client) -> Optional[Dict]:
         # Sau khi AI sửa, vẫn nên sanitize lại một lần nữa để chắc chắn
         repaired_str = sanitize_latex_json(repaired_str)
         
-        return json.loads(repaired_str, strict=False)
+        data = fast_json.loads(repaired_str, strict=False)
+        json_repair.record(json_repair.TIER_AI)
+        return data
     except json.JSONDecodeError as e:
         print(f"❌ Lỗi JSON lần 2 (AI Give up): {e}")
+        json_repair.record(json_repair.TIER_FAILED)
         return None
 def generate_or_get_image(hinh_anh_data: Dict) -> tuple:
     """
@@ -420,11 +411,19 @@ def generate_or_get_image(hinh_anh_data: Dict) -> tuple:
     loai = hinh_anh_data.get("loai", "tu_mo_ta")
     
     if loai == "tu_mo_ta" and mo_ta:
+        # Ảnh đã sinh trước đó lấy lại từ cache
+        image_cache = get_image_cache(get_app_path())
+        cached_bytes = image_cache.get(mo_ta)
+        if cached_bytes:
+            return cached_bytes, None
+        if not image_generation_allowed():
+            return None, f"🖼️ [Chưa có ảnh đã sinh: {mo_ta}]"
         try:
             from modules.common.text2Image import generate_image_from_text
             # Hàm này trả về 1 bytes object (hoặc None)
             image_bytes = generate_image_from_text(mo_ta)
             if image_bytes:
+                image_cache.put(mo_ta, image_bytes)
                 return image_bytes, None
             else:
                 # Nếu API trả về None (do lỗi mạng hoặc quota)
@@ -912,12 +911,15 @@ def response2docx_flexible(
     creds: str,
     model_name: str,
     question_type: str = "trac_nghiem_4_dap_an",
-    batch_name: Optional[str] = None
+    batch_name: Optional[str] = None,
+    use_text_layer: bool = False,
+    fast_docx: bool = False
 ) -> Optional[str]:
     try:
-        from modules.common.callAPI import VertexClient
+        from modules.common.callAPI import VertexClient, AsyncVertexClient, get_async_runner
         
         client = VertexClient(project_id, creds, model_name)
+        async_client = AsyncVertexClient(project_id, creds, model_name, use_text_layer=use_text_layer)
         
         if not batch_name:
             batch_name = file_name.replace("_TN", "").replace("_DS", "").replace("_TLN", "")
@@ -927,7 +929,7 @@ def response2docx_flexible(
         
         # 2. Gửi request AI
         print("📤 Đang gửi request tới AI...")
-        ai_response = client.send_data_to_AI(final_prompt, file_path)
+        ai_response = get_async_runner().run(async_client.send_data_to_AI(final_prompt, file_path))
         
         # 3. Parse JSON
         print("🔄 Đang parse JSON...")
@@ -938,65 +940,80 @@ def response2docx_flexible(
         
         print(f"✅ Parse thành công: {data.get('tong_so_cau', 0)} câu hỏi")
         
-        # 4. Render DOCX động
-        print("📝 Đang tạo DOCX...")
-        doc = Document()
-        renderer = DynamicDocxRenderer(doc)
+        # Lưu JSON để có thể render lại (resume) mà không gọi AI
+        save_json_securely(data, batch_name, file_name)
         
-        try:
-            renderer.render_all(data)
-            print("✅ Render DOCX thành công")
-        except Exception as e:
-            print(f"❌ Lỗi khi render DOCX: {e}")
-            traceback.print_exc()
-            return None
-        
-        # 5. Lưu file
-        print("💾 Đang lưu file...")
-        output_path = save_document_securely(doc, batch_name, file_name)
-        
-        if output_path:
-            print(f"✅ Hoàn thành: {output_path}")
-        else:
-            print("❌ Không thể lưu file")
-            
-        return output_path
+        return render_docx_from_json(data, batch_name, file_name, fast_docx=fast_docx)
     
     except Exception as e:
         print(f"❌ LỖI NGHIÊM TRỌNG: {e}")
         traceback.print_exc()
         return None
 
-def response2docx_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None):
+def render_docx_from_json(data: Dict, batch_name: str, file_name: str, fast_docx: bool = False) -> Optional[str]:
+    """Render DOCX từ dữ liệu JSON đã parse (dùng chung cho luồng AI và khi resume)"""
+    # 4. Render DOCX động
+    print("📝 Đang tạo DOCX...")
+    doc = create_document(fast=fast_docx)
+    renderer = DynamicDocxRenderer(doc)
+    
+    try:
+        renderer.render_all(data)
+        print("✅ Render DOCX thành công")
+    except Exception as e:
+        print(f"❌ Lỗi khi render DOCX: {e}")
+        traceback.print_exc()
+        return None
+    
+    # 5. Lưu file
+    print("💾 Đang lưu file...")
+    output_path = save_document_securely(doc, batch_name, file_name)
+    
+    if output_path:
+        print(f"✅ Hoàn thành: {output_path}")
+    else:
+        print("❌ Không thể lưu file")
+        
+    return output_path
+
+def response2docx_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None, use_text_layer=False, fast_docx=False):
     """Wrapper cho trắc nghiệm 4 đáp án (legacy)"""
     return response2docx_flexible(
         file_path, prompt, file_name, project_id, creds, model_name,
         question_type="trac_nghiem_4_dap_an",
-        batch_name=batch_name
+        batch_name=batch_name,
+        use_text_layer=use_text_layer,
+        fast_docx=fast_docx
     )
 
-def response2docx_dung_sai_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None):
+def response2docx_dung_sai_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None, use_text_layer=False, fast_docx=False):
     """Wrapper cho đúng/sai (legacy)"""
     return response2docx_flexible(
         file_path, prompt, file_name, project_id, creds, model_name,
         question_type="dung_sai",
-        batch_name=batch_name
+        batch_name=batch_name,
+        use_text_layer=use_text_layer,
+        fast_docx=fast_docx
     )
     
-def response2docx_tra_loi_ngan_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None):
+def response2docx_tra_loi_ngan_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None, use_text_layer=False, fast_docx=False):
     """Wrapper cho trả lời ngắn (legacy compatibility)"""
     return response2docx_flexible(
         file_path, prompt, file_name, project_id, creds, model_name,
         question_type="tra_loi_ngan",
-        batch_name=batch_name
+        batch_name=batch_name,
+        use_text_layer=use_text_layer,
+        fast_docx=fast_docx
     )
 
-def response2docx_tu_luan_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None):
+def response2docx_tu_luan_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None, use_text_layer=False, fast_docx=False):
     """Wrapper cho tự luận học liệu"""
     return response2docx_flexible(
         file_path, prompt, file_name, project_id, creds, model_name,
         question_type="tu_luan", # Key này sẽ kích hoạt logic trong PromptBuilder và Renderer
-        batch_name=batch_name
+        batch_name=batch_name,
+        use_text_layer=use_text_layer,
+        fast_docx=fast_docx
     )
 
 class ConfigManager:
@@ -0,0 +1,144 @@
+"""
+Kiểm tra + benchmark sanitize_latex_json (modules/khxh/response2docxXH.py):
+- So sánh kết quả với bản regex cũ trên JSON đã lưu + phản hồi giả lập + 100k mẫu ngẫu nhiên
+- Đo tốc độ 2 bản trên cùng corpus
+Chạy từ thư mục gốc project:
+    python scripts/bench_sanitize_latex_json.py [file.json | thư mục ...]
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.khxh.response2docxXH import sanitize_latex_json  # noqa: E402
+
+
+def sanitize_latex_json_legacy(text: str) -> str:
+    """
+    [BẢN CŨ - regex + duyệt từng ký tự, chỉ dùng làm chuẩn so sánh]
+    Sanitize JSON chứa LaTeX một cách AN TOÀN
+    
+    Chiến lược:
+    1. Chỉ xử lý BÊN TRONG chuỗi JSON (giữa dấu ngoặc kép)
+    2. Giữ nguyên phần cấu trúc JSON (keys, colons, brackets)
+    3. Escape backslash KHÔNG phải JSON escape hợp lệ
+    """
+    
+    # Danh sách escape sequences hợp lệ trong JSON spec
+    VALID_JSON_ESCAPES = {
+        '\\\\', '\\"', '\\/', '\\b', '\\f', '\\n', '\\r', '\\t'
+    }
+    
+    def fix_string_content(match):
+        """
+        Xử lý nội dung BÊN TRONG chuỗi JSON (giữa dấu ngoặc kép)
+        match.group(0) = toàn bộ "..." (có dấu ")
+        match.group(1) = nội dung giữa dấu " (không có dấu ")
+        """
+        full_match = match.group(0)
+        content = match.group(1)
+        
+        # Nếu chuỗi rỗng, giữ nguyên
+        if not content:
+            return full_match
+        
+        result = []
+        i = 0
+        
+        while i < len(content):
+            char = content[i]
+            
+            if char == '\\':
+                # Kiểm tra có phải escape hợp lệ không
+                if i + 1 < len(content):
+                    next_char = content[i + 1]
+                    two_chars = char + next_char
+                    
+                    # Trường hợp 1: JSON escape hợp lệ (\\, \", \n, \t...)
+                    if two_chars in VALID_JSON_ESCAPES:
+                        result.append(two_chars)
+                        i += 2
+                        continue
+                    
+                    # Trường hợp 2: Unicode escape (\uXXXX)
+                    if next_char == 'u' and i + 5 < len(content):
+                        hex_part = content[i+2:i+6]
+                        if len(hex_part) == 4 and all(c in '0123456789ABCDEFabcdef' for c in hex_part):
+                            result.append(content[i:i+6])  # \uXXXX
+                            i += 6
+                            continue
+                    
+                    # Trường hợp 3: LaTeX command (VD: \frac, \sqrt, \sin)
+                    # → Escape thành \\
+                    result.append('\\\\')
+                    i += 1
+                else:
+                    # Backslash ở cuối chuỗi → Escape
+                    result.append('\\\\')
+                    i += 1
+            else:
+                result.append(char)
+                i += 1
+        
+        # Trả về chuỗi đã fix (VẪN CÓ dấu ngoặc kép)
+        return '"' + ''.join(result) + '"'
+    
+    # Regex tìm tất cả chuỗi JSON: "..."
+    # (?:[^"\\]|\\.)* nghĩa là: (không phải " hoặc \) HOẶC (\ theo sau bất kỳ ký tự nào)
+    string_pattern = r'"((?:[^"\\]|\\.)*)"'
+    
+    sanitized = re.sub(string_pattern, fix_string_content, text)
+    
+    return sanitized
+
+
+def main():
+    def _collect_corpus(paths):
+        corpus = []
+        for path in paths:
+            files = [path]
+            if os.path.isdir(path):
+                files = [os.path.join(root, f) for root, _, names in os.walk(path) for f in names]
+            for file_path in files:
+                if file_path.endswith(".json"):
+                    with open(file_path, "r", encoding="utf-8") as f:
+                        saved = f.read()
+                    corpus.append(saved)
+                    # JSON đã lưu là JSON hợp lệ; bỏ 1 lớp escape để giống phản hồi thô của model
+                    corpus.append(saved.replace("\\\\", "\\"))
+        return corpus
+
+    def _random_case(rng):
+        alphabet = ['"', '\\', 'u', '0', 'a', 'F', 'n', 't', '/', '\n', ' ', '{', '}', ':', ',', 'x', 'ă', '$']
+        return ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+
+    sample_question = (
+        '{"stt": 1, "noi_dung": "Cho $y = \\frac{x^2 - 1}{x + 1}$, tính \\lim_{x \\to 1} y và \\sqrt{2}.\\n'
+        'Đáp án \\"A\\" \\u00e1 \\alpha", "dap_an": ["\\(\\Delta\\)", "\\text{m/s}", "C:\\\\path"]}'
+    )
+    corpus = _collect_corpus(sys.argv[1:] or ["output"])
+    if not corpus:
+        print("ℹ️ Không tìm thấy JSON đã lưu, dùng phản hồi giả lập")
+    corpus.append('{"cau_hoi": [' + ", ".join([sample_question] * 2000) + "]}")
+
+    rng = random.Random(46)
+    cases = corpus + [_random_case(rng) for _ in range(100000)]
+    mismatches = sum(sanitize_latex_json(case) != sanitize_latex_json_legacy(case) for case in cases)
+    print(f"🔍 So sánh {len(cases)} mẫu ({len(corpus)} từ corpus): {mismatches} khác biệt")
+    if mismatches:
+        sys.exit(1)
+
+    total_mb = sum(len(text.encode("utf-8")) for text in corpus) / 1024 / 1024
+    for name, func in (("regex cũ", sanitize_latex_json_legacy), ("máy trạng thái", sanitize_latex_json)):
+        started = time.perf_counter()
+        for text in corpus:
+            func(text)
+        elapsed = time.perf_counter() - started
+        print(f"⏱️ {name}: {elapsed * 1000:.1f} ms cho {total_mb:.2f} MB ({total_mb / elapsed:.1f} MB/s)")
+
+
+if __name__ == "__main__":
+    main()
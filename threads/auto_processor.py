@@ -1,13 +1,24 @@
 import os
-import json
 import re
 import xlsxwriter
 import sys
+import queue
+import threading
 from PyQt5.QtCore import QThread, pyqtSignal
 
 from core.client_driver import GoogleDriveAPI
 from core.callAPI import VertexClient
-from core.cutPDF import cut_pdf_by_pages
+from core.cutPDF import cut_pdf_by_pages, open_pdf_reader
+from core.cut_checkpoint import plan_book, save_checkpoint, fingerprint_file, fingerprint_bytes
+from core.hashing import text_sha256
+from modules.common import fast_json
+
+# Số PDF đã tải nhưng chưa xử lý được phép nằm chờ (backpressure cho luồng tải)
+PIPELINE_QUEUE_SIZE = 4
+# Chế độ tải vào RAM: mỗi sách có thể vài trăm MB nên giữ ít sách trong bộ nhớ hơn
+IN_MEMORY_QUEUE_SIZE = 1
+IN_MEMORY_DOWNLOAD_WORKERS = 2
+_PIPELINE_DONE = object()
 
 class AutoProcessor(QThread):
     """
@@ -18,12 +29,20 @@ class AutoProcessor(QThread):
     finished = pyqtSignal(list)  # danh sách tất cả file đã tạo
     file_completed = pyqtSignal(str, list)  # file_name, generated_files
 
-    def __init__(self, drive_folder_url, prompt_path, project_id, creds, base_download_path=None):
+    def __init__(self, drive_folder_url, prompt_path, project_id, creds, base_download_path=None, incremental=False,
+                 sync_mode=False, in_memory=False):
         super().__init__()
         self.drive_folder_url = drive_folder_url
         self.prompt_path = prompt_path
         self.project_id = project_id
         self.creds = creds
+        # Sync: chỉ tải PDF mới / đã sửa trên Drive so với manifest lần trước. File không đổi vẫn
+        # được đưa vào pipeline, checkpoint incremental quyết định bỏ qua (sách lỗi lần trước được thử lại)
+        self.sync_mode = sync_mode
+        # Incremental: chỉ gửi AI / cắt lại sách có PDF nguồn hoặc prompt thay đổi (bắt buộc khi sync)
+        self.incremental = incremental or sync_mode
+        # In-memory: tải PDF nguồn vào RAM, dùng chung 1 buffer cho AI và bước cắt (không ghi file nguồn)
+        self.in_memory = in_memory
         
         # Tạo thư mục download mặc định
         if base_download_path is None:
@@ -43,46 +62,82 @@ class AutoProcessor(QThread):
         self.all_generated_files = []
         # ⭐ THÊM BIẾN LƯU CẤU TRÚC FOLDER ⭐
         self.pdf_folder_mapping = {}  # {pdf_path: relative_folder_path}
+        # Tiến độ pipeline tải/xử lý chồng lấn
+        self._expected_files = 0
+        self._processed_count = 0
     
     def run(self):
-        """Main processing pipeline"""
+        """
+        Main processing pipeline: luồng tải (producer) đẩy từng PDF vào hàng đợi giới hạn
+        ngay khi tải xong, luồng này (consumer) lấy ra phân tích AI + cắt luôn.
+        Hàng đợi đầy -> các luồng tải phải chờ, số PDF chờ xử lý trên đĩa luôn bị chặn;
+        PDF đã xử lý xong bị xóa ngay (trừ chế độ sync).
+        """
         try:
             # Step 1: Initialize clients
             self.progress.emit("Khởi tạo kết nối...", 5)
             drive_api = GoogleDriveAPI(self.client_secrets_file)
             vertex_client = VertexClient(self.project_id, self.creds, "gemini-2.5-pro")
             
-            # Step 2: Download PDFs from Drive (và lưu cấu trúc folder)
+            # Step 2: Producer - tải PDF từ Drive (giữ cấu trúc folder)
             self.progress.emit("Đang tải PDF từ Google Drive...", 10)
-            downloaded_files = self._download_pdfs_from_drive_with_structure(drive_api)
-            
-            if not downloaded_files:
-                self.error.emit("Không tìm thấy file PDF nào trong folder Google Drive")
-                return
+            pdf_queue = queue.Queue(maxsize=IN_MEMORY_QUEUE_SIZE if self.in_memory else PIPELINE_QUEUE_SIZE)
+            producer_state = {"downloaded": [], "error": None}
             
-            self.progress.emit(f"Đã tải {len(downloaded_files)} file PDF", 20)
-            
-            # Step 3: Process each PDF với cấu trúc folder
-            total_files = len(downloaded_files)
-            for i, pdf_path in enumerate(downloaded_files):
-                base_progress = 20 + int((i / total_files) * 70)  # 20-90%
+            def producer():
+                try:
+                    producer_state["downloaded"] = self._download_pdfs_from_drive_with_structure(
+                        drive_api, on_pdf_ready=pdf_queue.put
+                    )
+                except Exception as e:
+                    producer_state["error"] = e
+                finally:
+                    pdf_queue.put(_PIPELINE_DONE)
+            
+            producer_thread = threading.Thread(target=producer, daemon=True)
+            producer_thread.start()
+            
+            # Step 3: Consumer - xử lý từng PDF ngay khi tải xong
+            while True:
+                item = pdf_queue.get()
+                if item is _PIPELINE_DONE:
+                    break
+                # In-memory: item = (đường dẫn ảo, bytes); ngược lại item = đường dẫn file
+                pdf_path, pdf_bytes = item if isinstance(item, tuple) else (item, None)
+                self._processed_count += 1
+                total_files = max(self._expected_files, self._processed_count)
+                base_progress = self._pipeline_progress(self._processed_count - 1)
                 
                 file_name = os.path.basename(pdf_path)
-                self.progress.emit(f"Đang xử lý: {file_name} ({i+1}/{total_files})", base_progress)
+                self.progress.emit(f"Đang xử lý: {file_name} ({self._processed_count}/{total_files})", base_progress)
                 
                 try:
                     # Process single PDF với cấu trúc folder
-                    generated_files = self._process_single_pdf_with_structure(pdf_path, vertex_client, base_progress)
+                    generated_files = self._process_single_pdf_with_structure(
+                        pdf_path, vertex_client, base_progress, pdf_bytes=pdf_bytes
+                    )
                     
                     if generated_files:
                         self.all_generated_files.extend(generated_files)
                         self.file_completed.emit(file_name, generated_files)
-                        self.progress.emit(f"✓ Hoàn thành: {file_name}", base_progress + int(70/total_files))
+                        self.progress.emit(f"✓ Hoàn thành: {file_name}", self._pipeline_progress(self._processed_count))
                     else:
-                        self.progress.emit(f"✗ Lỗi: {file_name}", base_progress + int(70/total_files))
+                        self.progress.emit(f"✗ Lỗi: {file_name}", self._pipeline_progress(self._processed_count))
                 
                 except Exception as e:
-                    self.progress.emit(f"✗ Lỗi {file_name}: {str(e)}", base_progress + int(70/total_files))
+                    self.progress.emit(f"✗ Lỗi {file_name}: {str(e)}", self._pipeline_progress(self._processed_count))
+                finally:
+                    # Nhả buffer của sách vừa xử lý trước khi lấy sách tiếp theo
+                    item = pdf_bytes = None
+                    self._discard_downloaded_pdf(pdf_path)
+            
+            producer_thread.join()
+            if producer_state["error"] is not None:
+                raise producer_state["error"]
+            
+            if not producer_state["downloaded"]:
+                self.error.emit("Không tìm thấy file PDF nào trong folder Google Drive")
+                return
             
             # Step 4: Finish
             self.progress.emit(f"Hoàn tất! Tạo ra {len(self.all_generated_files)} file", 100)
@@ -91,8 +146,29 @@ class AutoProcessor(QThread):
         except Exception as e:
             self.error.emit(f"Lỗi trong quá trình xử lý: {str(e)}")
     
-    def _download_pdfs_from_drive_with_structure(self, drive_api):
-        """Download all PDFs from Google Drive folder và lưu cấu trúc folder"""
+    def _discard_downloaded_pdf(self, pdf_path):
+        """
+        Xóa PDF nguồn đã tải khi sách xử lý xong để dung lượng đĩa luôn bị chặn bởi hàng đợi.
+        Giữ lại ở chế độ sync (manifest cần bản local để không tải lại); in-memory không có file.
+        """
+        self.pdf_folder_mapping.pop(pdf_path, None)
+        if self.in_memory or self.sync_mode:
+            return
+        try:
+            os.remove(pdf_path)
+        except OSError as e:
+            print(f"⚠️ Không xóa được PDF đã tải {pdf_path}: {e}")
+    
+    def _pipeline_progress(self, processed):
+        """Tiến độ 20% -> 90% theo số PDF đã xử lý / tổng số PDF cần tải"""
+        total_files = max(self._expected_files, processed, 1)
+        return 20 + int((processed / total_files) * 70)
+    
+    def _download_pdfs_from_drive_with_structure(self, drive_api, on_pdf_ready=None):
+        """
+        Download all PDFs from Google Drive folder và lưu cấu trúc folder.
+        on_pdf_ready(pdf_path): gọi từ luồng tải ngay khi 1 PDF tải xong (có thể chặn để tạo backpressure)
+        """
         try:
             # Extract folder ID
             folder_id = drive_api.extract_folder_id(self.drive_folder_url)
@@ -100,55 +176,74 @@ class AutoProcessor(QThread):
             # Create download folder
             download_folder = os.path.join(self.base_download_path, "downloaded_pdfs")
             
-            # ⭐ LẤY CẤU TRÚC FOLDER TRƯỚC KHI DOWNLOAD ⭐
             root_folder_name = drive_api.get_folder_name(folder_id)
-            all_folders = drive_api.list_all_folders(folder_id)
-            all_folders[folder_id] = ""  # Thêm folder gốc
+            root_download_path = os.path.join(download_folder, root_folder_name)
             
-            # Download with structure
-            drive_api.download_all_pdfs_with_structure(folder_id, download_folder)
+            # Tiến độ tải chỉ cập nhật message, % do luồng xử lý quyết định
+            def on_download_progress(done_files, total_files, bytes_done, total_bytes):
+                self._expected_files = total_files
+                self.progress.emit(
+                    f"Đang tải PDF: {done_files}/{total_files} file ({bytes_done / (1024 * 1024):.0f}/{total_bytes / (1024 * 1024):.0f} MB)",
+                    self._pipeline_progress(self._processed_count)
+                )
             
-            # ⭐ BUILD PDF-FOLDER MAPPING ⭐
-            pdf_files = []
-            root_download_path = os.path.join(download_folder, root_folder_name)
+            # ⭐ BUILD PDF-FOLDER MAPPING ngay khi từng file tải xong ⭐
+            def on_file_done(spec, pdf_path):
+                if not pdf_path or not pdf_path.lower().endswith('.pdf'):
+                    return
+                # Tính relative path từ root_download_path
+                relative_path = os.path.relpath(os.path.dirname(pdf_path), root_download_path)
+                if relative_path == ".":
+                    relative_path = ""  # File ở root folder
+                self.pdf_folder_mapping[pdf_path] = relative_path
+                if on_pdf_ready:
+                    on_pdf_ready(pdf_path)
+            
+            if self.in_memory:
+                if self.sync_mode:
+                    print("⚠️ Chế độ tải vào RAM không dùng manifest đồng bộ, tải lại toàn bộ cây")
+                
+                def on_memory_file_done(spec, data):
+                    if data is None or not spec['name'].lower().endswith('.pdf'):
+                        return
+                    # Đường dẫn ảo (không tồn tại trên đĩa) chỉ dùng để giữ cấu trúc folder + tên sách
+                    relative_path = spec['relative_path']
+                    virtual_path = os.path.join(root_download_path, relative_path, spec['name'])
+                    self.pdf_folder_mapping[virtual_path] = relative_path
+                    if on_pdf_ready:
+                        on_pdf_ready((virtual_path, data))
+                
+                specs = drive_api.stream_pdfs_with_structure(
+                    folder_id, max_workers=IN_MEMORY_DOWNLOAD_WORKERS,
+                    progress_callback=on_download_progress, on_file_done=on_memory_file_done
+                )
+                downloaded = [os.path.join(root_download_path, spec['relative_path'], spec['name']) for spec in specs]
+            elif self.sync_mode:
+                downloaded = drive_api.sync_pdfs_with_structure(
+                    folder_id, download_folder,
+                    progress_callback=on_download_progress, on_file_done=on_file_done
+                )
+            else:
+                downloaded = drive_api.download_all_pdfs_with_structure(
+                    folder_id, download_folder,
+                    progress_callback=on_download_progress, on_file_done=on_file_done
+                )
             
-            for root, dirs, files in os.walk(root_download_path):
-                for file in files:
-                    if file.lower().endswith('.pdf'):
-                        pdf_path = os.path.join(root, file)
-                        
-                        # Tính relative path từ root_download_path
-                        relative_path = os.path.relpath(os.path.dirname(pdf_path), root_download_path)
-                        if relative_path == ".":
-                            relative_path = ""  # File ở root folder
-                        
-                        # Lưu mapping
-                        self.pdf_folder_mapping[pdf_path] = relative_path
-                        pdf_files.append(pdf_path)
-            
-            return pdf_files
+            return sorted(path for path in downloaded if path.lower().endswith('.pdf'))
             
         except Exception as e:
             raise Exception(f"Lỗi khi tải từ Google Drive: {str(e)}")
     
-    def _process_single_pdf_with_structure(self, pdf_path, vertex_client, base_progress):
-        """Process single PDF: AI analysis → Cut PDF với cấu trúc folder"""
+    def _process_single_pdf_with_structure(self, pdf_path, vertex_client, base_progress, pdf_bytes=None):
+        """
+        Process single PDF: AI analysis → Cut PDF với cấu trúc folder.
+        pdf_bytes: nội dung PDF trong RAM (chế độ in-memory) - dùng cho cả AI lẫn bước cắt.
+        """
         try:
             # Read prompt
             with open(self.prompt_path, 'r', encoding='utf-8') as f:
                 prompt = f.read()
             
-            # Send to AI
-            self.progress.emit(f"Gửi lên AI: {os.path.basename(pdf_path)}", base_progress + 10)
-            ai_result = vertex_client.send_data_to_AI(prompt, pdf_path)
-            
-            # Parse JSON response
-            self.progress.emit(f"Phân tích kết quả AI: {os.path.basename(pdf_path)}", base_progress + 20)
-            json_data = self._parse_ai_response(ai_result)
-            
-            if not json_data:
-                raise ValueError("Không thể phân tích kết quả từ AI")
-            
             # ⭐ TạO OUTPUT FOLDER THEO CẤU TRÚC GỐC ⭐
             file_name = os.path.splitext(os.path.basename(pdf_path))[0]
             
@@ -161,25 +256,85 @@ class AutoProcessor(QThread):
             else:
                 output_folder = os.path.join(self.base_download_path, "processed", file_name)
             
+            prompt_sha = text_sha256(prompt)
+            plan = None
+            if self.incremental:
+                plan = plan_book(pdf_path, output_folder, file_name, prompt_sha, pdf_bytes=pdf_bytes)
+                if plan["action"] == "skip":
+                    self.progress.emit(f"⏭️ Không đổi, bỏ qua: {os.path.basename(pdf_path)}", base_progress + 30)
+                    return plan["valid_files"]
+                if plan["action"] == "recut":
+                    return self._recut_from_checkpoint(pdf_path, plan, output_folder, file_name, prompt_sha,
+                                                       base_progress, pdf_bytes=pdf_bytes)
+            
+            # Send to AI
+            self.progress.emit(f"Gửi lên AI: {os.path.basename(pdf_path)}", base_progress + 10)
+            if pdf_bytes is not None:
+                ai_result = vertex_client.send_data_to_AI(prompt, pdf_bytes=pdf_bytes)
+            else:
+                ai_result = vertex_client.send_data_to_AI(prompt, pdf_path)
+            
+            # Parse JSON response
+            self.progress.emit(f"Phân tích kết quả AI: {os.path.basename(pdf_path)}", base_progress + 20)
+            json_data = self._parse_ai_response(ai_result)
+            
+            if not json_data:
+                raise ValueError("Không thể phân tích kết quả từ AI")
+            
             os.makedirs(output_folder, exist_ok=True)
             
             # Save JSON result
             json_path = os.path.join(output_folder, f"{file_name}.json")
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(json_data, f, ensure_ascii=False, indent=2)
+            with open(json_path, 'wb') as f:
+                f.write(fast_json.dumps_bytes(json_data))
             
             # Cut PDF into parts
             self.progress.emit(f"Cắt PDF: {os.path.basename(pdf_path)}", base_progress + 30)
-            generated_files = self._cut_pdf_by_ai_result(pdf_path, json_data, output_folder, file_name)
+            pdf_reader = open_pdf_reader(pdf_bytes if pdf_bytes is not None else pdf_path)
+            generated_files = self._cut_pdf_by_ai_result(pdf_reader, json_data, output_folder, file_name)
             
             # Create Excel summary
             self._create_excel_summary(json_data, output_folder, file_name)
             
+            # Lưu checkpoint để lần chạy incremental sau bỏ qua sách này nếu không đổi
+            if plan:
+                source_fp = plan["source_fp"]
+            elif pdf_bytes is not None:
+                source_fp = fingerprint_bytes(pdf_bytes)
+            else:
+                source_fp = fingerprint_file(pdf_path)
+            save_checkpoint(output_folder, file_name, source_fp, prompt_sha, json_data, generated_files,
+                            previous=plan["checkpoint"] if plan else None)
+            
             return generated_files
             
         except Exception as e:
             raise Exception(f"Lỗi xử lý {os.path.basename(pdf_path)}: {str(e)}")
     
+    def _recut_from_checkpoint(self, pdf_path, plan, output_folder, book_name, prompt_sha, base_progress, pdf_bytes=None):
+        """PDF nguồn + prompt không đổi: dùng lại JSON cũ, chỉ cắt lại các bài bị thiếu / hỏng"""
+        json_data = plan["json_data"]
+        valid_files = set(plan["valid_files"])
+        missing = [bai for bai in json_data if self._lesson_output_path(output_folder, book_name, bai) not in valid_files]
+        self.progress.emit(f"♻️ Dùng lại kết quả AI, cắt lại {len(missing)} bài: {os.path.basename(pdf_path)}", base_progress + 30)
+        
+        pdf_reader = open_pdf_reader(pdf_bytes if pdf_bytes is not None else pdf_path)
+        recut_files = set(self._cut_pdf_by_ai_result(pdf_reader, missing, output_folder, book_name))
+        generated_files = []
+        for bai in json_data:
+            output_path = self._lesson_output_path(output_folder, book_name, bai)
+            if output_path in valid_files or output_path in recut_files:
+                generated_files.append(output_path)
+        
+        save_checkpoint(output_folder, book_name, plan["source_fp"], prompt_sha, json_data, generated_files,
+                        previous=plan["checkpoint"])
+        return generated_files
+    
+    def _lesson_output_path(self, output_folder, book_name, bai):
+        """Đường dẫn file bài: Tên sách + Tên bài.pdf"""
+        safe_name = re.sub(r"[:\\/\"*?<>|]", ".", bai['name'])
+        return os.path.join(output_folder, f"{book_name} + {safe_name}.pdf")
+    
     def _parse_ai_response(self, ai_result):
         """
         Xử lý chuyên sâu cho tiếng Trung và cấu trúc JSON từ Gemini.
@@ -198,7 +353,7 @@ class AutoProcessor(QThread):
             
             # 3. Parse JSON với strict=False để chấp nhận các ký tự điều khiển (control characters) 
             # thường xuất hiện khi AI trả về văn bản tiếng Trung
-            data = json.loads(json_str, strict=False)
+            data = fast_json.loads(json_str, strict=False)
             
             processed_data = []
             for item in data:
@@ -223,14 +378,16 @@ class AutoProcessor(QThread):
             return None
     
     def _cut_pdf_by_ai_result(self, pdf_path, json_data, output_folder, book_name):
-        """Cut PDF based on AI analysis result (không nén)"""
+        """
+        Cut PDF based on AI analysis result (không nén).
+        pdf_path: đường dẫn hoặc PdfReader đã mở (parse sách 1 lần cho mọi bài).
+        """
         generated_files = []
         
         for idx, bai in enumerate(json_data):
             try:
-                safe_name = re.sub(r"[:\\/\"*?<>|]", ".", bai['name'])
-                output_filename = f"{book_name} + {safe_name}.pdf"
-                output_path = os.path.join(output_folder, output_filename)
+                output_path = self._lesson_output_path(output_folder, book_name, bai)
+                output_filename = os.path.basename(output_path)
                 
                 # ⭐ CHỈ CẮT, KHÔNG NÉN ⭐
                 cut_pdf_by_pages(
@@ -1,5 +1,4 @@
 import os
-import json
 import re
 import xlsxwriter
 import sys
@@ -7,6 +6,9 @@ from PyQt5.QtCore import QThread, pyqtSignal
 
 from core.callAPI import VertexClient
 from core.cutPDF import cut_pdf_by_pages
+from core.cut_checkpoint import plan_book, save_checkpoint, fingerprint_file
+from core.hashing import text_sha256
+from modules.common import fast_json
 
 class LocalProcessor(QThread):
     """
@@ -17,13 +19,15 @@ class LocalProcessor(QThread):
     finished = pyqtSignal(list)  # danh sách tất cả file đã tạo
     file_completed = pyqtSignal(str, list)  # file_name, generated_files
 
-    def __init__(self, local_folder_path, pdf_files, prompt_path, project_id, creds):
+    def __init__(self, local_folder_path, pdf_files, prompt_path, project_id, creds, incremental=False):
         super().__init__()
         self.local_folder_path = local_folder_path
         self.pdf_files = pdf_files
         self.prompt_path = prompt_path
         self.project_id = project_id
         self.creds = creds
+        # Incremental: chỉ gửi AI / cắt lại sách có PDF nguồn hoặc prompt thay đổi
+        self.incremental = incremental
         
         # Tạo thư mục output
         if getattr(sys, 'frozen', False):
@@ -92,6 +96,25 @@ class LocalProcessor(QThread):
             with open(self.prompt_path, 'r', encoding='utf-8') as f:
                 prompt = f.read()
             
+            # Create output folder với cấu trúc tương tự
+            file_name = os.path.splitext(os.path.basename(pdf_path))[0]
+            relative_folder = self.pdf_folder_mapping.get(pdf_path, "")
+            
+            if relative_folder:
+                output_folder = os.path.join(self.output_base_path, "processed", relative_folder, file_name)
+            else:
+                output_folder = os.path.join(self.output_base_path, "processed", file_name)
+            
+            prompt_sha = text_sha256(prompt)
+            plan = None
+            if self.incremental:
+                plan = plan_book(pdf_path, output_folder, file_name, prompt_sha)
+                if plan["action"] == "skip":
+                    self.progress.emit(f"⏭️ Không đổi, bỏ qua: {os.path.basename(pdf_path)}", base_progress + 30)
+                    return plan["valid_files"]
+                if plan["action"] == "recut":
+                    return self._recut_from_checkpoint(pdf_path, plan, output_folder, file_name, prompt_sha, base_progress)
+            
             # Send to AI
             self.progress.emit(f"Gửi lên AI: {os.path.basename(pdf_path)}", base_progress + 10)
             ai_result = vertex_client.send_data_to_AI(prompt, pdf_path)
@@ -103,21 +126,12 @@ class LocalProcessor(QThread):
             if not json_data:
                 raise ValueError("Không thể phân tích kết quả từ AI")
             
-            # Create output folder với cấu trúc tương tự
-            file_name = os.path.splitext(os.path.basename(pdf_path))[0]
-            relative_folder = self.pdf_folder_mapping.get(pdf_path, "")
-            
-            if relative_folder:
-                output_folder = os.path.join(self.output_base_path, "processed", relative_folder, file_name)
-            else:
-                output_folder = os.path.join(self.output_base_path, "processed", file_name)
-            
             os.makedirs(output_folder, exist_ok=True)
             
             # Save JSON result
             json_path = os.path.join(output_folder, f"{file_name}.json")
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(json_data, f, ensure_ascii=False, indent=2)
+            with open(json_path, 'wb') as f:
+                f.write(fast_json.dumps_bytes(json_data))
             
             # Cut PDF into parts
             self.progress.emit(f"Cắt PDF: {os.path.basename(pdf_path)}", base_progress + 30)
@@ -126,11 +140,39 @@ class LocalProcessor(QThread):
             # Create Excel summary
             self._create_excel_summary(json_data, output_folder, file_name)
             
+            # Lưu checkpoint để lần chạy incremental sau bỏ qua sách này nếu không đổi
+            source_fp = plan["source_fp"] if plan else fingerprint_file(pdf_path)
+            save_checkpoint(output_folder, file_name, source_fp, prompt_sha, json_data, generated_files,
+                            previous=plan["checkpoint"] if plan else None)
+            
             return generated_files
             
         except Exception as e:
             raise Exception(f"Lỗi xử lý {os.path.basename(pdf_path)}: {str(e)}")
     
+    def _recut_from_checkpoint(self, pdf_path, plan, output_folder, book_name, prompt_sha, base_progress):
+        """PDF nguồn + prompt không đổi: dùng lại JSON cũ, chỉ cắt lại các bài bị thiếu / hỏng"""
+        json_data = plan["json_data"]
+        valid_files = set(plan["valid_files"])
+        missing = [bai for bai in json_data if self._lesson_output_path(output_folder, book_name, bai) not in valid_files]
+        self.progress.emit(f"♻️ Dùng lại kết quả AI, cắt lại {len(missing)} bài: {os.path.basename(pdf_path)}", base_progress + 30)
+        
+        recut_files = set(self._cut_pdf_by_ai_result(pdf_path, missing, output_folder, book_name))
+        generated_files = []
+        for bai in json_data:
+            output_path = self._lesson_output_path(output_folder, book_name, bai)
+            if output_path in valid_files or output_path in recut_files:
+                generated_files.append(output_path)
+        
+        save_checkpoint(output_folder, book_name, plan["source_fp"], prompt_sha, json_data, generated_files,
+                        previous=plan["checkpoint"])
+        return generated_files
+    
+    def _lesson_output_path(self, output_folder, book_name, bai):
+        """Đường dẫn file bài: Tên sách - Tên bài.pdf"""
+        safe_name = re.sub(r"[:\\/\"*?<>|]", ".", bai['name'])
+        return os.path.join(output_folder, f"{book_name} - {safe_name}.pdf")
+    
     def _parse_ai_response(self, ai_result):
         """
         Xử lý chuyên sâu cho tiếng Trung và cấu trúc JSON từ Gemini.
@@ -149,7 +191,7 @@ class LocalProcessor(QThread):
             
             # 3. Parse JSON với strict=False để chấp nhận các ký tự điều khiển (control characters) 
             # thường xuất hiện khi AI trả về văn bản tiếng Trung
-            data = json.loads(json_str, strict=False)
+            data = fast_json.loads(json_str, strict=False)
             
             processed_data = []
             for item in data:
@@ -179,12 +221,8 @@ class LocalProcessor(QThread):
         
         for idx, bai in enumerate(json_data):
             try:
-                # Clean filename
-                safe_name = re.sub(r"[:\\/\"*?<>|]", ".", bai['name'])
-                
-                # Đặt tên file: "Tên sách + Tên bài.pdf"
-                output_filename = f"{book_name} - {safe_name}.pdf"
-                output_path = os.path.join(output_folder, output_filename)
+                # Đặt tên file: "Tên sách - Tên bài.pdf"
+                output_path = self._lesson_output_path(output_folder, book_name, bai)
                 
                 # Cut PDF
                 cut_pdf_by_pages(
@@ -4,11 +4,34 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import QFont
 from datetime import datetime
-import requests
 import time
+import shutil
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # THÊM IMPORT CHO GOOGLE DRIVE
 from core.client_driver import GoogleDriveAPI  # THÊM DÒNG NÀY
+from core.mathpix_cache import MathpixCache, CACHE_FILE_NAME
+from core.mathpix_client import MathpixClient
+from core.mathpix_chunking import split_pdf, stitch_outputs, CHUNK_DIR_NAME
+
+# ============================================================
+# CẤU HÌNH PIPELINE MATHPIX
+# ============================================================
+DEFAULT_MATHPIX_CONCURRENCY = 4   # Số file upload / download cùng lúc
+MAX_MATHPIX_CONCURRENCY = 10
+POLL_INITIAL_INTERVAL = 2         # Giây chờ trước lần check status đầu tiên
+POLL_BACKOFF_FACTOR = 1.5         # Mỗi lần chưa xong thì giãn khoảng check
+POLL_MAX_INTERVAL = 30
+FIXED_WAIT_SECONDS = 15           # Khi tắt smart waiting
+MAX_PROCESSING_TIME = 300         # Quá thời gian này tính là timeout
+CHUNK_MAX_ATTEMPTS = 3            # Số lần gửi 1 đoạn PDF trước khi coi cả sách là lỗi
+
+# Tên file output theo format Mathpix
+MATHPIX_OUTPUT_NAMES = {
+    "md": "{base}.md",
+    "docx": "{base}_converted.docx",
+    "pdf": "{base}_ocr.pdf",
+}
 
 class ConvertPdfWidget(QWidget):
     # Signals để giao tiếp với main window
@@ -23,6 +46,7 @@ class ConvertPdfWidget(QWidget):
         self.selected_pdfs = []
         self.converted_files = []
         self.conversion_thread = None
+        self.cache_hits = {"output": 0, "pdf_id": 0}
         
         # Mathpix credentials
         self.app_key = None
@@ -190,7 +214,9 @@ class ConvertPdfWidget(QWidget):
         self.format_combo.addItems([
             "📝 Markdown (.md)", 
             "📄 DOCX (Microsoft Word)", 
-            "📃 PDF (OCR Enhanced)"
+            "📃 PDF (OCR Enhanced)",
+            "📚 Markdown + DOCX (1 lần upload)",
+            "📦 Markdown + DOCX + PDF (1 lần upload)"
         ])
         self.format_combo.setCurrentIndex(0)
         format_layout.addWidget(format_label)
@@ -224,6 +250,28 @@ class ConvertPdfWidget(QWidget):
         self.smart_wait_checkbox.setChecked(True)
         self.smart_wait_checkbox.setToolTip("Tự động kiểm tra status thay vì chờ cố định 15 giây")
         
+        # Số file xử lý song song
+        concurrency_layout = QHBoxLayout()
+        concurrency_label = QLabel("Số file song song:")
+        self.concurrency_spin = QSpinBox()
+        self.concurrency_spin.setRange(1, MAX_MATHPIX_CONCURRENCY)
+        self.concurrency_spin.setValue(DEFAULT_MATHPIX_CONCURRENCY)
+        self.concurrency_spin.setToolTip("Số file upload / download cùng lúc. Mathpix xử lý song song phía server.")
+        concurrency_layout.addWidget(concurrency_label)
+        concurrency_layout.addWidget(self.concurrency_spin)
+        
+        # Chia PDF lớn thành nhiều đoạn trang
+        chunk_label = QLabel("Chia PDF lớn (trang/đoạn):")
+        self.chunk_pages_spin = QSpinBox()
+        self.chunk_pages_spin.setRange(0, 1000)
+        self.chunk_pages_spin.setSingleStep(25)
+        self.chunk_pages_spin.setValue(0)
+        self.chunk_pages_spin.setSpecialValueText("Tắt")
+        self.chunk_pages_spin.setToolTip("PDF dài hơn số trang này được chia đoạn, gửi song song rồi ghép lại theo thứ tự")
+        concurrency_layout.addWidget(chunk_label)
+        concurrency_layout.addWidget(self.chunk_pages_spin)
+        concurrency_layout.addStretch()
+        
         # Credentials status
         self.credentials_status = QLabel()
         self.update_credentials_status()
@@ -234,6 +282,7 @@ class ConvertPdfWidget(QWidget):
         layout.addWidget(self.keep_original_checkbox)
         layout.addWidget(self.auto_open_checkbox)
         layout.addWidget(self.smart_wait_checkbox)
+        layout.addLayout(concurrency_layout)
         layout.addWidget(self.credentials_status)
         
         group.setLayout(layout)
@@ -443,6 +492,7 @@ class ConvertPdfWidget(QWidget):
             f"Bạn có muốn convert {len(self.selected_pdfs)} PDF files?\n\n"
             f"Output format: {format_text}\n"
             f"Smart waiting: {'Enabled' if self.smart_wait_checkbox.isChecked() else 'Disabled'}\n"
+            f"Song song: {self.concurrency_spin.value()} file\n"
             f"Quá trình này có thể mất vài phút...",
             QMessageBox.Yes | QMessageBox.No
         )
@@ -472,7 +522,9 @@ class ConvertPdfWidget(QWidget):
             self.app_key,
             self.app_id,
             self.format_combo.currentText(),
-            self.smart_wait_checkbox.isChecked()
+            self.smart_wait_checkbox.isChecked(),
+            max_concurrent=self.concurrency_spin.value(),
+            chunk_pages=self.chunk_pages_spin.value()
         )
         
         # Connect signals
@@ -480,6 +532,7 @@ class ConvertPdfWidget(QWidget):
         self.conversion_thread.file_completed.connect(self.on_file_completed)
         self.conversion_thread.conversion_finished.connect(self.on_conversion_finished)
         self.conversion_thread.error_occurred.connect(self.on_error_occurred)
+        self.conversion_thread.cache_hit.connect(self.on_cache_hit)
         
         # Update UI
         self.set_conversion_ui_state(True)
@@ -575,7 +628,16 @@ class ConvertPdfWidget(QWidget):
                          if self.results_list.item(item).text().startswith("✅")])
         failed = self.results_list.count() - successful
         
-        self.stats_label.setText(f"Statistics: {successful}, {failed} failed")
+        stats_text = f"Statistics: {successful}, {failed} failed"
+        if self.cache_hits["output"] or self.cache_hits["pdf_id"]:
+            stats_text += (f" | ♻️ Cache: {self.cache_hits['output']} bỏ qua, "
+                           f"{self.cache_hits['pdf_id']} không upload lại")
+        self.stats_label.setText(stats_text)
+
+    def on_cache_hit(self, original_file, kind):
+        """Đếm số file dùng lại kết quả Mathpix từ cache"""
+        self.cache_hits[kind] = self.cache_hits.get(kind, 0) + 1
+        self.update_statistics()
 
     def open_results_folder(self):
         """Mở thư mục kết quả"""
@@ -693,8 +755,10 @@ class ConversionThread(QThread):
     file_completed = pyqtSignal(str, str, bool, str)  # original, output, success, error
     conversion_finished = pyqtSignal(int, int)  # successful, failed
     error_occurred = pyqtSignal(str)
+    cache_hit = pyqtSignal(str, str)  # original, kind ("output" = bỏ qua hẳn, "pdf_id" = không upload lại)
     
-    def __init__(self, pdf_files, output_folder, app_key, app_id, output_format, smart_wait=True):
+    def __init__(self, pdf_files, output_folder, app_key, app_id, output_format, smart_wait=True,
+                 max_concurrent=DEFAULT_MATHPIX_CONCURRENCY, use_cache=True, chunk_pages=0):
         super().__init__()
         self.pdf_files = pdf_files
         self.output_folder = output_folder
@@ -702,42 +766,223 @@ class ConversionThread(QThread):
         self.app_id = app_id
         self.output_format = output_format
         self.smart_wait = smart_wait
+        self.max_concurrent = max(1, max_concurrent)
         self.should_stop = False
+        # 1 session Mathpix cho cả pool upload + download (đủ kết nối cho 2 pool)
+        self.client = MathpixClient(app_key, app_id, pool_size=2 * self.max_concurrent + 2)
+        # Cache theo hash nội dung PDF (dùng chung mọi output folder)
+        self.cache = MathpixCache(os.path.join(self._app_dir(), CACHE_FILE_NAME)) if use_cache else None
+        # Chia đoạn: PDF dài hơn chunk_pages trang được gửi thành nhiều job (0 = tắt)
+        self.chunk_pages = chunk_pages
+        self._chunk_parent = {}  # đường dẫn đoạn -> PDF gốc
         
     def stop_conversion(self):
         """Dừng conversion"""
         self.should_stop = True
         
     def run(self):
-        """Chạy conversion"""
+        """
+        Chạy conversion dạng pipeline:
+        - Upload tối đa max_concurrent file cùng lúc (Mathpix xử lý song song phía server)
+        - 1 vòng lặp duy nhất check status mọi pdf_id đang chờ, mỗi job có backoff riêng
+          (2s, x1.5 mỗi lần, tối đa 30s)
+        - Job nào xong thì tải kết quả ngay, không chờ các file khác
+        - Chế độ chia đoạn: mỗi đoạn trang là 1 job riêng (lỗi thì gửi lại riêng đoạn đó),
+          đủ các đoạn thì ghép kết quả theo thứ tự
+        """
         successful = 0
         failed = 0
         total_files = len(self.pdf_files)
         
+        upload_pool = ThreadPoolExecutor(max_workers=self.max_concurrent)
+        download_pool = ThreadPoolExecutor(max_workers=self.max_concurrent)
+        splits = {}     # future -> pdf_file (đang chia đoạn)
+        uploads = {}    # future -> pdf_file
+        stitches = {}   # future -> pdf_file (đang ghép kết quả các đoạn)
+        chunk_groups = {}  # pdf_file -> {chunks, outputs, attempts, done}
+        downloads = {}  # future -> (job, format)
+        polling = {}    # pdf_file -> job {pdf_id, hash, reused, started, next_check, interval}
+        last_status = None
+        
+        def schedule(job, first_wait):
+            now = time.time()
+            job.update(started=now, next_check=now + first_wait, interval=POLL_INITIAL_INTERVAL)
+            polling[job["pdf_file"]] = job
+        
+        def retry_without_cache(job):
+            """pdf_id cũ trong cache không dùng được nữa -> bỏ cache, upload lại"""
+            print(f"♻️ pdf_id cache hết hiệu lực, upload lại: {os.path.basename(job['pdf_file'])}")
+            if self.cache and job["hash"]:
+                self.cache.forget(job["hash"])
+            uploads[upload_pool.submit(self._prepare_job, job["pdf_file"], False)] = job["pdf_file"]
+        
+        def file_done(pdf_file, outputs):
+            """1 job xong đủ format: file thường -> báo luôn, đoạn -> chờ đủ đoạn rồi ghép"""
+            nonlocal successful
+            parent = self._chunk_parent.get(pdf_file)
+            if parent is None:
+                successful += 1
+                for output_file in outputs.values():
+                    self.file_completed.emit(pdf_file, output_file, True, "")
+                return
+            group = chunk_groups[parent]
+            if group["done"]:
+                return
+            group["outputs"][pdf_file] = dict(outputs)
+            if len(group["outputs"]) == len(group["chunks"]):
+                group["done"] = True
+                stitches[download_pool.submit(self._stitch_chunks, parent, group)] = parent
+        
+        def file_failed(pdf_file, error_msg):
+            """1 job lỗi: đoạn còn lượt thì gửi lại riêng đoạn đó, hết lượt thì cả sách lỗi"""
+            nonlocal failed
+            parent = self._chunk_parent.get(pdf_file)
+            if parent is None:
+                failed += 1
+                self.file_completed.emit(pdf_file, "", False, error_msg)
+                return
+            group = chunk_groups[parent]
+            if group["done"]:
+                return
+            attempts = group["attempts"][pdf_file] = group["attempts"].get(pdf_file, 0) + 1
+            if attempts < CHUNK_MAX_ATTEMPTS:
+                print(f"🔁 Gửi lại đoạn {os.path.basename(pdf_file)} (lần {attempts + 1}/{CHUNK_MAX_ATTEMPTS}): {error_msg}")
+                uploads[upload_pool.submit(self._prepare_job, pdf_file, False)] = pdf_file
+                return
+            group["done"] = True
+            failed += 1
+            self.file_completed.emit(parent, "", False, f"Đoạn {os.path.basename(pdf_file)} lỗi: {error_msg}")
+        
         try:
-            for i, pdf_file in enumerate(self.pdf_files):
-                if self.should_stop:
-                    break
-                    
-                # Update overall progress
-                overall_percent = int((i / total_files) * 100)
-                file_name = os.path.basename(pdf_file)
-                self.progress_updated.emit(overall_percent, 0, f"Converting {file_name} ({i+1}/{total_files})")
+            for pdf_file in self.pdf_files:
+                if self.chunk_pages > 0:
+                    splits[upload_pool.submit(self._split_job, pdf_file)] = pdf_file
+                else:
+                    uploads[upload_pool.submit(self._prepare_job, pdf_file)] = pdf_file
+            
+            while (splits or uploads or polling or downloads or stitches) and not self.should_stop:
+                # 0. Chia đoạn xong -> mỗi đoạn thành 1 job (file nhỏ thì đi như bình thường)
+                for future in [f for f in splits if f.done()]:
+                    pdf_file = splits.pop(future)
+                    if future.exception():
+                        failed += 1
+                        self.file_completed.emit(pdf_file, "", False, f"Không chia được PDF: {future.exception()}")
+                        continue
+                    result = future.result()
+                    if result is None:
+                        uploads[upload_pool.submit(self._prepare_job, pdf_file)] = pdf_file
+                    elif result["outputs"]:
+                        successful += 1
+                        self.cache_hit.emit(pdf_file, "output")
+                        for output_file in result["outputs"].values():
+                            self.file_completed.emit(pdf_file, output_file, True, "")
+                    else:
+                        chunk_groups[pdf_file] = {"chunks": result["chunks"], "hash": result["hash"],
+                                                  "work_dir": result["work_dir"],
+                                                  "outputs": {}, "attempts": {}, "done": False}
+                        for chunk_path in result["chunks"]:
+                            self._chunk_parent[chunk_path] = pdf_file
+                            uploads[upload_pool.submit(self._prepare_job, chunk_path)] = chunk_path
+                
+                # 1. Hash + tra cache + upload xong -> đưa vào danh sách chờ xử lý
+                for future in [f for f in uploads if f.done()]:
+                    pdf_file = uploads.pop(future)
+                    job = future.result() if not future.exception() else None
+                    if job and not job["pending"]:
+                        # Mọi output (cùng nội dung PDF + format) đã có sẵn -> bỏ qua hẳn
+                        self.cache_hit.emit(self._chunk_parent.get(pdf_file, pdf_file), "output")
+                        file_done(pdf_file, job["outputs"])
+                        continue
+                    if not job or not job["pdf_id"]:
+                        file_failed(pdf_file, "Failed to upload PDF")
+                        continue
+                    if job["reused"]:
+                        # Đã xử lý trên Mathpix từ trước -> check status ngay
+                        self.cache_hit.emit(self._chunk_parent.get(pdf_file, pdf_file), "pdf_id")
+                        schedule(job, 0)
+                        print(f"♻️ Dùng lại PDF ID từ cache: {os.path.basename(pdf_file)} ({job['pdf_id'][:8]}...)")
+                    else:
+                        schedule(job, POLL_INITIAL_INTERVAL if self.smart_wait else FIXED_WAIT_SECONDS)
+                        print(f"⬆️ Uploaded {os.path.basename(pdf_file)} (PDF ID: {job['pdf_id'][:8]}...)")
                 
-                # Convert single file
-                success, output_file, error_msg = self.convert_single_file(pdf_file)
+                # 2. Check status các job đến hạn
+                now = time.time()
+                for pdf_file, job in list(polling.items()):
+                    if self.should_stop or job["next_check"] > now:
+                        continue
+                    state = self._poll_job(pdf_file, job)
+                    if state == "completed":
+                        # Tải song song mọi format còn thiếu của job
+                        polling.pop(pdf_file)
+                        for fmt in sorted(job["pending"]):
+                            downloads[download_pool.submit(self.download_result, job["pdf_id"], pdf_file, fmt)] = (job, fmt)
+                            job["in_flight"] += 1
+                    elif state is not None:
+                        polling.pop(pdf_file)
+                        if job["reused"]:
+                            retry_without_cache(job)
+                            continue
+                        file_failed(pdf_file, state)
+                
+                # 3. Tải xong -> báo kết quả (job xong khi mọi format đã tải)
+                for future in [f for f in downloads if f.done()]:
+                    job, fmt = downloads.pop(future)
+                    pdf_file = job["pdf_file"]
+                    job["in_flight"] -= 1
+                    output_file = future.result() if not future.exception() else None
+                    if output_file and os.path.exists(output_file):
+                        job["pending"].discard(fmt)
+                        job["outputs"][fmt] = output_file
+                        if self.cache and job["hash"]:
+                            self.cache.record_output(job["hash"], fmt, output_file)
+                    if job["in_flight"]:
+                        continue
+                    
+                    if not job["pending"]:
+                        file_done(pdf_file, job["outputs"])
+                    elif job["reused"] and time.time() - job["started"] < MAX_PROCESSING_TIME:
+                        # Format mới của pdf_id cũ có thể đang được Mathpix convert -> thử lại sau
+                        job["interval"] = min(job["interval"] * POLL_BACKOFF_FACTOR, POLL_MAX_INTERVAL)
+                        job["next_check"] = time.time() + job["interval"]
+                        polling[pdf_file] = job
+                    elif job["reused"]:
+                        retry_without_cache(job)
+                    else:
+                        missing = ", ".join(sorted(job["pending"]))
+                        file_failed(pdf_file, f"Failed to download result ({missing})")
                 
-                if success:
+                # 3b. Ghép xong kết quả các đoạn -> báo kết quả cho PDF gốc
+                for future in [f for f in stitches if f.done()]:
+                    pdf_file = stitches.pop(future)
+                    if future.exception():
+                        failed += 1
+                        self.file_completed.emit(pdf_file, "", False, f"Không ghép được kết quả: {future.exception()}")
+                        continue
                     successful += 1
-                    self.file_completed.emit(pdf_file, output_file, True, "")
-                else:
-                    failed += 1
-                    self.file_completed.emit(pdf_file, "", False, error_msg)
+                    for output_file in future.result().values():
+                        self.file_completed.emit(pdf_file, output_file, True, "")
                 
-                # Delay giữa các file để tránh rate limit
-                if i < total_files - 1 and not self.should_stop:
-                    self.progress_updated.emit(-1, -1, "Waiting 3 seconds to avoid rate limit...")
-                    time.sleep(3)
+                # 4. Tiến độ tổng hợp (chỉ emit khi có thay đổi)
+                finished = successful + failed
+                uploaded = total_files - len(uploads) - len(splits)
+                status_message = (f"⬆️ Upload: {len(uploads) + len(splits)} | 🔄 Processing: {len(polling)} | "
+                                  f"⬇️ Download: {len(downloads)} | ✅ {finished}/{total_files}")
+                if status_message != last_status:
+                    last_status = status_message
+                    self.progress_updated.emit(
+                        int((finished / total_files) * 100) if total_files else 100,
+                        int((uploaded / total_files) * 100) if total_files else 100,
+                        status_message
+                    )
+                
+                # 5. Ngủ tới khi có upload/download xong hoặc job kế tiếp đến hạn check
+                next_due = min((job["next_check"] for job in polling.values()), default=time.time() + 1)
+                timeout = min(1.0, max(0.05, next_due - time.time()))
+                pending = list(splits) + list(uploads) + list(downloads) + list(stitches)
+                if pending:
+                    wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(timeout)
             
             # Final progress update
             if not self.should_stop:
@@ -746,218 +991,183 @@ class ConversionThread(QThread):
             
         except Exception as e:
             self.error_occurred.emit(str(e))
+        finally:
+            upload_pool.shutdown(wait=False, cancel_futures=True)
+            download_pool.shutdown(wait=False, cancel_futures=True)
+            if not self.should_stop:
+                self.client.close()
     
-    def convert_single_file(self, pdf_file):
-        """Convert một file PDF - TÍCH HỢP từ convert_odf_md.py"""
-        try:
-            # Update current file progress
-            file_name = os.path.basename(pdf_file)
-            file_size = os.path.getsize(pdf_file) / (1024 * 1024)  # MB
-            self.progress_updated.emit(-1, 10, f"Uploading {file_name} ({file_size:.1f}MB)")
-            
-            # 1. Upload PDF to Mathpix
-            pdf_id = self.send_pdf_to_mathpix(pdf_file)
-            if not pdf_id:
-                return False, "", "Failed to upload PDF"
-            
-            self.progress_updated.emit(-1, 30, f"Processing {file_name} (PDF ID: {pdf_id[:8]}...)")
-            
-            # 2. Wait for processing
-            if self.smart_wait:
-                # Smart waiting với status check
-                if not self.wait_for_conversion(pdf_id, file_name):
-                    return False, "", "Processing timeout or failed"
-            else:
-                # Fixed waiting
-                time.sleep(15)
-            
-            self.progress_updated.emit(-1, 80, f"Downloading {file_name}")
-            
-            # 3. Download result
-            output_file = self.download_result(pdf_id, pdf_file)
-            if not output_file:
-                return False, "", "Failed to download result"
-            
-            # 4. Verify output file
-            if os.path.exists(output_file):
-                file_size = os.path.getsize(output_file)
-                self.progress_updated.emit(-1, 100, f"Completed {file_name} ({file_size} bytes)")
-                return True, output_file, ""
-            else:
-                return False, "", "Output file not created"
-            
-        except Exception as e:
-            return False, "", str(e)
+    def _split_job(self, pdf_file):
+        """
+        Chạy trên pool upload: chia PDF lớn thành các đoạn trang.
+        Returns: None nếu không cần chia, hoặc {hash, work_dir, chunks, outputs}
+        (outputs khác rỗng: file ghép từ lần trước còn nguyên -> bỏ qua hẳn)
+        """
+        file_hash = MathpixCache.hash_file(pdf_file)
+        if self.cache:
+            outputs = {}
+            for fmt in self._format_keys():
+                output = self.cache.output_for(file_hash, fmt, self._output_path(pdf_file, fmt))
+                if output:
+                    outputs[fmt] = output
+            if len(outputs) == len(self._format_keys()):
+                return {"hash": file_hash, "work_dir": None, "chunks": [], "outputs": outputs}
+        
+        # Thư mục đoạn đặt theo hash nội dung -> chạy lại dùng lại được đoạn đã cắt
+        work_dir = os.path.join(self._base_output_dir(), CHUNK_DIR_NAME, file_hash[:16])
+        chunks = split_pdf(pdf_file, work_dir, self.chunk_pages)
+        if not chunks:
+            return None
+        return {"hash": file_hash, "work_dir": work_dir, "chunks": chunks, "outputs": {}}
+    
+    def _stitch_chunks(self, pdf_file, group):
+        """Chạy trên pool download: ghép kết quả các đoạn theo thứ tự thành output của PDF gốc"""
+        outputs = {}
+        for fmt in self._format_keys():
+            parts = [group["outputs"][chunk_path][fmt] for chunk_path in group["chunks"]]
+            outputs[fmt] = stitch_outputs(fmt, parts, self._output_path(pdf_file, fmt))
+        print(f"🧩 Đã ghép {len(group['chunks'])} đoạn: {os.path.basename(pdf_file)}")
+        
+        if self.cache:
+            # PDF gốc không có pdf_id riêng, chỉ ghi nhận output đã ghép
+            self.cache.record_upload(group["hash"], None, list(outputs), os.path.basename(pdf_file))
+            for fmt, output_file in outputs.items():
+                self.cache.record_output(group["hash"], fmt, output_file)
+        shutil.rmtree(group["work_dir"], ignore_errors=True)
+        return outputs
+    
+    def _prepare_job(self, pdf_file, allow_reuse=True):
+        """
+        Chạy trên pool upload: hash PDF, tra cache, chỉ upload khi cache không dùng được.
+        Trả về job {pdf_file, hash, pdf_id, reused, outputs, pending}:
+        - outputs: {format: file} đã có sẵn từ cache (không tải lại)
+        - pending: các format còn phải tải (rỗng -> bỏ qua hoàn toàn)
+        - reused: dùng lại pdf_id đã upload trước đó
+        """
+        formats = self._format_keys()
+        job = {"pdf_file": pdf_file, "hash": None, "pdf_id": None, "reused": False,
+               "outputs": {}, "pending": set(formats), "in_flight": 0}
+        if self.cache:
+            job["hash"] = self.cache.hash_file(pdf_file)
+            for fmt in formats:
+                output = self.cache.output_for(job["hash"], fmt, self._output_path(pdf_file, fmt))
+                if output:
+                    job["outputs"][fmt] = output
+                    job["pending"].discard(fmt)
+            if not job["pending"]:
+                return job
+            entry = self.cache.lookup(job["hash"])
+            if allow_reuse and entry and entry.get("pdf_id"):
+                job["pdf_id"] = entry["pdf_id"]
+                job["reused"] = True
+                return job
+        
+        job["pdf_id"] = self.send_pdf_to_mathpix(pdf_file)
+        if job["pdf_id"] and self.cache:
+            self.cache.record_upload(job["hash"], job["pdf_id"], formats, os.path.basename(pdf_file))
+            # pdf_id mới: tải lại mọi format để output khớp với job này
+            job["outputs"] = {}
+            job["pending"] = set(formats)
+        return job
+    
+    def _poll_job(self, pdf_file, job):
+        """
+        Check status 1 job. Trả về "completed", chuỗi lỗi nếu job hỏng / timeout,
+        hoặc None nếu còn đang xử lý (đã hẹn lần check tiếp theo).
+        """
+        file_name = os.path.basename(pdf_file)
+        elapsed = int(time.time() - job["started"])
+        
+        if not self.smart_wait:
+            # Fixed waiting: hết thời gian chờ cố định thì tải luôn
+            return "completed"
+        
+        status_result = self.check_conversion_status(job["pdf_id"])
+        status = status_result.get('status', 'unknown') if status_result else None
+        
+        if status == 'completed':
+            print(f"✅ {file_name} processed successfully ({elapsed}s)")
+            return "completed"
+        if status == 'error':
+            error_msg = status_result.get('error', 'Unknown error')
+            print(f"❌ Processing error {file_name}: {error_msg}")
+            return f"Processing error: {error_msg}"
+        if elapsed >= MAX_PROCESSING_TIME:
+            print(f"⏰ Timeout processing {file_name}")
+            return "Processing timeout or failed"
+        
+        job["interval"] = min(job["interval"] * POLL_BACKOFF_FACTOR, POLL_MAX_INTERVAL)
+        job["next_check"] = time.time() + job["interval"]
+        return None
     
     def send_pdf_to_mathpix(self, file_path):
-        """Gửi PDF lên Mathpix - TÍCH HỢP từ convert_odf_md.py"""
-        try:
-            with open(file_path, "rb") as f:
-                files = {
-                    "file": (os.path.basename(file_path), f, "application/pdf")
-                }
-                
-                # Specify conversion formats based on output format
-                data = {}
-                if "Markdown" in self.output_format:
-                    data["conversion_formats[md]"] = "true"
-                    data["conversion_formats[docx]"] = "false"
-                elif "DOCX" in self.output_format:
-                    data["conversion_formats[docx]"] = "true"
-                    data["conversion_formats[md]"] = "false"
-                
-                response = requests.post(
-                    "https://api.mathpix.com/v3/pdf",
-                    headers={
-                        "app_id": self.app_id,
-                        "app_key": self.app_key
-                    },
-                    files=files,
-                    data=data,
-                    timeout=120
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    return result.get('pdf_id')
-                else:
-                    print(f"❌ API Error: {response.status_code} - {response.text}")
-                    return None
-                    
-        except Exception as e:
-            print(f"❌ Upload error: {e}")
-            return None
+        """Gửi PDF lên Mathpix (bật mọi format đã chọn trên cùng 1 lần upload)"""
+        return self.client.upload_pdf(file_path, self._format_keys())
     
     def check_conversion_status(self, pdf_id):
-        """Kiểm tra trạng thái conversion - TỪ convert_odf_md.py"""
-        headers = {
-            'app_key': self.app_key,
-            'app_id': self.app_id
-        }
-        
-        try:
-            url = f"https://api.mathpix.com/v3/pdf/{pdf_id}"
-            response = requests.get(url, headers=headers, timeout=30)
-            
-            if response.status_code == 200:
-                result = response.json()
-                return result
-            else:
-                print(f"❌ Status check error: {response.status_code}")
-                return None
-        except Exception as e:
-            print(f"❌ Status check error: {e}")
-            return None
+        """Kiểm tra trạng thái conversion"""
+        return self.client.get_status(pdf_id)
     
-    def wait_for_conversion(self, pdf_id, file_name, max_wait_time=300):
-        """Chờ conversion hoàn thành - TỪ convert_odf_md.py"""
-        start_time = time.time()
-        check_interval = 10  # Check mỗi 10 giây
-        
-        while time.time() - start_time < max_wait_time and not self.should_stop:
-            status_result = self.check_conversion_status(pdf_id)
-            
-            if not status_result:
-                time.sleep(check_interval)
-                continue
-            
-            status = status_result.get('status', 'unknown')
-            elapsed = int(time.time() - start_time)
-            
-            if status == 'completed':
-                self.progress_updated.emit(-1, 70, f"✅ {file_name} processed successfully ({elapsed}s)")
-                return True
-            elif status == 'error':
-                error_msg = status_result.get('error', 'Unknown error')
-                self.progress_updated.emit(-1, 0, f"❌ Processing error: {error_msg}")
-                return False
-            elif status == 'processing':
-                self.progress_updated.emit(-1, 50, f"🔄 Processing {file_name}... ({elapsed}s)")
-            
-            time.sleep(check_interval)
+    def _base_output_dir(self):
+        """Thư mục output gốc: folder user chọn hoặc output/ trong thư mục project"""
+        if self.output_folder:
+            return self.output_folder
+        return os.path.join(self._app_dir(), "output")
+    
+    @staticmethod
+    def _app_dir():
+        if getattr(sys, 'frozen', False):
+            return os.path.dirname(sys.executable)
+        return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    
+    def _format_key(self):
+        """Format đang chọn trên UI -> key Mathpix (md / docx / pdf)"""
+        if "Markdown" in self.output_format:
+            return "md"
+        if "DOCX" in self.output_format:
+            return "docx"
+        return "pdf"
+    
+    def _format_keys(self):
+        """Danh sách format cần lấy từ 1 lần upload (chế độ nhiều format có dấu '+')"""
+        if "+" not in self.output_format:
+            return [self._format_key()]
+        return [fmt for fmt, label in (("md", "Markdown"), ("docx", "DOCX"), ("pdf", "PDF"))
+                if label in self.output_format]
+    
+    def _output_path(self, original_file, fmt):
+        """Đường dẫn file output - tạo folder theo tên folder gốc"""
+        if original_file in self._chunk_parent:
+            # Kết quả từng đoạn nằm cạnh file đoạn, chờ ghép
+            base_name = os.path.splitext(os.path.basename(original_file))[0]
+            return os.path.join(os.path.dirname(original_file), MATHPIX_OUTPUT_NAMES[fmt].format(base=base_name))
+        
+        # Tạo subfolder dựa trên tên folder chứa file gốc
+        original_dir_name = os.path.basename(os.path.dirname(original_file))
+        
+        # Nếu file từ Drive, lấy tên folder cuối cùng trong path
+        if "downloaded_pdfs" in original_file:
+            # Extract folder name từ path: .../downloaded_pdfs/folder_name/file.pdf
+            path_parts = original_file.split(os.sep)
+            if "downloaded_pdfs" in path_parts:
+                drive_index = path_parts.index("downloaded_pdfs")
+                if drive_index + 1 < len(path_parts) - 1:  # Có folder con sau downloaded_pdfs
+                    original_dir_name = path_parts[drive_index + 1]
+                else:
+                    original_dir_name = "drive_files"
         
-        # Timeout
-        self.progress_updated.emit(-1, 0, f"⏰ Timeout processing {file_name}")
-        return False
+        # Tạo thư mục output cuối cùng
+        output_dir = os.path.join(self._base_output_dir(), original_dir_name)
+        base_name = os.path.splitext(os.path.basename(original_file))[0]
+        return os.path.join(output_dir, MATHPIX_OUTPUT_NAMES[fmt].format(base=base_name))
     
-    def download_result(self, pdf_id, original_file):
+    def download_result(self, pdf_id, original_file, fmt=None):
         """Download kết quả conversion - CẬP NHẬT để tạo folder theo tên folder gốc"""
         try:
-            # Determine output directory structure
-            if self.output_folder:
-                # Sử dụng output folder được chỉ định
-                base_output_dir = self.output_folder
-            else:
-                # Tạo folder output trong thư mục gốc của project
-                if getattr(sys, 'frozen', False):
-                    app_dir = os.path.dirname(sys.executable)
-                else:
-                    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-                base_output_dir = os.path.join(app_dir, "output")
-        
-            # Tạo subfolder dựa trên tên folder chứa file gốc
-            original_dir_name = os.path.basename(os.path.dirname(original_file))
-            
-            # Nếu file từ Drive, lấy tên folder cuối cùng trong path
-            if "downloaded_pdfs" in original_file:
-                # Extract folder name từ path: .../downloaded_pdfs/folder_name/file.pdf
-                path_parts = original_file.split(os.sep)
-                if "downloaded_pdfs" in path_parts:
-                    drive_index = path_parts.index("downloaded_pdfs")
-                    if drive_index + 1 < len(path_parts) - 1:  # Có folder con sau downloaded_pdfs
-                        original_dir_name = path_parts[drive_index + 1]
-                    else:
-                        original_dir_name = "drive_files"
-        
-            # Tạo thư mục output cuối cùng
-            output_dir = os.path.join(base_output_dir, original_dir_name)
-            
-            # Tạo output filename dựa trên format
-            base_name = os.path.splitext(os.path.basename(original_file))[0]
-            
-            if "Markdown" in self.output_format:
-                output_file = os.path.join(output_dir, f"{base_name}.md")
-                url = f"https://api.mathpix.com/v3/pdf/{pdf_id}.md"
-                write_mode = 'w'
-                encoding = 'utf-8'
-            elif "DOCX" in self.output_format:
-                output_file = os.path.join(output_dir, f"{base_name}_converted.docx")
-                url = f"https://api.mathpix.com/v3/pdf/{pdf_id}.docx"
-                write_mode = 'wb'
-                encoding = None
-            else:  # PDF OCR
-                output_file = os.path.join(output_dir, f"{base_name}_ocr.pdf")
-                url = f"https://api.mathpix.com/v3/pdf/{pdf_id}.pdf"
-                write_mode = 'wb'
-                encoding = None
-        
-            # Download file
-            headers = {
-                'app_key': self.app_key, 
-                'app_id': self.app_id
-            }
-            
-            response = requests.get(url, headers=headers, timeout=120)
-            
-            if response.status_code == 200:
-                # Ensure output directory exists
-                os.makedirs(output_dir, exist_ok=True)
-                
-                # Write file
-                if write_mode == 'w':
-                    # Text mode for Markdown
-                    with open(output_file, 'w', encoding=encoding) as f:
-                        f.write(response.text)
-                else:
-                    # Binary mode for DOCX/PDF
-                    with open(output_file, 'wb') as f:
-                        f.write(response.content)
-                
-                return output_file
-            else:
-                print(f"❌ Download error: {response.status_code}")
-                return None
-                
+            fmt = fmt or self._format_key()
+            output_file = self._output_path(original_file, fmt)
+            # Tải dạng stream qua session dùng chung
+            return self.client.download(pdf_id, fmt, output_file)
         except Exception as e:
             print(f"❌ Download error: {e}")
             return None
\ No newline at end of file
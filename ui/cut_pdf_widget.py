@@ -200,8 +200,20 @@ class CutPdfWidget(QWidget):
         buttons_layout.addWidget(self.browse_folder_button)
         buttons_layout.addWidget(self.scan_folder_button)
         
+        self.incremental_checkbox = QCheckBox("⏭️ Chỉ xử lý sách mới / đã thay đổi (dùng lại kết quả cũ)")
+        self.incremental_checkbox.setChecked(True)
+        
+        self.drive_sync_checkbox = QCheckBox("🔄 Drive: chỉ tải PDF mới / đã sửa trên Drive (giữ bản local để đồng bộ)")
+        self.drive_sync_checkbox.setChecked(False)
+        
+        self.in_memory_checkbox = QCheckBox("💾 Drive: tải PDF nguồn vào RAM, không lưu file gốc (sách chỉ cắt 1 lần)")
+        self.in_memory_checkbox.setChecked(False)
+        
         layout.addWidget(self.local_folder_input)
         layout.addLayout(buttons_layout)
+        layout.addWidget(self.incremental_checkbox)
+        layout.addWidget(self.drive_sync_checkbox)
+        layout.addWidget(self.in_memory_checkbox)
         layout.addWidget(self.auto_process_local_button)
         group.setLayout(layout)
         return group
@@ -821,7 +833,10 @@ class CutPdfWidget(QWidget):
             drive_url, 
             prompt_path, 
             self.project_id, 
-            self.credentials
+            self.credentials,
+            incremental=self.incremental_checkbox.isChecked(),
+            sync_mode=self.drive_sync_checkbox.isChecked(),
+            in_memory=self.in_memory_checkbox.isChecked()
         )
         
         self.auto_processor.progress.connect(self.update_status)
@@ -887,7 +902,8 @@ class CutPdfWidget(QWidget):
             self.local_pdfs,
             prompt_path, 
             self.project_id, 
-            self.credentials
+            self.credentials,
+            incremental=self.incremental_checkbox.isChecked()
         )
         
         self.local_processor.progress.connect(self.update_status)
@@ -5,6 +5,7 @@ Tương thích với kiến trúc CutPdfByDrive hiện tại
 import sys
 import os
 import glob
+import time
 import threading
 import concurrent.futures
 import mammoth
@@ -19,27 +20,75 @@ from PyQt5.QtWidgets import (
 from PyQt5.QtCore import Qt, QThread, pyqtSignal, QSettings
 from PyQt5.QtWebEngineWidgets import QWebEngineView
 from PyQt5.QtGui import QFont
+from collections import deque
 from config.credentials import Config
 from ui.groupfiles import main as _smart_group_files
+from modules.common.concurrency import AdaptiveConcurrency, QuotaErrorCounter, get_model_concurrency_limit, is_quota_error
+from modules.common.callAPI import (AsyncRunner, set_current_async_runner, set_current_quota_counter,
+                                    set_current_text_layer_report)
+from modules.common import pdf_text_layer, fast_json, json_repair
+from modules.common.lesson_composer import TASK_SUFFIXES, compose_lesson
+from core.hashing import file_sha256, text_sha256
+from modules.common.run_journal import RunJournal
+
+DEFAULT_MODEL_NAME = "gemini-2.5-pro"
+SUBMIT_STAGGER_SECONDS = 2  # Giãn cách giữa 2 lần nạp task liên tiếp
 
 # ============================================================
 # CLASS ĐA LUỒNG (WORKER) - ĐÃ TỐI ƯU HÓA
 # ============================================================
 class TaskInfo:
     """Class lưu thông tin cho từng nhiệm vụ nhỏ"""
-    def __init__(self, output_name, pdf_files, task_type, prompt_content):
+    def __init__(self, output_name, pdf_files, task_type, prompt_content, pdf_sha=""):
         self.output_name = output_name
         self.pdf_files = pdf_files
         self.task_type = task_type  # "TN", "DS", hoặc "TLN"
         self.prompt_content = prompt_content
+        # Dấu vân tay đầu vào (prompt + nội dung từng PDF) để journal biết kết quả cũ còn hợp lệ không
+        self.input_sha = text_sha256(prompt_content + "\n" + pdf_sha)
+        self.replay_json = None  # JSON phản hồi AI đã lưu -> render lại, không gọi AI
+
+def compose_lessons_with_progress(output_names, processor_module, emit_progress, fast_docx=False):
+    """Gộp TN/DS/TLN/TL đã lưu của từng bài thành 1 file, trả về các file đã tạo"""
+    composed = []
+    for idx, output_name in enumerate(output_names, 1):
+        emit_progress(f"📚 [{idx}/{len(output_names)}] Gộp các dạng đề: {output_name}")
+        try:
+            output_path = compose_lesson(processor_module, output_name, fast_docx=fast_docx)
+        except Exception as e:
+            emit_progress(f"❌ Lỗi gộp {output_name}: {e}")
+            continue
+        if output_path:
+            composed.append(output_path)
+    return composed
+
+
+class ComposeThread(QThread):
+    """Gộp file cho các bài đã xử lý trước đó (chỉ render từ JSON, không gọi AI)"""
+    progress = pyqtSignal(str)
+    finished = pyqtSignal(list)
+
+    def __init__(self, output_names, processor_module, fast_docx=False):
+        super().__init__()
+        self.output_names = output_names
+        self.processor_module = processor_module
+        self.fast_docx = fast_docx
+
+    def run(self):
+        self.finished.emit(compose_lessons_with_progress(self.output_names, self.processor_module, self.progress.emit,
+                                                         fast_docx=self.fast_docx))
+
 
 class ProcessingThread(QThread):
     progress = pyqtSignal(str)
     progress_update = pyqtSignal(int, int)
+    concurrency_update = pyqtSignal(int, int, int)  # đang chạy, đang chờ, giới hạn hiện tại
     finished = pyqtSignal(list)
     error_signal = pyqtSignal(str)
 
-    def __init__(self, selected_items, prompt_paths, project_id, creds, processor_module, max_workers=2):
+    def __init__(self, selected_items, prompt_paths, project_id, creds, processor_module, max_workers=2,
+                 auto_concurrency=False, model_name=DEFAULT_MODEL_NAME, resume=False, use_text_layer=False,
+                 fast_docx=False, compose_lessons=False):
         super().__init__()
         self.selected_items = selected_items
         self.prompt_paths = prompt_paths
@@ -47,14 +96,43 @@ class ProcessingThread(QThread):
         self.creds = creds
         self.processor_module = processor_module # Module xử lý (KHXH hoặc KHTN)
         self.max_workers = max_workers
+        self.auto_concurrency = auto_concurrency
+        self.model_name = model_name
+        self.resume = resume
+        self.use_text_layer = use_text_layer
+        self.fast_docx = fast_docx
+        self.compose_lessons = compose_lessons
+        self.journal = None
         self.generated_files = []
         self.is_running = True
         self.lock = threading.Lock()
+        # Event loop riêng cho lần chạy này: stop() hủy được mọi request Gemini đang bay
+        self.async_runner = None
+        # Lỗi quota của riêng lần chạy này (tab khác gặp 429 không làm giảm luồng ở đây)
+        self.quota_counter = QuotaErrorCounter()
+        self.text_layer_report = pdf_text_layer.TextLayerReport()
+
+    def _create_concurrency_controller(self):
+        """Giới hạn số task chạy cùng lúc: cố định theo user hoặc tự động theo quota model"""
+        model_limit = get_model_concurrency_limit(self.model_name)
+        if self.auto_concurrency:
+            return AdaptiveConcurrency(model_limit, initial=min(2, model_limit), adaptive=True)
+        limit = min(self.max_workers, model_limit)
+        return AdaptiveConcurrency(limit, initial=limit, adaptive=False)
+
+    @staticmethod
+    def _pdf_fingerprint(pdf_files):
+        """Hash nội dung các PDF (không phải đường dẫn): sửa PDF cùng tên -> kết quả cũ hết hợp lệ"""
+        parts = []
+        for path in pdf_files:
+            try:
+                parts.append(file_sha256(path))
+            except OSError:
+                parts.append(path)  # Không đọc được -> để lỗi báo ở bước gửi AI
+        return "\n".join(parts)
 
     def run(self):
         """Logic chạy chính: Tách nhỏ tác vụ để chạy song song"""
-        import time
-
         self.progress.emit("⚙️ Đang chuẩn bị dữ liệu và đọc Prompt...")
 
         # 1. Đọc Prompt
@@ -72,107 +150,217 @@ class ProcessingThread(QThread):
         all_tasks = []
         total_input_files = len(self.selected_items)
         for output_name, pdf_files in self.selected_items.items():
+            pdf_sha = self._pdf_fingerprint(pdf_files)  # Hash 1 lần, dùng chung cho các dạng đề
             if "trac_nghiem" in prompts:
-                all_tasks.append(TaskInfo(output_name, pdf_files, "TN", prompts["trac_nghiem"]))
+                all_tasks.append(TaskInfo(output_name, pdf_files, "TN", prompts["trac_nghiem"], pdf_sha))
             if "dung_sai" in prompts:
-                all_tasks.append(TaskInfo(output_name, pdf_files, "DS", prompts["dung_sai"]))
+                all_tasks.append(TaskInfo(output_name, pdf_files, "DS", prompts["dung_sai"], pdf_sha))
             if "tra_loi_ngan" in prompts:
-                all_tasks.append(TaskInfo(output_name, pdf_files, "TLN", prompts["tra_loi_ngan"]))
+                all_tasks.append(TaskInfo(output_name, pdf_files, "TLN", prompts["tra_loi_ngan"], pdf_sha))
             if "tu_luan" in prompts:
-                all_tasks.append(TaskInfo(output_name, pdf_files, "TL", prompts["tu_luan"]))
+                all_tasks.append(TaskInfo(output_name, pdf_files, "TL", prompts["tu_luan"], pdf_sha))
 
         total_tasks = len(all_tasks)
         if total_tasks == 0:
             self.finished.emit([])
             return
 
-        msg_start = f"🚀 Bắt đầu xử lý {total_input_files} bài (sinh ra {total_tasks} file kết quả)..."
+        # Journal ghi lại trạng thái từng task trong output/run_journal.jsonl
+        self.journal = RunJournal(os.path.join(self.processor_module.get_app_path(), "output"))
+        skipped_count = 0
+        replay_count = 0
+        if self.resume:
+            remaining_tasks = []
+            for task in all_tasks:
+                done_path = self.journal.completed_output(task.output_name, task.task_type, task.input_sha)
+                if done_path:
+                    self.generated_files.append(done_path)
+                    skipped_count += 1
+                    continue
+                task.replay_json = self.journal.cached_response(
+                    task.output_name, task.task_type, task.input_sha, self._response_path(task)
+                )
+                if task.replay_json:
+                    replay_count += 1
+                remaining_tasks.append(task)
+            all_tasks = remaining_tasks
+            self.progress.emit(f"♻️ Resume: bỏ qua {skipped_count} task đã xong, render lại {replay_count} task từ JSON đã lưu.")
+
+        controller = self._create_concurrency_controller()
+        mode_text = "tự động" if controller.adaptive else "cố định"
+        msg_start = f"🚀 Bắt đầu xử lý {total_input_files} bài (sinh ra {total_tasks} file kết quả) - luồng {mode_text}, tối đa {controller.max_limit}..."
         self.progress.emit(msg_start)
         self.progress_update.emit(0, total_tasks)
 
-        completed_count = 0
+        completed_count = skipped_count
         failed_count = 0
+        self.progress_update.emit(completed_count, total_tasks)
+        pending_tasks = deque(all_tasks)
+        in_flight = {}
+        seen_quota_errors = self.quota_counter.count
 
-        # 3. Thực thi song song
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            future_to_task = {}
-            for task in all_tasks:
-                if not self.is_running: break
-                future = executor.submit(self._process_worker, task)
-                future_to_task[future] = task
-                time.sleep(5)  # Tránh spam API
-
-            for future in concurrent.futures.as_completed(future_to_task):
-                if not self.is_running: break
-                task = future_to_task[future]
-                try:
-                    result_path, error_msg = future.result()
-                    with self.lock:
+        json_repair.reset_stats()
+
+        # 3. Thực thi song song: chỉ nạp thêm task khi số task đang chạy < giới hạn hiện tại
+        self.async_runner = AsyncRunner()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=controller.max_limit)
+        try:
+            while (pending_tasks or in_flight) and self.is_running:
+                while pending_tasks and len(in_flight) < controller.limit and self.is_running:
+                    task = pending_tasks.popleft()
+                    future = executor.submit(self._run_timed_worker, task)
+                    in_flight[future] = task
+                    self.concurrency_update.emit(len(in_flight), len(pending_tasks), controller.limit)
+                    if pending_tasks and len(in_flight) < controller.limit:
+                        time.sleep(SUBMIT_STAGGER_SECONDS)  # Tránh spam API
+
+                done, _ = concurrent.futures.wait(
+                    in_flight, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    task = in_flight.pop(future)
+                    try:
+                        result_path, error_msg, latency = future.result()
+                        with self.lock:
+                            completed_count += 1
+                            if result_path:
+                                controller.record_success(latency, key=task.task_type)
+                                self.generated_files.append(result_path)
+                                status_icon = "✅"
+                                # Rút gọn tên hiển thị cho đỡ rối
+                                short_name = task.output_name if len(task.output_name) < 30 else task.output_name[:27] + "..."
+                                msg = f"Xong {short_name} - {task.task_type} ({latency:.0f}s)"
+                            else:
+                                controller.record_failure()
+                                failed_count += 1
+                                status_icon = "⚠️"
+                                msg = f"Lỗi {task.output_name}: {error_msg}"
+
+                        self.progress.emit(f"{status_icon} [{completed_count}/{total_tasks}] {msg}")
+                        self.progress_update.emit(completed_count, total_tasks)
+
+                    except Exception as e:
+                        controller.record_failure(quota_error=is_quota_error(e))
                         completed_count += 1
-                        if result_path:
-                            self.generated_files.append(result_path)
-                            status_icon = "✅"
-                            # Rút gọn tên hiển thị cho đỡ rối
-                            short_name = task.output_name if len(task.output_name) < 30 else task.output_name[:27] + "..."
-                            msg = f"Xong {short_name} - {task.task_type}"
-                        else:
-                            failed_count += 1
-                            status_icon = "⚠️"
-                            msg = f"Lỗi {task.output_name}: {error_msg}"
-                    
-                    self.progress.emit(f"{status_icon} [{completed_count}/{total_tasks}] {msg}")
-                    self.progress_update.emit(completed_count, total_tasks)
+                        self.progress.emit(f"❌ Exception tại {task.output_name}: {str(e)}")
+                        self.progress_update.emit(completed_count, total_tasks)
 
-                except Exception as e:
-                    completed_count += 1
-                    self.progress.emit(f"❌ Exception tại {task.output_name}: {str(e)}")
-                    self.progress_update.emit(completed_count, total_tasks)
+                # Lỗi quota (429) trong bất kỳ request nào của lần chạy này -> giảm số luồng
+                quota_errors = self.quota_counter.count
+                if quota_errors > seen_quota_errors:
+                    seen_quota_errors = quota_errors
+                    controller.record_failure(quota_error=True)
 
+                self.concurrency_update.emit(len(in_flight), len(pending_tasks), controller.limit)
+        finally:
+            # Bấm dừng -> bỏ các task chưa chạy, không chờ task đang chạy
+            executor.shutdown(wait=self.is_running, cancel_futures=True)
+            self.async_runner.close()
+
+        if not self.is_running:
+            self.progress.emit(f"🛑 Đã dừng. Hoàn thành {completed_count}/{total_tasks} file.")
+        elif self.compose_lessons:
+            self.generated_files.extend(compose_lessons_with_progress(
+                list(self.selected_items), self.processor_module, self.progress.emit, fast_docx=self.fast_docx))
+        if self.use_text_layer:
+            pdf_text_layer.clear_cache()
+            report_text = self.text_layer_report.format()
+            print(report_text)
+            self.progress.emit(report_text)
+        if json_repair.get_stats():
+            repair_text = json_repair.format_stats()
+            print(repair_text)
+            self.progress.emit(repair_text)
         self.finished.emit(self.generated_files)
 
+    def _run_timed_worker(self, task):
+        """Chạy worker và đo thời gian để bộ điều phối luồng đánh giá tải API"""
+        started = time.perf_counter()
+        set_current_async_runner(self.async_runner)
+        set_current_quota_counter(self.quota_counter)
+        set_current_text_layer_report(self.text_layer_report)
+        result_path, error_msg = self._process_worker(task)
+        return result_path, error_msg, time.perf_counter() - started
+
+    def _response_path(self, task):
+        """Đường dẫn JSON phản hồi AI mà module xử lý lưu cạnh file DOCX"""
+        batch_folder = self.processor_module.ensure_output_folder_for_batch(task.output_name)
+        return os.path.join(batch_folder, f"{task.output_name}{TASK_SUFFIXES[task.task_type]}.json")
+
+    def _replay_cached_response(self, task, output_filename):
+        """Render lại DOCX từ JSON đã lưu (không gọi AI)"""
+        render_func = getattr(self.processor_module, 'render_docx_from_json', None)
+        if not render_func:
+            return None
+        json_data = fast_json.load_file(task.replay_json)
+        self.progress.emit(f"♻️ Render lại từ JSON: {output_filename}")
+        return render_func(json_data, task.output_name, output_filename, fast_docx=self.fast_docx)
+
     def _process_worker(self, task):
         """Gọi hàm xử lý từ module được truyền vào"""
-        MODEL_NAME = "gemini-2.5-pro"
-        
+        started_ts = time.time()
         try:
             if task.task_type == "TN":
                 func = getattr(self.processor_module, 'response2docx_json', None)
-                suffix = "_TN"
             elif task.task_type == "DS":
                 func = getattr(self.processor_module, 'response2docx_dung_sai_json', None)
-                suffix = "_DS"
             elif task.task_type == "TLN":
                 func = getattr(self.processor_module, 'response2docx_tra_loi_ngan_json', None)
-                suffix = "_TLN"
             else: # [THÊM MỚI] Tự luận
                 func = getattr(self.processor_module, 'response2docx_tu_luan_json', None)
-                suffix = "_TL"
 
             if not func:
                 return None, f"Module không hỗ trợ loại đề {task.task_type}"
 
-            output_filename = f"{task.output_name}{suffix}"
-            
-            docx_path = func(
-                task.pdf_files,
-                task.prompt_content,
-                output_filename,
-                self.project_id,
-                self.creds,
-                MODEL_NAME, 
-                batch_name=task.output_name
-            )
+            output_filename = f"{task.output_name}{TASK_SUFFIXES[task.task_type]}"
+
+            if task.replay_json:
+                # Giữ mốc started cũ để JSON vẫn còn hợp lệ nếu lần render này lại lỗi
+                entry = self.journal.get(task.output_name, task.task_type) or {}
+                started_ts = entry.get("started_ts", started_ts)
+                docx_path = self._replay_cached_response(task, output_filename)
+            else:
+                self.journal.record(task.output_name, task.task_type, "started",
+                                    input_sha=task.input_sha, started_ts=started_ts)
+                docx_path = func(
+                    task.pdf_files,
+                    task.prompt_content,
+                    output_filename,
+                    self.project_id,
+                    self.creds,
+                    self.model_name, 
+                    batch_name=task.output_name,
+                    # PDF có text layer tốt -> gửi text thay cho cả file (giảm token đầu vào)
+                    use_text_layer=self.use_text_layer,
+                    # Đề lớn: ghi thẳng WordprocessingML thay vì object python-docx
+                    fast_docx=self.fast_docx
+                )
             
             if docx_path and os.path.exists(docx_path):
+                response_path = self._response_path(task)
+                self.journal.record(
+                    task.output_name, task.task_type, "done",
+                    input_sha=task.input_sha, started_ts=started_ts,
+                    output_path=docx_path, output_sha256=file_sha256(docx_path),
+                    response_path=response_path if os.path.exists(response_path) else None
+                )
                 return docx_path, None
             else:
+                self.journal.record(task.output_name, task.task_type, "failed",
+                                    input_sha=task.input_sha, started_ts=started_ts,
+                                    error="Không tạo được file DOCX")
                 return None, "Không tạo được file DOCX"
 
         except Exception as e:
+            if self.journal:
+                self.journal.record(task.output_name, task.task_type, "failed",
+                                    input_sha=task.input_sha, started_ts=started_ts, error=str(e))
             return None, str(e)
 
     def stop(self):
         self.is_running = False
+        if self.async_runner:
+            self.async_runner.cancel_all()
 
 # ============================================================
 # CLASS GIAO DIỆN CHÍNH (BASE WIDGET)
@@ -520,11 +708,46 @@ class GenQuesWidget(QWidget):
         
         thread_layout = QHBoxLayout()
         thread_layout.addWidget(QLabel("Số bài xử lí cùng lúc:"))
+        model_limit = get_model_concurrency_limit(DEFAULT_MODEL_NAME)
         self.spin_worker = QSpinBox()
-        self.spin_worker.setRange(1, 3)
-        self.spin_worker.setValue(3)
+        self.spin_worker.setRange(1, model_limit)
+        self.spin_worker.setValue(min(self.settings.value("max_workers", 3, type=int), model_limit))
         self.spin_worker.setFixedWidth(60)
+        self.spin_worker.setToolTip(f"Tối đa {model_limit} luồng cho {DEFAULT_MODEL_NAME}")
+        self.spin_worker.valueChanged.connect(lambda v: self.settings.setValue("max_workers", v))
         thread_layout.addWidget(self.spin_worker)
+
+        self.chk_auto_worker = QCheckBox("Tự động (tăng dần theo quota)")
+        self.chk_auto_worker.setToolTip("Bắt đầu với 2 luồng, tăng dần khi API ổn định, giảm một nửa khi API báo hết quota (429) "
+                                        "hoặc phản hồi chậm hẳn nhiều lần liên tiếp. Lỗi JSON / nội dung không làm giảm luồng")
+        self.chk_auto_worker.setChecked(self.settings.value("auto_concurrency", False, type=bool))
+        self.chk_auto_worker.stateChanged.connect(self.on_auto_worker_changed)
+        self.spin_worker.setEnabled(not self.chk_auto_worker.isChecked())
+        thread_layout.addWidget(self.chk_auto_worker)
+
+        self.chk_resume = QCheckBox("♻️ Tiếp tục lần chạy trước")
+        self.chk_resume.setToolTip("Bỏ qua các file đã tạo xong (theo output/run_journal.jsonl), render lại từ JSON đã lưu nếu có")
+        self.chk_resume.setChecked(self.settings.value("resume_run", False, type=bool))
+        self.chk_resume.stateChanged.connect(lambda state: self.settings.setValue("resume_run", state == Qt.Checked))
+        thread_layout.addWidget(self.chk_resume)
+
+        self.chk_text_layer = QCheckBox("📑 Gửi text layer thay cho PDF")
+        self.chk_text_layer.setToolTip("PDF có sẵn text tốt được gửi dạng text, chỉ đính kèm các trang có hình / text lỗi; PDF scan vẫn gửi nguyên file")
+        self.chk_text_layer.setChecked(self.settings.value("use_text_layer", False, type=bool))
+        self.chk_text_layer.stateChanged.connect(lambda state: self.settings.setValue("use_text_layer", state == Qt.Checked))
+        thread_layout.addWidget(self.chk_text_layer)
+
+        self.chk_fast_docx = QCheckBox("⚡ Ghi DOCX trực tiếp")
+        self.chk_fast_docx.setToolTip("Ghi XML của DOCX trực tiếp thay vì qua python-docx: nhanh và nhẹ hơn nhiều với đề 100-200 câu song ngữ")
+        self.chk_fast_docx.setChecked(self.settings.value("fast_docx_writer", False, type=bool))
+        self.chk_fast_docx.stateChanged.connect(lambda state: self.settings.setValue("fast_docx_writer", state == Qt.Checked))
+        thread_layout.addWidget(self.chk_fast_docx)
+
+        self.chk_compose = QCheckBox("📚 Gộp các dạng đề thành 1 file / bài")
+        self.chk_compose.setToolTip("Sau khi chạy xong, gộp TN + DS + TLN + TL của mỗi bài thành <bài>_TONG_HOP.docx")
+        self.chk_compose.setChecked(self.settings.value("compose_lessons", False, type=bool))
+        self.chk_compose.stateChanged.connect(lambda state: self.settings.setValue("compose_lessons", state == Qt.Checked))
+        thread_layout.addWidget(self.chk_compose)
         thread_layout.addStretch()
         
         self.btn_process = QPushButton("🚀 BẮT ĐẦU SINH CÂU HỎI")
@@ -532,8 +755,25 @@ class GenQuesWidget(QWidget):
         self.btn_process.setMinimumHeight(50)
         self.btn_process.clicked.connect(self.process_files)
         
+        self.btn_stop = QPushButton("⏹️ Dừng")
+        self.btn_stop.setMinimumHeight(50)
+        self.btn_stop.setFixedWidth(120)
+        self.btn_stop.setEnabled(False)
+        self.btn_stop.clicked.connect(self.stop_processing)
+
+        self.btn_compose = QPushButton("📚 Gộp file đã có")
+        self.btn_compose.setMinimumHeight(50)
+        self.btn_compose.setFixedWidth(160)
+        self.btn_compose.setToolTip("Gộp các dạng đề đã tạo của bài đang chọn thành 1 file (không gọi AI)")
+        self.btn_compose.clicked.connect(self.compose_existing)
+
+        run_layout = QHBoxLayout()
+        run_layout.addWidget(self.btn_process)
+        run_layout.addWidget(self.btn_compose)
+        run_layout.addWidget(self.btn_stop)
+        
         act_layout.addLayout(thread_layout)
-        act_layout.addWidget(self.btn_process)
+        act_layout.addLayout(run_layout)
 
         self.progress_bar = QProgressBar()
         self.progress_bar.setVisible(False)
@@ -544,7 +784,13 @@ class GenQuesWidget(QWidget):
         self.status_lbl.setAlignment(Qt.AlignCenter)
         self.status_lbl.setStyleSheet("font-weight: bold; color: #555; min-height: 40px;")
         
+        self.concurrency_lbl = QLabel("")
+        self.concurrency_lbl.setAlignment(Qt.AlignCenter)
+        self.concurrency_lbl.setStyleSheet("color: #1565C0;")
+        self.concurrency_lbl.setVisible(False)
+
         act_layout.addWidget(self.progress_bar)
+        act_layout.addWidget(self.concurrency_lbl)
         act_layout.addWidget(self.status_lbl)
 
         proc_layout.addWidget(file_group, 5)
@@ -1113,6 +1359,22 @@ class GenQuesWidget(QWidget):
         else: 
             self.btn_process.setText("BẮT ĐẦU XỬ LÝ")
 
+    def on_auto_worker_changed(self, state):
+        """Bật chế độ tự động thì khóa ô nhập số luồng"""
+        is_auto = state == Qt.Checked
+        self.spin_worker.setEnabled(not is_auto)
+        self.settings.setValue("auto_concurrency", is_auto)
+
+    def update_concurrency_label(self, in_flight, queued, limit):
+        self.concurrency_lbl.setText(f"⚡ Đang chạy: {in_flight} | ⏳ Đang chờ: {queued} | 🎚️ Giới hạn: {limit} luồng")
+
+    def stop_processing(self):
+        """Dừng luồng xử lý: bỏ task chưa chạy và hủy các request AI đang chờ"""
+        if self.processing_thread and self.processing_thread.isRunning():
+            self.processing_thread.stop()
+            self.btn_stop.setEnabled(False)
+            self.status_lbl.setText("🛑 Đang dừng, hủy các request đang chạy...")
+
     # --- LOGIC CHẠY (PROCESS) ---
     def process_files(self):
         # 1. Kiểm tra đã chọn PDF chưa
@@ -1150,11 +1412,15 @@ class GenQuesWidget(QWidget):
 
         # 3. Nếu mọi thứ OK -> Mới bắt đầu khóa nút và chạy Thread
         self.btn_process.setEnabled(False)
+        self.btn_compose.setEnabled(False)  # Gộp file cùng lúc sẽ ghi đè file của lần chạy đang dở
+        self.btn_stop.setEnabled(True)
         self.progress_bar.setVisible(True)
         self.progress_bar.setValue(0)
         self.status_lbl.setText("⏳ Đang khởi tạo quá trình xử lý đa luồng...")
         
         max_workers = self.spin_worker.value()
+        self.concurrency_lbl.setText("")
+        self.concurrency_lbl.setVisible(True)
         
         self.processing_thread = ProcessingThread(
             selected,
@@ -1162,10 +1428,16 @@ class GenQuesWidget(QWidget):
             self.project_id,
             self.credentials,
             self.processor_module,
-            max_workers
+            max_workers,
+            auto_concurrency=self.chk_auto_worker.isChecked(),
+            resume=self.chk_resume.isChecked(),
+            use_text_layer=self.chk_text_layer.isChecked(),
+            fast_docx=self.chk_fast_docx.isChecked(),
+            compose_lessons=self.chk_compose.isChecked()
         )
         
         self.processing_thread.progress.connect(lambda s: self.status_lbl.setText(s))
+        self.processing_thread.concurrency_update.connect(self.update_concurrency_label)
         self.processing_thread.progress_update.connect(lambda c, t: self.progress_bar.setValue(int(c/t*100) if t else 0))
         self.processing_thread.finished.connect(self.on_finished)
         
@@ -1173,21 +1445,43 @@ class GenQuesWidget(QWidget):
         def on_thread_error(e):
             QMessageBox.critical(self, "Lỗi xử lý", f"❌ Có lỗi xảy ra trong quá trình chạy:\n{e}")
             self.btn_process.setEnabled(True) # Mở lại nút để user bấm lại
+            self.btn_compose.setEnabled(True)
+            self.btn_stop.setEnabled(False)
             self.progress_bar.setVisible(False)
+            self.concurrency_lbl.setVisible(False)
             self.status_lbl.setText("Đã dừng do lỗi.")
 
         self.processing_thread.error_signal.connect(on_thread_error)
         
         self.processing_thread.start()
 
+    def compose_existing(self):
+        """Gộp file cho các bài đang chọn từ JSON đã lưu"""
+        selected = self.get_selected_files()
+        if not selected:
+            QMessageBox.warning(self, "Thiếu dữ liệu", "⚠️ Vui lòng chọn ít nhất 1 bài đã xử lý!")
+            return
+
+        self.btn_process.setEnabled(False)
+        self.btn_compose.setEnabled(False)
+        self.status_lbl.setText("📚 Đang gộp file...")
+        self.compose_thread = ComposeThread(list(selected), self.processor_module,
+                                            fast_docx=self.chk_fast_docx.isChecked())
+        self.compose_thread.progress.connect(lambda s: self.status_lbl.setText(s))
+        self.compose_thread.finished.connect(self.on_finished)
+        self.compose_thread.start()
+
     def on_finished(self, files):
         self.generated_files = files
+        self.btn_compose.setEnabled(True)
         self.res_list.clear()
         for f in files:
             self.res_list.addItem(os.path.basename(f))
         
         self.btn_process.setEnabled(True)
+        self.btn_stop.setEnabled(False)
         self.progress_bar.setVisible(False)
+        self.concurrency_lbl.setVisible(False)
         self.status_lbl.setText(f"Hoàn thành! Tạo được {len(files)} file.")
         self.tab_widget.setCurrentIndex(1)
         